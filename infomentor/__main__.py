@@ -2,10 +2,14 @@ import infomentor.flock as flock
 import logging
 import argparse
 import datetime
+import concurrent.futures
+import time
 import sys
 import os
+import secrets
 import requests
-from infomentor import db, model, connector, informer, config
+from sqlalchemy.orm import joinedload
+from infomentor import db, model, connector, informer, config, filestorage, dispatcher, mailer
 
 
 logformat = (
@@ -49,20 +53,50 @@ def parse_args(arglist):
     parser.add_argument(
         "--invitationmail", type=str, nargs="?", help="e-mail for notification"
     )
+    parser.add_argument(
+        "--calendarfeed",
+        action="store_true",
+        help="provide the calendar entries as ics feed for subscription",
+    )
+    parser.add_argument(
+        "--batchinvitations",
+        action="store_true",
+        help="send the calendar entries of a run in one invitation mail",
+    )
+    parser.add_argument(
+        "--digest",
+        type=int,
+        nargs="?",
+        const=0,
+        help="send news and homework as one message per run or per window of minutes",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="number of users updated in parallel"
+    )
+    parser.add_argument(
+        "--gc", action="store_true", help="remove stored files no longer referenced"
+    )
+    parser.add_argument(
+        "--nodispatch", action="store_true", help="only fetch, leave notifications queued"
+    )
+    parser.add_argument(
+        "--dispatchonly", action="store_true", help="only send queued notifications"
+    )
     args = parser.parse_args(arglist)
     return args
 
 
 def perform_user_update(args):
+    logger = logging.getLogger(__name__)
     username = args.username
     session = db.get_db()
     existing_user = (
         session.query(model.User).filter(model.User.name == username).one_or_none()
     )
     if existing_user is not None:
-        logger.info("Updating user {}", username)
+        logger.info("Updating user %s", username)
     else:
-        logger.info("Creating User user {}", username)
+        logger.info("Creating user %s", username)
 
     if args.password is None:
         logger.info("No password provided, asking for it")
@@ -72,7 +106,8 @@ def perform_user_update(args):
         password = args.password
 
     if existing_user is not None:
-        existing_user.password = password
+        user = existing_user
+        user.password = password
     else:
         user = model.User(name=username, password=password)
         session.add(user)
@@ -98,6 +133,11 @@ def perform_user_update(args):
             ntype=model.Notification.Types.FAKE, info=""
         )
 
+    if args.digest is not None and user.notification is not None:
+        logger.info("Activating digest notification")
+        user.notification.digest = True
+        user.notification.digestwindow = args.digest
+
     if (
         args.iclouduser is not None
         and args.icloudpwd is not None
@@ -112,53 +152,80 @@ def perform_user_update(args):
 
     if args.invitationmail:
         logger.info("Activating sending of calendar entries per mail")
-        user.invitation = model.Invitation(email=mail)
+        user.invitation = model.Invitation(
+            email=args.invitationmail, batch=args.batchinvitations
+        )
+
+    if args.calendarfeed and user.feed_token is None:
+        user.feed_token = secrets.token_urlsafe(24)
+        logger.info("Calendar feed at /calendar/%s.ics", user.feed_token)
 
     session.commit()
 
 
-def notify_users():
-    logger = logging.getLogger(__name__)
-    session = db.get_db()
-    cfg = config.load()
-    if cfg["healthchecks"]["url"] != "":
-        logger.info("Triggering Healthcheck Start")
-        requests.get(cfg["healthchecks"]["url"] + "/start")
+def _load_user(session, user_id):
+    """Load a user with the relations used while no transaction is open"""
+    return (
+        session.query(model.User)
+        .options(
+            joinedload(model.User.notification),
+            joinedload(model.User.icalendar),
+            joinedload(model.User.invitation),
+        )
+        .filter(model.User.id == user_id)
+        .one()
+    )
+
+
+def update_user(user_id, cache=None):
+    """Run all update stages for one user, using its own sessions
 
-    for user in session.query(model.User):
+    Returns the username and the time it took to process the user."""
+    logger = logging.getLogger(__name__)
+    started = time.monotonic()
+    session = db.new_session()
+    try:
+        user = _load_user(session, user_id)
         logger.info("==== USER: %s =====", user.name)
         if user.password == "":
             logger.warning("User %s not enabled", user.name)
-            continue
+            return user.name, time.monotonic() - started
         now = datetime.datetime.now()
-        im = connector.Infomentor(user.name)
-        im.login(user.password)
-        logger.info("User loggedin")
         statusinfo = {"datetime": now, "ok": False, "info": "", "degraded_count": 0}
         if user.apistatus is None:
             user.apistatus = model.ApiStatus(**statusinfo)
         logger.info("Former API status: %s", user.apistatus)
+        # the stages end their transactions before requesting infomentor
+        session.commit()
+        im = connector.Infomentor(user.name, logger=logger, cache=cache)
+        i = informer.Informer(user, im, logger=logger, session=session)
+        status_update = None
         try:
-            i = informer.Informer(user, im, logger=logger)
+            im.login(user.password)
+            logger.info("User loggedin")
             i.update_news()
             i.update_homework()
             i.update_calendar()
             statusinfo["ok"] = True
             statusinfo["degraded"] = False
         except Exception as e:
+            session.rollback()
             inforstr = "Exception occured:\n{}:{}\n".format(type(e).__name__, e)
             statusinfo["ok"] = False
             statusinfo["info"] = inforstr
             logger.exception("Something went wrong")
         finally:
+            # a rollback expires the user, the status update needs its
+            # notification after the transaction ended
+            _load_user(session, user_id)
             if user.apistatus.ok == True and statusinfo["ok"] == False:
                 logger.error("Switching to degraded state %s", user.name)
                 statusinfo["degraded_count"] = 1
             if user.apistatus.ok == False and statusinfo["ok"] == False:
                 if user.apistatus.degraded_count == 1 and user.wantstatus:
-                    im.send_status_update(statusinfo["info"])
+                    status_update = statusinfo["info"]
                 try:
-                    statusinfo["degraded_count"] = user.apistatus["degraded_count"] + 1
+                    statusinfo["degraded_count"] = user.apistatus.degraded_count + 1
                 except Exception as e:
                     statusinfo["degraded_count"] = 1
             if user.apistatus.ok == False and statusinfo["ok"] == True:
@@ -167,16 +234,89 @@ def notify_users():
                 )
                 statusinfo["degraded_count"] = 0
                 if user.wantstatus:
-                    im.send_status_update(statusinfo["info"])
+                    status_update = statusinfo["info"]
             user.apistatus.updateobj(statusinfo)
         logger.info("New API status: %s", user.apistatus)
         session.commit()
+        if status_update is not None:
+            i.send_status_update(status_update)
+        return user.name, time.monotonic() - started
+    finally:
+        session.close()
+
+
+def notify_users(workers=1):
+    logger = logging.getLogger(__name__)
+    cfg = config.load()
+    if cfg["healthchecks"]["url"] != "":
+        logger.info("Triggering Healthcheck Start")
+        requests.get(cfg["healthchecks"]["url"] + "/start")
+
+    started = time.monotonic()
+    cache = filestorage.FetchCache(
+        db.new_session,
+        filestorage.BlobStore(cfg["storage"]["blobdir"]),
+        maxage=cfg.getint("cache", "maxage"),
+    )
+    # closed right away, an open transaction keeps sqlite from checkpointing
+    session = db.new_session(readonly=True)
+    try:
+        user_ids = [user_id for user_id, in session.query(model.User.id)]
+    finally:
+        session.close()
+    timings = []
+    if workers > 1:
+        logger.info("Processing %d users with %d workers", len(user_ids), workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(update_user, uid, cache): uid for uid in user_ids
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    timings.append(future.result())
+                except Exception as e:
+                    logger.exception("Updating user %s failed", futures[future])
+    else:
+        for user_id in user_ids:
+            try:
+                timings.append(update_user(user_id, cache))
+            except Exception as e:
+                logger.exception("Updating user %s failed", user_id)
+
+    for name, duration in sorted(timings, key=lambda t: t[1], reverse=True):
+        logger.info("User %s took %.2fs", name, duration)
+    logger.info(
+        "Processed %d users in %.2fs", len(user_ids), time.monotonic() - started
+    )
 
     if cfg["healthchecks"]["url"] != "":
         logger.info("Triggering Healthcheck Stop")
         requests.get(cfg["healthchecks"]["url"])
 
 
+def dispatch_notifications(workers=1):
+    logger = logging.getLogger(__name__)
+    lock = flock.flock(".im.dispatch.lock")
+    if not lock.aquire():
+        logger.info("Dispatcher is still running")
+        return
+    started = time.monotonic()
+    delivered = dispatcher.Dispatcher(
+        db.new_session, logger=logger, workers=workers
+    ).run()
+    logger.info(
+        "Delivered %d notifications in %.2fs", delivered, time.monotonic() - started
+    )
+
+
+def collect_garbage():
+    logger = logging.getLogger(__name__)
+    cfg = config.load()
+    store = filestorage.BlobStore(cfg["storage"]["blobdir"])
+    removed = filestorage.collect_garbage(db.get_db(), store)
+    logger.info("Removed %d orphaned files", removed)
+
+
 def main():
     args = parse_args(sys.argv[1:])
     if args.nolog:
@@ -186,18 +326,27 @@ def main():
     logger = logging.getLogger("Infomentor Notifier")
     logger.info("STARTING-------------------- %s", os.getpid())
     try:
+        if args.dispatchonly:
+            # runs next to the fetching, guarded by its own lock
+            dispatch_notifications(args.workers)
+            return
         lock = flock.flock()
         if not lock.aquire():
             logger.info("EXITING - PREVIOUS IS STILL RUNNING")
             raise Exception()
         if args.username:
             perform_user_update(args)
+        elif args.gc:
+            collect_garbage()
         else:
-            notify_users()
+            notify_users(args.workers)
+            if not args.nodispatch:
+                dispatch_notifications(args.workers)
     except Exception as e:
         logger.info("Exceptional exit")
         logger.exception("Info")
     finally:
+        mailer.close_pool()
         logger.info("EXITING--------------------- %s", os.getpid())
 
 
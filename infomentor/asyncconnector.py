@@ -0,0 +1,320 @@
+import asyncio
+import contextlib
+import json
+import os
+import aiohttp
+from infomentor.connector import (
+    CHUNK_SIZE,
+    InfomentorBase,
+    InfomentorFile,
+    _validator,
+    attachment_id,
+    parse_auth_token,
+    parse_filename,
+)
+
+# a partial download interrupted by one of these is kept to be resumed
+NETWORK_ERRORS = (
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    asyncio.TimeoutError,
+)
+
+
+class Response(object):
+    """A fully read response, detached from the connection it came from"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncInfomentor(InfomentorBase):
+    """asyncio variant of connector.Infomentor
+
+    Every method returns its result instead of keeping it on the object, so
+    one instance can run many requests at once. The number of requests in
+    flight is bounded by a semaphore, which may be shared between the
+    instances of several accounts."""
+
+    def __init__(self, user, logger=None, semaphore=None, limit=10):
+        """Create informentor object for username"""
+        super().__init__(user, logger=logger)
+        self.semaphore = semaphore or asyncio.Semaphore(limit)
+        self.cookiefile = "cookiejars/{}.aiocookies".format(self.user)
+        self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_session(self):
+        """Create the session lazily, it has to be created within the loop"""
+        if self.session is None:
+            jar = aiohttp.CookieJar()
+            with contextlib.suppress(FileNotFoundError):
+                jar.load(self.cookiefile)
+            self.session = aiohttp.ClientSession(
+                headers={"User-Agent": "Mozilla/5.0"}, cookie_jar=jar
+            )
+        return self.session
+
+    def _save_cookies(self):
+        """Save cookies"""
+        os.makedirs("cookiejars", exist_ok=True)
+        self.session.cookie_jar.save(self.cookiefile)
+
+    async def close(self):
+        """Save the cookies and close the underlying connections"""
+        if self.session is not None:
+            self._save_cookies()
+            await self.session.close()
+            self.session = None
+
+    async def _request(self, method, url, **kwargs):
+        """Perform a request and read the whole body"""
+        self.logger.info("%s: %s", method.lower(), url)
+        async with self.semaphore:
+            async with self._get_session().request(method, url, **kwargs) as r:
+                result = Response(r.status, r.headers, await r.read())
+        self.logger.info("result: %d", result.status_code)
+        return result
+
+    async def _do_post(self, url, **kwargs):
+        """Post request for session"""
+        if "data" in kwargs:
+            self.logger.info("data: %s", json.dumps(kwargs["data"]))
+        return await self._request("POST", url, **kwargs)
+
+    async def _do_get(self, url, **kwargs):
+        """get request for session"""
+        result = await self._request("GET", url, **kwargs)
+        if result.status_code != 200:
+            raise Exception("Got response with code {}".format(result.status_code))
+        return result
+
+    async def _do_post_json(self, url, **kwargs):
+        result = await self._do_post(url, **kwargs)
+        try:
+            return result.json()
+        except json.JSONDecodeError:
+            self.logger.exception("JSON coudl not be decoded")
+            self.logger.info("status code: %d", result.status_code)
+            self.logger.info("response was: %s", result.text)
+            raise
+
+    async def login(self, password):
+        """Login using the given password"""
+        if await self.logged_in(self.user):
+            return True
+        await self._do_login(password)
+        self._save_cookies()
+        return await self.logged_in(self.user)
+
+    async def logged_in(self, username):
+        """Check if user is logged in (with cookies)"""
+        r = await self._do_post(self._auth_check_url())
+        self.logger.info("%s loggedin: %s", username, r.text)
+        return r.text.lower() == "true"
+
+    async def _do_login(self, password):
+        # Get the initial oauth token
+        r = await self._do_get(self._mim_url())
+        oauth_token = parse_auth_token(r.text)
+        # This request is performed by the browser, the reason is unclear
+        login_url = self._mim_url("Authentication/Authentication/Login?ReturnUrl=%2F")
+        await self._do_get(login_url)
+
+        r = await self._do_post(
+            self._im1_url("mentor/"), data={"oauth_token": oauth_token}
+        )
+        payload = self._login_payload(r.text, password)
+        r = await self._do_post(
+            self._im1_url("mentor/"), data=payload, headers=self._login_headers()
+        )
+
+        # Read the oauth token which is the final token for the login
+        oauth_token = parse_auth_token(r.text)
+        await self._do_post(self._im1_url("mentor/"), data={"oauth_token": oauth_token})
+        await self._do_get(self._mim_url())
+
+    async def download_file(self, url, filename=None, directory=None):
+        """download a file with given name or provided filename
+
+        Returns the path relative to directory or None if the file exceeds
+        the configured maximum size."""
+        file = await self.fetch_file(url, filename=filename, directory=directory)
+        if file is None:
+            return None
+        return file.fullfilename
+
+    async def fetch_file(self, url, filename=None, directory=None):
+        """stream a file to disk and return the InfomentorFile with hash and size
+
+        An interrupted download is resumed like by the blocking connector."""
+        self.logger.info("fetching download: %s", url)
+        if directory is None:
+            self.logger.error("fetching download requires a directory")
+            raise Exception("Download Failed")
+        file = InfomentorFile(directory, filename, seed=url, store=self.store)
+        headers, offset = file.resume_headers()
+        if offset:
+            self.logger.info("resuming download at %d bytes", offset)
+        try:
+            async with self.semaphore:
+                async with self._get_session().get(
+                    self._mim_url(url), headers=headers
+                ) as r:
+                    return await self._write_download(file, r, offset)
+        except NETWORK_ERRORS:
+            # the partial download is resumed by the next attempt
+            file.suspend()
+            raise
+        except Exception:
+            file.discard()
+            raise
+        except BaseException:
+            # cancelled, kept for the next attempt as well
+            file.suspend()
+            raise
+
+    async def _write_download(self, file, r, offset):
+        """Write the body of the download response r to file"""
+        self.logger.info("result: %d", r.status)
+        if r.status not in (200, 206):
+            raise Exception("Got response with code {}".format(r.status))
+        if r.status != 206:
+            offset = 0
+        file.keep_validator(_validator(r.headers))
+        if file.filename is None:
+            file.filename = parse_filename(r.headers.get("content-disposition"))
+        size = offset + int(r.headers.get("content-length", 0))
+        if size > self.maxsize > 0:
+            self.logger.warning("%s is too large (%d bytes), skipped", r.url, size)
+            file.discard()
+            return None
+        file.begin(offset)
+        async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+            if file.write(chunk) > self.maxsize > 0:
+                self.logger.warning("%s exceeds maximum size, skipped", r.url)
+                file.discard()
+                return None
+        file.finish()
+        self.logger.info("full filename: %s", file.fullfilename)
+        return file
+
+    async def _get_list(self, ep, sort="lastPublishDate___SORT_DESC"):
+        """Fetches the list of news"""
+        self.logger.info("fetching %s", ep)
+        data = {"pageSize": -1, "sortBy": sort}
+        _json = await self._do_post_json(self._list_url(ep), data=data)
+        return _json["items"]
+
+    async def get_news_list(self):
+        return await self._get_list("News")
+
+    async def get_document_list(self):
+        return await self._get_list("Documents")
+
+    async def get_links_list(self):
+        return await self._get_list("Links")
+
+    async def get_news_article(self, news_entry):
+        """Receive all the article information, downloads run concurrently"""
+        attachments, imagefile = await asyncio.gather(
+            self._get_attachments(news_entry["attachments"]),
+            self.get_newsimage(news_entry["id"]),
+            return_exceptions=True,
+        )
+        if isinstance(attachments, Exception):
+            raise attachments
+        news = self._news_from_entry(news_entry, attachments)
+        if isinstance(imagefile, Exception):
+            self.logger.error(
+                "fetching image of news %s failed", news_entry["id"], exc_info=imagefile
+            )
+        else:
+            news.imagefile = imagefile
+        return news
+
+    async def _get_attachments(self, attachments):
+        """Download the attachments of a news or homework entry
+
+        The downloads run concurrently and all of them are waited for. Every
+        failed one is logged, then the first failure is raised."""
+        files = await asyncio.gather(
+            *[
+                self.fetch_file(attachment["url"], directory="files")
+                for attachment in attachments
+            ],
+            return_exceptions=True,
+        )
+        failed = []
+        for attachment, f in zip(attachments, files):
+            if isinstance(f, Exception):
+                self.logger.error(
+                    "downloading %s failed", attachment["url"], exc_info=f
+                )
+                failed.append(f)
+        if failed:
+            raise failed[0]
+        return [
+            self._attachment_from_file(
+                attachment_id(attachment["url"]), attachment, f
+            )
+            for attachment, f in zip(attachments, files)
+        ]
+
+    async def get_newsimage(self, id):
+        """Fetches the image to a corresponding news entry"""
+        self.logger.info("fetching article image: %s", id)
+        filename = "{}.image".format(id)
+        url = "Communication/NewsImage/GetImage?id={}".format(id)
+        return await self.download_file(url, directory="images", filename=filename)
+
+    async def get_calendar(self):
+        """Fetches a list of calendar entries"""
+        self.logger.info("fetching calendar")
+        data = self._get_calendar_dates()
+        url = self._mim_url("Calendar/Calendar/getEntries")
+        return await self._do_post_json(url, data=data)
+
+    async def get_event(self, eventid):
+        """Request the event details from the server"""
+        self.logger.info("fetching calendar entry")
+        url = self._mim_url("Calendar/Calendar/getEntry")
+        return await self._do_post_json(url, data={"id": eventid})
+
+    async def get_homework(self, offset=0):
+        """Receives a list of homework for the week"""
+        self.logger.info("fetching homework")
+        data = self._get_homework_dates(offset)
+        url = self._mim_url("Homework/homework/GetHomework")
+        return await self._do_post_json(url, data=data)
+
+    async def get_homework_list(self):
+        """Receives the homework entries of this and the next week
+
+        Unlike the blocking connector this returns the entries themselves,
+        they are passed to get_homework_info."""
+        weeks = await asyncio.gather(
+            self.get_homework(), self.get_homework(1), return_exceptions=True
+        )
+        for week in weeks:
+            if isinstance(week, Exception):
+                raise week
+        return list(self._homework_items(group for week in weeks for group in week))
+
+    async def get_homework_info(self, hw):
+        attachments = await self._get_attachments(hw["attachments"])
+        return self._homework_from_entry(hw, attachments)
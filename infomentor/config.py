@@ -4,16 +4,35 @@ import os
 _config = None
 
 _defaults = {
-    "pushover": {"apikey": ""},
+    "pushover": {"apikey": "", "reserve": "0"},
     "general": {
         "secretkey": "",
         "baseurl": "",
         "adminmail": "",
         "im1url": "https://im1.infomentor.de/Germany/Germany/Production",
-        "mimrul": "https://mein.infomentor.de",
+        "mimurl": "https://mein.infomentor.de",
+    },
+    "smtp": {
+        "server": "",
+        "username": "",
+        "password": "",
+        "poolsize": "2",
+        "maxmessages": "50",
+        "maxsize": "20971520",
     },
-    "smtp": {"server": "", "username": "", "password": ""},
     "healthchecks": {"url": ""},
+    "download": {"maxsize": "0"},
+    "storage": {"blobdir": "blobs"},
+    "cache": {"maxage": "86400"},
+    "calendar": {"discoveryttl": "168", "workers": "4"},
+    "sync": {"pagesize": "20", "fullsync": "24"},
+    "database": {
+        "url": "sqlite:///infomentor.db",
+        "poolsize": "5",
+        "busytimeout": "30",
+        "commitbatch": "50",
+    },
+    "outbox": {"maxattempts": "10", "backoff": "60", "lease": "600"},
 }
 
 
@@ -25,7 +44,8 @@ def load(cfg_file="infomentor.ini"):
     """Load the config from the file"""
     global _config
     if _config is None:
-        _config = configparser.ConfigParser(_defaults)
+        _config = configparser.ConfigParser()
+        _config.read_dict(_defaults)
         if not os.path.isfile(cfg_file):
             _set_defaults(_config)
             save(cfg_file)
@@ -10,22 +10,110 @@ import contextlib
 import logging
 import urllib.parse
 import uuid
-import glob
 import hashlib
-from infomentor import model, config
+from infomentor import model, config, filestorage, jsonstream
+
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# a download interrupted by these is resumed later, otherwise it is dropped
+NETWORK_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+def parse_auth_token(text):
+    """Reading oauth_token from response text"""
+    token_re = r'name="oauth_token" value="([^"]*)"'
+    tokens = re.findall(token_re, text)
+    if len(tokens) != 1:
+        _logger.error("OAUTH_TOKEN not found")
+        raise Exception("Invalid Count of tokens")
+    return tokens[0]
+
+
+def parse_hidden_fields(text):
+    """Extracts key/value elements from the hidden fields of a login page"""
+    hidden_re = '<input type="hidden"(.*?) />'
+    field_values = {}
+    for f in re.findall(hidden_re, text):
+        names = re.findall('name="([^"]*)"', f)
+        if len(names) != 1:
+            _logger.error("Could not parse hidden field (fieldname)")
+            continue
+        values = re.findall('value="([^"]*)"', f)
+        if len(values) != 1:
+            _logger.error("Could not parse hidden field (value)")
+            continue
+        field_values[names[0]] = values[0]
+    return field_values
+
+
+def parse_filename(cd):
+    """determine filename from content-disposition header or random uuid"""
+    if cd:
+        filename_re = r"""
+            .* # Anything
+            (?:
+                filename=(?P<native>.+) # normal filename
+                |
+                filename\*=(?P<extended>.+) # extended filename
+            ) # The filename
+            (?:$|;.*) # End or more
+        """
+        fname = re.match(filename_re, cd, flags=re.VERBOSE)
+        filename = fname.group("native")
+        if filename is not None and len(filename) != 0:
+            return filename
+        filename = fname.group("extended")
+        if filename is not None and len(filename) != 0:
+            encoding, string = filename.split("''")
+            return urllib.parse.unquote(string, encoding)
+    filename = str(uuid.uuid4())
+    _logger.warning(
+        "no filename detected in %s: using random filename %s", cd, filename
+    )
+    return filename
+
+
+def _validator(headers):
+    """The validator of a response usable with If-Range
+
+    Only a strong ETag can be used, otherwise the Last-Modified date."""
+    etag = headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def attachment_id(url):
+    """Extract the infomentor id of an attachment from its download url"""
+    return re.findall("Download/([0-9]+)?", url)[0]
 
 
 class InfomentorFile(object):
-    """Represent a file which is downloaded"""
+    """Represent a file which is downloaded
 
-    def __init__(self, directory, filename, seed=""):
+    The content is streamed into a partial file next to the target, hashed
+    on the way and moved to the target once it is complete. With a BlobStore
+    the content is kept in the store and the target links to it. The
+    validator (ETag or Last-Modified) of the response the partial file was
+    written from is kept next to it, a resume is only valid for that one."""
+
+    def __init__(self, directory, filename, seed="", store=None):
         if directory is None:
             raise Exception("directory is required")
+        self.store = store
         self.filename = filename
         self.randomid = hashlib.sha1(
             "{}{}".format(filename, seed).encode("utf-8")
         ).hexdigest()
         self.directory = directory
+        self.sha256 = None
+        self.size = None
+        self._fp = None
 
     @property
     def targetfile(self):
@@ -37,30 +125,291 @@ class InfomentorFile(object):
         """Get the files output directory"""
         return os.path.join(self.directory, self.randomid)
 
+    @property
+    def partfile(self):
+        """Get the path the download is streamed to"""
+        return os.path.join(self.directory, "{}.part".format(self.randomid))
+
     @property
     def fullfilename(self):
         if self.filename is None:
             raise Exception("no filename set")
         return os.path.join(self.randomid, self.filename)
 
+    @property
+    def validatorfile(self):
+        """Get the path the validator of the partial download is kept at"""
+        return os.path.join(self.directory, "{}.validator".format(self.randomid))
+
+    def validator(self):
+        """The validator of the partial download, None if there is none"""
+        try:
+            with open(self.validatorfile) as f:
+                return f.read() or None
+        except OSError:
+            return None
+
+    def keep_validator(self, validator):
+        """Remember the validator of the response being written"""
+        if validator is None:
+            self._drop_validator()
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.validatorfile, "w") as f:
+            f.write(validator)
+
+    def _drop_validator(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.validatorfile)
+
+    def partial_size(self):
+        """Size of an interrupted previous download, 0 if there is none"""
+        try:
+            return os.path.getsize(self.partfile)
+        except OSError:
+            return 0
+
+    def resume_headers(self):
+        """The request headers resuming the partial download, and its offset
+
+        The server sends the whole file instead if it changed since. Without
+        a validator the partial download can not be checked, it starts
+        again."""
+        offset = self.partial_size()
+        validator = self.validator()
+        if not offset or validator is None:
+            return {}, 0
+        return {"Range": "bytes={}-".format(offset), "If-Range": validator}, offset
+
+    def begin(self, offset=0):
+        """Start writing, continuing a partial download at offset if given"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._hash = hashlib.sha256()
+        self._written = 0
+        if offset:
+            with open(self.partfile, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    self._hash.update(chunk)
+                    self._written += len(chunk)
+            self._fp = open(self.partfile, "ab")
+        else:
+            self._fp = open(self.partfile, "wb")
+
+    def write(self, chunk):
+        """Write the next chunk, returns the number of bytes written so far"""
+        self._fp.write(chunk)
+        self._hash.update(chunk)
+        self._written += len(chunk)
+        return self._written
+
+    def finish(self):
+        """Move the complete download to the target file"""
+        self._fp.close()
+        self._fp = None
+        self.sha256 = self._hash.hexdigest()
+        self.size = self._written
+        os.makedirs(self.targetdir, exist_ok=True)
+        self._drop_validator()
+        if self.store is None:
+            os.replace(self.partfile, self.targetfile)
+        else:
+            self.store.add(self.partfile, self.sha256)
+            self.store.link(self.sha256, self.targetfile)
+
+    def suspend(self):
+        """Stop writing but keep the partial download for a later resume"""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def discard(self):
+        """Drop the partial download"""
+        self.suspend()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.partfile)
+        self._drop_validator()
+
+    def write_stream(self, chunks, offset=0, maxsize=0):
+        """Write all chunks, returns False if the file exceeds maxsize
+
+        If writing is interrupted the partial file is kept, it is up to the
+        caller to discard it if it can not be resumed."""
+        self.begin(offset)
+        try:
+            for chunk in chunks:
+                if self.write(chunk) > maxsize > 0:
+                    self.discard()
+                    return False
+        except BaseException:
+            self.suspend()
+            raise
+        self.finish()
+        return True
+
     def save_file(self, content):
         """Write file to the registered path"""
-        os.makedirs(self.targetdir, exist_ok=True)
-        with open(self.targetfile, "wb+") as f:
-            f.write(content)
+        self.write_stream([content])
 
 
-class Infomentor(object):
-    """Basic object for handling infomentor site login and fetching of data"""
+class InfomentorBase(object):
+    """Shared request building for the blocking and the asyncio connector"""
 
     def __init__(self, user, logger=None):
-        """Create informentor object for username"""
         self.logger = logger or logging.getLogger(__name__)
-        self._last_result = None
         self.user = user
         self.cfg = config.load()
         self.BASE_IM1 = self.cfg["general"]["im1url"]
         self.BASE_MIM = self.cfg["general"]["mimurl"]
+        self.maxsize = self.cfg.getint("download", "maxsize", fallback=0)
+        self.store = filestorage.BlobStore(self.cfg["storage"]["blobdir"])
+        self.pagesize = self.cfg.getint("sync", "pagesize")
+
+    def _login_payload(self, text, password):
+        """Build the login form data from the hidden fields of the login page"""
+        payload = parse_hidden_fields(text)
+        payload.update(
+            {
+                "login_ascx$txtNotandanafn": self.user,
+                "login_ascx$txtLykilord": password,
+                "__EVENTTARGET": "login_ascx$btnLogin",
+                "__EVENTARGUMENT": "",
+            }
+        )
+        return payload
+
+    def _login_headers(self):
+        return {
+            "Referer": self._im1_url("mentor/"),
+            "Content-Type": "application/x-www-form-urlencoded",
+        }
+
+    def _auth_check_url(self):
+        ts = math.floor(time.time())
+        auth_check_url = (
+            "authentication/authentication/" + "isauthenticated/?_={}000".format(ts)
+        )
+        return self._mim_url(auth_check_url)
+
+    def _list_url(self, ep):
+        return self._mim_url("Communication/{0}/Get{0}List".format(ep))
+
+    @staticmethod
+    def list_item_date(item):
+        """The publishing date of a list entry, used as sync watermark"""
+        return item.get("lastPublishDate") or item.get("publishedDate")
+
+    def _news_from_entry(self, article_json, attachments):
+        """Build a News object from a list entry and its stored attachments"""
+        storenewsdata = {k: article_json[k] for k in ("title", "content")}
+        storenewsdata["date"] = article_json["publishedDate"]
+        storenewsdata["news_id"] = article_json["id"]
+        storenewsdata["raw"] = json.dumps(article_json)
+        storenewsdata["attachments"] = attachments
+        return model.News(**storenewsdata)
+
+    def _homework_from_entry(self, hw, attachments):
+        """Build a Homework object from a homework entry and its attachments"""
+        storehw = {k: hw[k] for k in ("subject", "courseElement")}
+        storehw["homework_id"] = hw["id"]
+        storehw["text"] = hw["homeworkText"]
+        storehw["attachments"] = attachments
+        return model.Homework(**storehw)
+
+    def _attachment_from_file(self, att_id, attachment, file):
+        """Build an Attachment, only the link is kept if file was skipped"""
+        stored = model.Attachment(
+            attachment_id=att_id, url=attachment["url"], title=attachment["title"]
+        )
+        if file is not None:
+            stored.localpath = file.fullfilename
+            stored.sha256 = file.sha256
+            stored.size = file.size
+        return stored
+
+    def _build_url(self, path="", base=None):
+        """Builds a general infomentor (IM1) url"""
+        if base is None:
+            base = self.BASE_IM1
+        return "{}/{}".format(base, path)
+
+    def _mim_url(self, path=""):
+        """Builds a general mein.infomentor (MIM) url"""
+        return self._build_url(path, base=self.BASE_MIM)
+
+    def _im1_url(self, path=""):
+        """Builds a general infomentor (IM1) url"""
+        return self._build_url(path, base=self.BASE_IM1)
+
+    def _get_calendar_dates(self):
+        """The start and end of the current school year"""
+        utcoffset = self._get_utc_offset()
+        data = {"UTCOffset": utcoffset}
+        schoolyear = int(datetime.datetime.now().strftime("%Y"))
+        if int(datetime.datetime.now().strftime("%m")) <= 7:
+            schoolyear -= 1
+        data["start"] = "{}-08-01".format(schoolyear)
+        data["end"] = "{}-07-31".format(schoolyear + 1)
+        return data
+
+    def _homework_items(self, dategroups):
+        """Flatten the homework date groups, skipping the placeholder entries"""
+        for dategroup in dategroups:
+            for hw in dategroup["items"]:
+                if hw["id"] == 0:
+                    continue
+                yield hw
+
+    def _get_homework_dates(self, offset=0):
+        startofweek = self._get_start_of_week(offset)
+        timestamp = startofweek.strftime("%Y-%m-%dT00:00:00.000Z")
+        return {"date": timestamp, "isWeek": True}
+
+    def _get_week_dates(self, offset=0, weeks=1):
+        """Convert the current week, an offset and the timespan in weeks to start and end days"""
+        weekoffset = datetime.timedelta(days=7 * offset)
+
+        startofweek = self._get_start_of_week()
+        endofweek = startofweek + datetime.timedelta(days=5 + 7 * (weeks - 1))
+
+        startofweek += weekoffset
+        endofweek += weekoffset
+
+        utcoffset = self._get_utc_offset()
+
+        data = {
+            "UTCOffset": utcoffset,
+            "start": startofweek.strftime("%Y-%m-%d"),
+            "end": endofweek.strftime("%Y-%m-%d"),
+        }
+        return data
+
+    def _get_utc_offset(self):
+        """Calculate the UTCoffset"""
+        now = datetime.datetime.now()
+        utctime = datetime.datetime.utcnow()
+        return (now.hour - utctime.hour) * 60
+
+    def _get_start_of_week(self, offset=0):
+        """Get the start of the current + offset week"""
+        now = datetime.datetime.now()
+        dayofweek = now.weekday()
+        startofweek = now - datetime.timedelta(days=dayofweek)
+        startofweek -= datetime.timedelta(days=offset * 7)
+        return startofweek
+
+
+class Infomentor(InfomentorBase):
+    """Basic object for handling infomentor site login and fetching of data"""
+
+    def __init__(self, user, logger=None, cache=None):
+        """Create informentor object for username
+
+        With a filestorage.FetchCache, files already downloaded for another
+        user are reused instead of being downloaded again."""
+        super().__init__(user, logger=logger)
+        self.cache = cache
+        self.fingerprints = {}
+        self._last_result = None
         self._create_session()
 
     def _create_session(self):
@@ -87,12 +436,7 @@ class Infomentor(object):
 
     def logged_in(self, username):
         """Check if user is logged in (with cookies)"""
-        ts = math.floor(time.time())
-        auth_check_url = (
-            "authentication/authentication/" + "isauthenticated/?_={}000".format(ts)
-        )
-        url = self._mim_url(auth_check_url)
-        r = self._do_post(url)
+        r = self._do_post(self._auth_check_url())
         self.logger.info("%s loggedin: %s", username, r.text)
         return r.text.lower() == "true"
 
@@ -112,59 +456,18 @@ class Infomentor(object):
 
     def _get_auth_token(self):
         """Reading oauth_token from response text"""
-        token_re = r'name="oauth_token" value="([^"]*)"'
-        tokens = re.findall(token_re, self._last_result.text)
-        if len(tokens) != 1:
-            self.logger.error("OAUTH_TOKEN not found")
-            raise Exception("Invalid Count of tokens")
-        return tokens[0]
+        return parse_auth_token(self._last_result.text)
 
     def _perform_login(self, password):
         self._do_post(self._im1_url("mentor/"), data={"oauth_token": self._oauth_token})
-        # Extract the hidden fields content
-        payload = self._get_hidden_fields()
-        # update with the missing and the login parameters
-        payload.update(
-            {
-                "login_ascx$txtNotandanafn": self.user,
-                "login_ascx$txtLykilord": password,
-                "__EVENTTARGET": "login_ascx$btnLogin",
-                "__EVENTARGUMENT": "",
-            }
-        )
+        # Extract the hidden fields content and add the login parameters
+        payload = self._login_payload(self._last_result.text, password)
 
         # perform the login
         self._do_post(
-            self._im1_url("mentor/"),
-            data=payload,
-            headers={
-                "Referer": self._im1_url("mentor/"),
-                "Content-Type": "application/x-www-form-urlencoded",
-            },
+            self._im1_url("mentor/"), data=payload, headers=self._login_headers()
         )
 
-    def _get_hidden_fields(self):
-        """Extracts key/value elements from hidden fields"""
-        hiddenfields = self._extract_hidden_fields()
-        field_values = {}
-        for f in hiddenfields:
-            names = re.findall('name="([^"]*)"', f)
-            if len(names) != 1:
-                self.logger.error("Could not parse hidden field (fieldname)")
-                continue
-            values = re.findall('value="([^"]*)"', f)
-            if len(values) != 1:
-                self.logger.error("Could not parse hidden field (value)")
-                continue
-            field_values[names[0]] = values[0]
-        return field_values
-
-    def _extract_hidden_fields(self):
-        """Extracts all the hidden fields from a infomentor login page"""
-        hidden_re = '<input type="hidden"(.*?) />'
-        hiddenfields = re.findall(hidden_re, self._last_result.text)
-        return hiddenfields
-
     def _finalize_login(self):
         """The final login step to get the cookie"""
         # Read the oauth token which is the final token for the login
@@ -188,7 +491,9 @@ class Infomentor(object):
         self._last_result = self.session.get(url, **kwargs)
         self.logger.info("result: %d", self._last_result.status_code)
         self._save_cookies()
-        if self._last_result.status_code != 200:
+        if self._last_result.status_code not in (200, 206):
+            # a streamed response would keep its connection otherwise
+            self._last_result.close()
             raise Exception(
                 "Got response with code {}".format(self._last_result.status_code)
             )
@@ -199,7 +504,17 @@ class Infomentor(object):
         self.session.cookies.save(ignore_discard=True, ignore_expires=True)
 
     def download_file(self, url, filename=None, directory=None):
-        """download a file with given name or provided filename"""
+        """download a file with given name or provided filename
+
+        Returns the path relative to directory or None if the file exceeds
+        the configured maximum size."""
+        file = self.fetch_file(url, filename=filename, directory=directory)
+        if file is None:
+            return None
+        return file.fullfilename
+
+    def fetch_file(self, url, filename=None, directory=None):
+        """download a file and return the InfomentorFile with hash and size"""
         self.logger.info("fetching download: %s", url)
         if filename is not None or directory is not None:
             return self._download_file(url, directory, filename)
@@ -209,97 +524,147 @@ class Infomentor(object):
 
     def _get_filename_from_cd(self):
         """determine filename from headers or random uuid"""
-        cd = self._last_result.headers.get("content-disposition")
-        if cd:
-            filename_re = r"""
-                .* # Anything
-                (?:
-                    filename=(?P<native>.+) # normal filename
-                    |
-                    filename\*=(?P<extended>.+) # extended filename
-                ) # The filename
-                (?:$|;.*) # End or more
-            """
-            fname = re.match(filename_re, cd, flags=re.VERBOSE)
-            filename = fname.group("native")
-            if filename is not None and len(filename) != 0:
-                return filename
-            filename = fname.group("extended")
-            if filename is not None and len(filename) != 0:
-                encoding, string = filename.split("''")
-                return urllib.parse.unquote(string, encoding)
-        filename = str(uuid.uuid4())
-        self.logger.warning(
-            "no filename detected in %s: using random filename %s", cd, filename
-        )
-        return filename
+        return parse_filename(self._last_result.headers.get("content-disposition"))
+
+    def _fetch_cached(self, key, url, directory, filename=None):
+        """fetch a file, reusing the download of another user if cached"""
+        if self.cache is None:
+            return self.fetch_file(url, filename=filename, directory=directory)
+        with self.cache.lock(key):
+            cached = self.cache.lookup(key)
+            if cached is not None:
+                self.logger.info("using cached download %s", key)
+                file = InfomentorFile(directory, filename, seed=url, store=self.store)
+                file.filename = cached.filename
+                os.makedirs(file.targetdir, exist_ok=True)
+                self.store.link(cached.sha256, file.targetfile)
+                file.sha256 = cached.sha256
+                file.size = cached.size
+                return file
+            file = self.fetch_file(url, filename=filename, directory=directory)
+            if file is not None:
+                self.cache.store_file(key, file.filename, file.sha256, file.size)
+            return file
 
     def _download_file(self, url, directory, filename=None):
-        """download a file with  provided filename"""
-        file = InfomentorFile(directory, filename, seed=url)
+        """stream a file with provided filename, resuming a partial download"""
+        file = InfomentorFile(directory, filename, seed=url, store=self.store)
         self.logger.info("to (randomized) directory %s", file.targetdir)
         url = self._mim_url(url)
-        self._do_get(url)
-        if filename is None:
-            self.logger.info("determine filename from headers")
-            filename = self._get_filename_from_cd()
-            self.logger.info("determined filename: %s", filename)
-        file.filename = filename
-        self.logger.info("full filename: %s", file.fullfilename)
-        file.save_file(self._last_result.content)
-        return file.fullfilename
+        headers, offset = file.resume_headers()
+        if offset:
+            self.logger.info("resuming download at %d bytes", offset)
+        try:
+            return self._write_download(file, url, headers, offset)
+        except NETWORK_ERRORS:
+            # the partial download is resumed by the next attempt
+            file.suspend()
+            raise
+        except Exception:
+            file.discard()
+            raise
 
-    def _build_url(self, path="", base=None):
-        """Builds a general infomentor (IM1) url"""
-        if base is None:
-            base = self.BASE_IM1
-        return "{}/{}".format(base, path)
+    def _write_download(self, file, url, headers, offset):
+        """Request url and write the body of the response to file"""
+        r = self._do_get(url, headers=headers, stream=True)
+        with contextlib.closing(r):
+            if r.status_code != 206:
+                offset = 0
+            file.keep_validator(_validator(r.headers))
+            if file.filename is None:
+                self.logger.info("determine filename from headers")
+                file.filename = self._get_filename_from_cd()
+                self.logger.info("determined filename: %s", file.filename)
+            size = offset + int(r.headers.get("content-length", 0))
+            if size > self.maxsize > 0:
+                self.logger.warning("%s is too large (%d bytes), skipped", url, size)
+                file.discard()
+                return None
+            chunks = r.iter_content(chunk_size=CHUNK_SIZE)
+            if not file.write_stream(chunks, offset, self.maxsize):
+                self.logger.warning("%s exceeds maximum size, skipped", url)
+                return None
+        self.logger.info("full filename: %s", file.fullfilename)
+        return file
 
-    def _mim_url(self, path=""):
-        """Builds a general mein.infomentor (MIM) url"""
-        return self._build_url(path, base=self.BASE_MIM)
+    def _get_list(self, ep, sort="lastPublishDate___SORT_DESC", since=None):
+        """Fetches a list, with since only the entries published since then
 
-    def _im1_url(self, path=""):
-        """Builds a general infomentor (IM1) url"""
-        return self._build_url(path, base=self.BASE_IM1)
-
-    def _get_list(self, ep, sort="lastPublishDate___SORT_DESC"):
-        """Fetches the list of news"""
+        Without since the complete list is fetched at once and its entries
+        are yielded while the response is parsed. Otherwise it is paged
+        through, newest first, until an entry older than since shows up. The
+        first page is fetched right away and its fingerprint remembered."""
         self.logger.info("fetching %s", ep)
-        self._do_post(self._mim_url("Communication/{0}/Get{0}List".format(ep)), data={"pageSize":-1,"sortBy":"lastPublishDate___SORT_DESC"})
-        _json = self.get_json_return()
-        return _json["items"]
+        if since is None:
+            data = {"pageSize": -1, "sortBy": sort}
+            return self._iter_json_items(self._list_url(ep), data)
+        items = self._get_list_page(ep, sort, 1)
+        self._remember_fingerprint(ep, self._last_result.content)
+        return self._get_list_since(ep, sort, since, items)
+
+    def _get_list_page(self, ep, sort, page):
+        data = {"pageSize": self.pagesize, "page": page, "sortBy": sort}
+        self._do_post(self._list_url(ep), data=data)
+        return self.get_json_return()["items"]
+
+    def _get_list_since(self, ep, sort, since, items):
+        page = 1
+        while True:
+            for item in items:
+                date = self.list_item_date(item)
+                if date is not None and date < since:
+                    self.logger.info("reached watermark %s on page %d", since, page)
+                    return
+                yield item
+            if len(items) < self.pagesize:
+                return
+            page += 1
+            items = self._get_list_page(ep, sort, page)
+
+    def _remember_fingerprint(self, endpoint, *contents):
+        """Store the hash of the raw responses of an endpoint"""
+        fingerprint = hashlib.sha256()
+        for content in contents:
+            fingerprint.update(content)
+        self.fingerprints[endpoint] = fingerprint.hexdigest()
+
+    def _iter_json_items(self, url, data):
+        """Post and yield the entries of the items list while it is received"""
+        r = self._do_post(url, data=data, stream=True)
+        with contextlib.closing(r):
+            try:
+                chunks = r.iter_content(chunk_size=CHUNK_SIZE)
+                yield from jsonstream.iter_items(chunks)
+            except json.JSONDecodeError as jse:
+                self.logger.exception("JSON coudl not be decoded")
+                self.logger.info("status code: %d", r.status_code)
+                raise
 
-    def get_news_list(self):
-        return self._get_list('News')
+    def get_news_list(self, since=None):
+        return self._get_list("News", since=since)
 
     def get_news_article(self, news_entry):
         """Receive all the article information"""
-        article_json = news_entry
-        storenewsdata = {k: article_json[k] for k in ("title", "content")}
-        storenewsdata["date"] = article_json["publishedDate"]
-        storenewsdata["news_id"] = article_json["id"]
-        storenewsdata["raw"] = json.dumps(article_json)
-        storenewsdata["attachments"] = []
-        for attachment in article_json["attachments"]:
+        attachments = self._get_attachments(news_entry["attachments"])
+        news = self._news_from_entry(news_entry, attachments)
+        with contextlib.suppress(Exception):
+            news.imagefile = self.get_newsimage(news_entry["id"])
+        return news
+
+    def _get_attachments(self, attachments):
+        """Download the attachments of a news or homework entry"""
+        stored = []
+        for attachment in attachments:
             self.logger.info("found attachment %s", attachment["title"])
-            att_id = re.findall("Download/([0-9]+)?", attachment["url"])[0]
-            f = self.download_file(attachment["url"], directory="files")
+            att_id = attachment_id(attachment["url"])
+            f = self._fetch_cached(
+                "attachment:{}".format(att_id), attachment["url"], directory="files"
+            )
             try:
-                storenewsdata["attachments"].append(
-                    model.Attachment(
-                        attachment_id=att_id,
-                        url=attachment["url"],
-                        localpath=f,
-                        title=attachment["title"],
-                    )
-                )
+                stored.append(self._attachment_from_file(att_id, attachment, f))
             except Exception as e:
                 self.logger.exception("failed to store attachment")
-        news = model.News(**storenewsdata)
-        with contextlib.suppress(Exception):
-            news.imagefile = self.get_newsimage(article_json["id"])
-        return news
+        return stored
 
     def get_article(self, id):
         """Receive the article details"""
@@ -312,25 +677,25 @@ class Infomentor(object):
         self.logger.info("fetching article image: %s", id)
         filename = "{}.image".format(id)
         url = "Communication/NewsImage/GetImage?id={}".format(id)
-        return self.download_file(url, directory="images", filename=filename)
+        file = self._fetch_cached(
+            "newsimage:{}".format(id), url, directory="images", filename=filename
+        )
+        if file is None:
+            return None
+        return file.fullfilename
 
-    def get_document_list(self):
-        return self._get_list('Documents')
+    def get_document_list(self, since=None):
+        return self._get_list("Documents", since=since)
 
-    def get_links_list(self):
-        return self._get_list('Links')
+    def get_links_list(self, since=None):
+        return self._get_list("Links", since=since)
 
     def get_calendar(self, offset=0, weeks=1):
         """Fetches a list of calendar entries"""
         self.logger.info("fetching calendar")
-        utcoffset = self._get_utc_offset()
-        data = {"UTCOffset": utcoffset}
-        schoolyear = int(datetime.datetime.now().strftime("%Y"))
-        if int(datetime.datetime.now().strftime("%m")) <= 7:
-            schoolyear -= 1
-        data["start"] = "{}-08-01".format(schoolyear)
-        data["end"] = "{}-07-31".format(schoolyear + 1)
+        data = self._get_calendar_dates()
         self._do_post(self._mim_url("Calendar/Calendar/getEntries"), data=data)
+        self._remember_fingerprint("Calendar", self._last_result.content)
         return self.get_json_return()
 
     def get_event(self, eventid):
@@ -340,12 +705,18 @@ class Infomentor(object):
         self._do_post(self._mim_url("Calendar/Calendar/getEntry"), data=data)
         return self.get_json_return()
 
+    def get_event_resources(self, resources):
+        """Download the resources of a calendar event as attachments"""
+        stored = []
+        for resource in resources:
+            f = self.fetch_file(resource["url"], directory="files")
+            stored.append(self._attachment_from_file(None, resource, f))
+        return stored
+
     def get_homework(self, offset=0):
         """Receives a list of homework for the week"""
         self.logger.info("fetching homework")
-        startofweek = self._get_start_of_week(offset)
-        timestamp = startofweek.strftime("%Y-%m-%dT00:00:00.000Z")
-        data = {"date": timestamp, "isWeek": True}
+        data = self._get_homework_dates(offset)
         self._do_post(self._mim_url("Homework/homework/GetHomework"), data=data)
         return self.get_json_return()
 
@@ -355,39 +726,18 @@ class Infomentor(object):
         homeworklist = []
         homework = []
         homework.extend(self.get_homework())
+        thisweek = self._last_result.content
         homework.extend(self.get_homework(1))
-        for dategroup in homework:
-            for hw in dategroup["items"]:
-                if hw["id"] == 0:
-                    continue
-                else:
-                    self._homework[hw["id"]] = hw
-                    homeworklist.append(hw["id"])
+        self._remember_fingerprint("Homework", thisweek, self._last_result.content)
+        for hw in self._homework_items(homework):
+            self._homework[hw["id"]] = hw
+            homeworklist.append(hw["id"])
         return homeworklist
 
     def get_homework_info(self, id):
         hw = self._homework[id]
-        storehw = {k: hw[k] for k in ("subject", "courseElement")}
-        storehw["homework_id"] = hw["id"]
-        storehw["text"] = hw["homeworkText"]
-        storehw["attachments"] = []
-        for attachment in hw["attachments"]:
-            self.logger.info("found attachment %s", attachment["title"])
-            att_id = re.findall("Download/([0-9]+)?", attachment["url"])[0]
-            f = self.download_file(attachment["url"], directory="files")
-            try:
-                storehw["attachments"].append(
-                    model.Attachment(
-                        attachment_id=att_id,
-                        url=attachment["url"],
-                        localpath=f,
-                        title=attachment["title"],
-                    )
-                )
-            except Exception as e:
-                self.logger.exception("failed to store attachment")
-        hw = model.Homework(**storehw)
-        return hw
+        attachments = self._get_attachments(hw["attachments"])
+        return self._homework_from_entry(hw, attachments)
 
     def get_timetable(self, offset=0):
         self.logger.info("fetching timetable")
@@ -404,36 +754,3 @@ class Infomentor(object):
             self.logger.info("status code: %d", self._last_result.status_code)
             self.logger.info("response was: %s", self._last_result.text)
             raise
-
-    def _get_week_dates(self, offset=0, weeks=1):
-        """Convert the current week, an offset and the timespan in weeks to start and end days"""
-        weekoffset = datetime.timedelta(days=7 * offset)
-
-        startofweek = self._get_start_of_week()
-        endofweek = startofweek + datetime.timedelta(days=5 + 7 * (weeks - 1))
-
-        startofweek += weekoffset
-        endofweek += weekoffset
-
-        utcoffset = self._get_utc_offset()
-
-        data = {
-            "UTCOffset": utcoffset,
-            "start": startofweek.strftime("%Y-%m-%d"),
-            "end": endofweek.strftime("%Y-%m-%d"),
-        }
-        return data
-
-    def _get_utc_offset(self):
-        """Calculate the UTCoffset"""
-        now = datetime.datetime.now()
-        utctime = datetime.datetime.utcnow()
-        return (now.hour - utctime.hour) * 60
-
-    def _get_start_of_week(self, offset=0):
-        """Get the start of the current + offset week"""
-        now = datetime.datetime.now()
-        dayofweek = now.weekday()
-        startofweek = now - datetime.timedelta(days=dayofweek)
-        startofweek -= datetime.timedelta(days=offset * 7)
-        return startofweek
@@ -0,0 +1,92 @@
+import datetime
+import functools
+import re
+
+_iso = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})"
+    r"(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?)?"
+    r"\s*(Z|[+-]\d{2}:?\d{2})?$"
+)
+
+
+def _timezone(designator):
+    if designator is None:
+        return None
+    if designator == "Z":
+        return datetime.timezone.utc
+    sign = -1 if designator[0] == "-" else 1
+    digits = designator[1:].replace(":", "")
+    offset = datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:]))
+    return datetime.timezone(sign * offset)
+
+
+def parse_iso(text):
+    """Parse an ISO 8601 timestamp as sent by infomentor, None if it is none"""
+    match = _iso.match(text.strip())
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, tz = match.groups()
+    return datetime.datetime(
+        int(year),
+        int(month),
+        int(day),
+        int(hour or 0),
+        int(minute or 0),
+        int(second or 0),
+        int((fraction or "0").ljust(6, "0")),
+        tzinfo=_timezone(tz),
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def parse(text):
+    """Parse a date string, returns None if it can not be parsed
+
+    The timestamps of infomentor are ISO 8601, those are parsed directly.
+    Everything else is handed to dateparser, which is only imported then."""
+    if not text:
+        return None
+    try:
+        parsed = parse_iso(text)
+    except ValueError:
+        parsed = None
+    if parsed is not None:
+        return parsed
+    import dateparser
+
+    return dateparser.parse(text)
+
+
+if __name__ == "__main__":
+    import timeit
+
+    # the start and end dates of a calendar of one school year
+    start = datetime.datetime(2019, 8, 1, 8)
+    payload = []
+    for day in range(300):
+        for lesson in range(2):
+            begin = start + datetime.timedelta(days=day, hours=2 * lesson)
+            end = begin + datetime.timedelta(minutes=90)
+            payload.append(begin.strftime("%Y-%m-%dT%H:%M:%S"))
+            payload.append(end.strftime("%Y-%m-%dT%H:%M:%S"))
+
+    def run(function):
+        for text in payload:
+            function(text)
+
+    def run_uncached():
+        parse.cache_clear()
+        run(parse)
+
+    def report(name, function):
+        print("{:<24} {:.4f}s".format(name, timeit.timeit(function, number=1)))
+
+    print("{} timestamps".format(len(payload)))
+    report("dates.parse (uncached)", run_uncached)
+    report("dates.parse (cached)", lambda: run(parse))
+    try:
+        import dateparser
+    except ImportError:
+        print("dateparser not installed, skipping comparison")
+    else:
+        report("dateparser.parse", lambda: run(dateparser.parse))
@@ -1,17 +1,318 @@
-from infomentor import model
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
-_session = None
-
-
-def get_db(filename="infomentor.db"):
-    """Get the database session for infomentor"""
-    global _session
-    if _session is None:
-        engine = create_engine(f"sqlite:///{filename}")
-        model.ModelBase.metadata.create_all(engine)
-        model.ModelBase.metadata.bind = engine
-        DBSession = sessionmaker(bind=engine)
-        _session = DBSession()
-    return _session
+import hashlib
+from infomentor import model, config
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+_engine = None
+_sessionmaker = None
+_readsessionmaker = None
+_scoped_session = None
+_scoped_readsession = None
+
+# stored in PRAGMA user_version, increase it whenever the model changes and
+# add the step migrating existing databases to MIGRATIONS
+SCHEMA_VERSION = 22
+
+
+def _database_url(filename):
+    if filename is not None:
+        return f"sqlite:///{filename}"
+    return config.load()["database"]["url"]
+
+
+def get_engine(filename=None):
+    """Get the database engine for infomentor, creating the schema if needed
+
+    The database is [database] url of the config, or the sqlite database
+    filename if given."""
+    global _engine, _sessionmaker, _readsessionmaker
+    global _scoped_session, _scoped_readsession
+    if _engine is None:
+        cfg = config.load()
+        url = _database_url(filename)
+        busytimeout = cfg.getint("database", "busytimeout")
+        if url.startswith("sqlite"):
+            _engine = create_engine(
+                url,
+                connect_args={"timeout": busytimeout, "check_same_thread": False},
+            )
+            _tune_sqlite(_engine, busytimeout)
+            _enable_savepoints(_engine)
+        else:
+            _engine = create_engine(
+                url,
+                pool_size=cfg.getint("database", "poolsize"),
+                pool_pre_ping=True,
+                pool_recycle=3600,
+            )
+        _ensure_schema(_engine)
+        model.ModelBase.metadata.bind = _engine
+        # the objects stay usable after a commit, so a session can end its
+        # transaction before a request to infomentor without reloading them
+        _sessionmaker = sessionmaker(
+            bind=_engine.execution_options(sqlite_begin="IMMEDIATE"),
+            expire_on_commit=False,
+        )
+        _readsessionmaker = sessionmaker(bind=_engine)
+        _scoped_session = scoped_session(_sessionmaker)
+        _scoped_readsession = scoped_session(_readsessionmaker)
+    return _engine
+
+
+def _ensure_schema(engine):
+    """Create or migrate the schema, unless the database is current already
+
+    A new database gets the schema of the model, an existing one the
+    migrations newer than its version. All of it is one transaction.
+    Other databases than sqlite only get the missing tables created."""
+    with engine.begin() as conn:
+        if engine.dialect.name != "sqlite":
+            model.ModelBase.metadata.create_all(conn)
+            return
+        version = conn.execute("PRAGMA user_version").scalar()
+        if version == SCHEMA_VERSION:
+            return
+        if not engine.dialect.has_table(conn, model.User.__tablename__):
+            model.ModelBase.metadata.create_all(conn)
+            conn.execute("PRAGMA user_version = {:d}".format(SCHEMA_VERSION))
+            return
+        for target, migration in MIGRATIONS:
+            if version < target:
+                migration(conn)
+        conn.execute("PRAGMA user_version = {:d}".format(SCHEMA_VERSION))
+
+
+def _columns(conn, table):
+    """The columns of an existing table and their declared types"""
+    return {
+        row[1]: row[2] for row in conn.execute("PRAGMA table_info({})".format(table))
+    }
+
+
+def _add_columns(tablename, *names):
+    """A migration adding the named columns of the model to an existing table"""
+
+    def migration(conn):
+        table = model.ModelBase.metadata.tables[tablename]
+        existing = _columns(conn, tablename)
+        for name in names:
+            if name in existing:
+                continue
+            column = table.columns[name]
+            coltype = column.type.compile(dialect=conn.dialect)
+            conn.execute(
+                "ALTER TABLE {} ADD COLUMN {} {}".format(tablename, name, coltype)
+            )
+            if column.unique:
+                # sqlite can not add a column with a unique constraint
+                conn.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS uq_{0}_{1} ON {0} ({1})".format(
+                        tablename, name
+                    )
+                )
+
+    return migration
+
+
+def _create_tables(*tablenames):
+    """A migration creating new tables of the model"""
+
+    def migration(conn):
+        for tablename in tablenames:
+            model.ModelBase.metadata.tables[tablename].create(conn, checkfirst=True)
+
+    return migration
+
+
+def _rebuild_table(conn, table):
+    """Recreate a table as declared in the model, keeping its rows"""
+    existing = _columns(conn, table.name)
+    columns = ", ".join(c.name for c in table.columns if c.name in existing)
+    for index in table.indexes:
+        # the indexes keep their names on the renamed table
+        conn.execute("DROP INDEX IF EXISTS {}".format(index.name))
+    conn.execute("ALTER TABLE {0} RENAME TO {0}_old".format(table.name))
+    table.create(conn)
+    conn.execute(
+        "INSERT INTO {0} ({1}) SELECT {1} FROM {0}_old".format(table.name, columns)
+    )
+    conn.execute("DROP TABLE {}_old".format(table.name))
+
+
+def _retype_calendar_id(conn):
+    """calendar_id holds uuids, but was declared as integer"""
+    table = model.CalendarEntry.__table__
+    if _columns(conn, table.name)["calendar_id"].upper() == "INTEGER":
+        _rebuild_table(conn, table)
+
+
+def _drop_outbox_key_unique(conn):
+    """A sent notification may be queued again, the key is not unique"""
+    table = model.OutboxMessage.__table__
+    unique = [
+        row
+        for row in conn.execute("PRAGMA index_list({})".format(table.name))
+        if row[2]
+    ]
+    if unique:
+        _rebuild_table(conn, table)
+
+
+def _rehash_calendar_entries(conn):
+    """The content hash of calendar entries was taken of an empty calendar
+
+    It is taken again of the stored event without its DTSTAMP, as a run
+    does, so unchanged entries are not notified again. Entries stored with
+    a fingerprint have the right hash already."""
+    from icalendar import Calendar
+
+    query = "SELECT id, ical FROM calendarentries WHERE ical IS NOT NULL"
+    if "fingerprint" in _columns(conn, "calendarentries"):
+        query += " AND fingerprint IS NULL"
+    rows = conn.execute(query).fetchall()
+    for entry_id, ical in rows:
+        try:
+            calend = Calendar.from_ical(ical)
+        except ValueError:
+            continue
+        for vevent in calend.walk("VEVENT"):
+            vevent.pop("DTSTAMP", None)
+        entryhash = hashlib.sha1(calend.to_ical().replace(b"\r", b"")).hexdigest()
+        conn.execute(
+            text("UPDATE calendarentries SET hash = :hash WHERE id = :id"),
+            hash=entryhash,
+            id=entry_id,
+        )
+
+
+def _create_indexes(conn):
+    """Create the indexes of the model missing on existing tables
+
+    Indexes of columns added by a later step are left to that step."""
+    for table in model.ModelBase.metadata.sorted_tables:
+        existing = {
+            row[1] for row in conn.execute("PRAGMA index_list({})".format(table.name))
+        }
+        columns = _columns(conn, table.name)
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if all(column.name in columns for column in index.columns):
+                index.create(conn)
+
+
+# (schema version, migration) in the order they are applied, every change of
+# the model adds a step. The steps check the existing schema, so they are
+# safe to repeat: versions up to 6 were set without migrating the tables, all
+# steps are applied to those databases.
+MIGRATIONS = [
+    # content hash and size of downloaded attachments
+    (7, _add_columns("attachments", "sha256", "size")),
+    # deduplicated storage of the downloads
+    (8, _create_tables("blobs")),
+    # downloads shared between users
+    (9, _create_tables("cached_files")),
+    # list level fingerprint of calendar entries
+    (10, _add_columns("calendarentries", "fingerprint")),
+    # incremental news sync
+    (11, _create_tables("sync_state")),
+    # fingerprint of the last list response of an endpoint
+    (12, _add_columns("sync_state", "fingerprint")),
+    # notification outbox
+    (13, _create_tables("outbox")),
+    # digest notifications
+    (14, _add_columns("notifications", "digest", "digestwindow")),
+    # cached caldav discovery
+    (
+        15,
+        _add_columns(
+            "icloud_calendar",
+            "principal_path",
+            "home_set_url",
+            "calendar_url",
+            "discovered_at",
+        ),
+    ),
+    # conditional calendar uploads
+    (16, _add_columns("calendarentries", "href", "etag", "synced_hash")),
+    # batched invitation mails
+    (17, _add_columns("invitation_mails", "batch")),
+    # ics feed of the calendar entries
+    (18, _add_columns("users", "feed_token")),
+    (18, _create_tables("calendar_feeds")),
+    # indexes of the lookup columns
+    (19, _retype_calendar_id),
+    (19, _create_indexes),
+    # notifications queued again after a change back
+    (20, _drop_outbox_key_unique),
+    # resources of calendar entries stored as attachments
+    (21, _add_columns("attachments", "calendarentry_id")),
+    (21, _create_indexes),
+    # content hash of the calendar entries stored before it was fixed
+    (22, _rehash_calendar_entries),
+]
+
+def _tune_sqlite(engine, busytimeout):
+    """Let readers and a writer work at the same time
+
+    With the write-ahead log the web app can read while a run writes, and
+    a second writer waits up to busytimeout seconds instead of failing."""
+
+    @event.listens_for(engine, "connect")
+    def do_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode a commit is durable without a sync of the database file
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-16000")
+        cursor.execute("PRAGMA busy_timeout={:d}".format(busytimeout * 1000))
+        cursor.close()
+
+
+def _enable_savepoints(engine):
+    """Let SQLAlchemy emit BEGIN itself, pysqlite breaks SAVEPOINT otherwise
+
+    Transactions of sessions which write begin with BEGIN IMMEDIATE. A
+    deferred transaction which read first fails at once when it tries to
+    write after another connection wrote, without waiting busytimeout."""
+
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        mode = conn.get_execution_options().get("sqlite_begin")
+        conn.execute("BEGIN {}".format(mode) if mode else "BEGIN")
+
+
+def new_session(filename=None, readonly=False):
+    """Create a new, independent database session (e.g. for a worker thread)
+
+    Every transaction of the session holds the write lock of sqlite, so
+    commit before waiting on anything else. A readonly session does not
+    take the lock."""
+    get_engine(filename)
+    if readonly:
+        return _readsessionmaker()
+    return _sessionmaker()
+
+
+def get_db(filename=None, readonly=False):
+    """Get the database session of the current thread
+
+    Every thread gets its own session, the same one on every call until
+    remove_session is called. Like with new_session only a readonly session
+    does not hold the write lock, use it wherever nothing is written (e.g.
+    the pages of the web app)."""
+    get_engine(filename)
+    if readonly:
+        return _scoped_readsession()
+    return _scoped_session()
+
+
+def remove_session():
+    """Close the sessions of the current thread, e.g. at the end of a request"""
+    if _scoped_session is not None:
+        _scoped_session.remove()
+        _scoped_readsession.remove()
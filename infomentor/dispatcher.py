@@ -0,0 +1,243 @@
+import concurrent.futures
+import datetime
+import logging
+from sqlalchemy.orm import joinedload, selectinload
+from infomentor import model, connector, informer, config, pushclient
+
+
+class Dispatcher(object):
+    """Delivers the notifications queued in the outbox
+
+    Scraping only writes to the outbox, this drains it. A failed delivery is
+    retried with exponential backoff until maxattempts is reached. Messages
+    are claimed in a committed transaction before they are delivered, no
+    transaction is open during the delivery, and they are marked as sent in
+    a short one right after it. So each one goes out once even if the
+    dispatcher runs again. The messages of different users are
+    delivered concurrently, each user's in order. For users with digest
+    notification news and homework are sent together as one message. The
+    calendar entries of a user are uploaded as one batch."""
+
+    itemtypes = {
+        model.OutboxMessage.Kinds.NEWS: model.News,
+        model.OutboxMessage.Kinds.HOMEWORK: model.Homework,
+        model.OutboxMessage.Kinds.CALENDAR: model.CalendarEntry,
+    }
+    digestkinds = (model.OutboxMessage.Kinds.NEWS, model.OutboxMessage.Kinds.HOMEWORK)
+    calendarkind = model.OutboxMessage.Kinds.CALENDAR
+
+    def __init__(self, new_session, logger=None, workers=1):
+        self.logger = logger or logging.getLogger(__name__)
+        self.new_session = new_session
+        self.workers = workers
+        cfg = config.load()
+        self.maxattempts = cfg.getint("outbox", "maxattempts")
+        self.backoff = cfg.getint("outbox", "backoff")
+        self.lease = datetime.timedelta(seconds=cfg.getint("outbox", "lease"))
+
+    def _pending(self, session):
+        now = datetime.datetime.now()
+        return (
+            session.query(model.OutboxMessage)
+            .filter(model.OutboxMessage.sent == None)
+            .filter(model.OutboxMessage.next_attempt <= now)
+            .filter(model.OutboxMessage.attempts < self.maxattempts)
+            .order_by(model.OutboxMessage.id)
+        )
+
+    def run(self):
+        """Deliver all due messages, returns the number of delivered ones"""
+        session = self.new_session(readonly=True)
+        try:
+            user_ids = [
+                user_id
+                for user_id, in self._pending(session)
+                .with_entities(model.OutboxMessage.user_id)
+                # ordered by id every user would be listed once per message
+                .order_by(None)
+                .distinct()
+            ]
+        finally:
+            session.close()
+        if self.workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                return sum(pool.map(self.run_user, user_ids))
+        return sum(map(self.run_user, user_ids))
+
+    def run_user(self, user_id):
+        """Deliver the due messages of one user in its own session"""
+        session = self.new_session()
+        delivered = 0
+        try:
+            messages = (
+                self._pending(session)
+                .filter(model.OutboxMessage.user_id == user_id)
+                .all()
+            )
+            if not messages:
+                return 0
+            # with the relations used while no transaction is open
+            user = (
+                session.query(model.User)
+                .options(
+                    joinedload(model.User.notification),
+                    joinedload(model.User.icalendar),
+                    joinedload(model.User.invitation),
+                )
+                .filter(model.User.id == user_id)
+                .one()
+            )
+            im = connector.InfomentorBase(user.name, logger=self.logger)
+            # delivering needs no infomentor session, only its url building
+            inf = informer.Informer(user, im, logger=self.logger, session=session)
+            notification = user.notification
+            if notification is not None and notification.digest:
+                digest = [m for m in messages if m.kind in self.digestkinds]
+                messages = [m for m in messages if m.kind not in self.digestkinds]
+                if digest and self._digest_due(notification, digest):
+                    delivered += self.deliver_digest(session, inf, digest)
+            calendar = [m for m in messages if m.kind == self.calendarkind]
+            messages = [m for m in messages if m.kind != self.calendarkind]
+            if calendar:
+                delivered += self.deliver_calendar(session, inf, calendar)
+            for message in messages:
+                if self.deliver(session, inf, message):
+                    delivered += 1
+        except Exception:
+            self.logger.exception("dispatching for user %s failed", user_id)
+        finally:
+            session.close()
+        return delivered
+
+    def _digest_due(self, notification, messages):
+        """Check if the window of the digest started by the oldest message is over"""
+        window = datetime.timedelta(minutes=notification.digestwindow or 0)
+        oldest = min(message.created for message in messages)
+        return oldest + window <= datetime.datetime.now()
+
+    def _item(self, session, message):
+        """Get the item of a message, a vanished one is dropped"""
+        itemtype = self.itemtypes[message.kind]
+        query = session.query(itemtype)
+        if hasattr(itemtype, "attachments"):
+            query = query.options(selectinload(itemtype.attachments))
+        item = query.get(message.item_id)
+        if item is None:
+            self.logger.warning("item of %s vanished, dropping it", message.key)
+            message.sent = datetime.datetime.now()
+            message.error = "item vanished"
+        return item
+
+    def _claim(self, session, messages):
+        """Hold messages back from other runs and end the transaction
+
+        The delivery runs without a transaction, so it does not keep the
+        database locked. A run failing before it marked the messages sent
+        does not deliver them again before the lease is over."""
+        until = datetime.datetime.now() + self.lease
+        for message in messages:
+            message.next_attempt = until
+        session.commit()
+
+    def _retry_later(self, message, error):
+        """Schedule the next attempt of a message after a failed delivery"""
+        if isinstance(error, pushclient.RateLimited):
+            # not the messages fault, wait for the reset without counting it
+            if error.reset is not None:
+                message.next_attempt = datetime.datetime.fromtimestamp(error.reset)
+            else:
+                message.next_attempt = datetime.datetime.now() + datetime.timedelta(
+                    seconds=self.backoff
+                )
+            message.error = str(error)
+            return
+        message.attempts += 1
+        delay = min(self.backoff * 2 ** (message.attempts - 1), 86400)
+        message.next_attempt = datetime.datetime.now() + datetime.timedelta(
+            seconds=delay
+        )
+        message.error = "{}: {}".format(type(error).__name__, error)
+
+    def deliver(self, session, inf, message):
+        """Deliver one message, on failure the next attempt is scheduled"""
+        item = self._item(session, message)
+        if item is None:
+            session.commit()
+            return False
+        self._claim(session, [message])
+        try:
+            inf.deliver(message.kind, item)
+        except pushclient.RateLimited as e:
+            self.logger.warning("deferring %s: %s", message.key, e)
+            self._retry_later(message, e)
+            session.commit()
+            return False
+        except Exception as e:
+            self._retry_later(message, e)
+            self.logger.exception(
+                "delivering %s failed (attempt %d)", message.key, message.attempts
+            )
+            session.commit()
+            return False
+        message.sent = datetime.datetime.now()
+        message.error = None
+        session.commit()
+        return True
+
+    def deliver_digest(self, session, inf, messages):
+        """Deliver messages as one digest, returns the number of messages sent"""
+        items = []
+        for message in messages:
+            item = self._item(session, message)
+            if item is not None:
+                items.append((message, item))
+        if not items:
+            session.commit()
+            return 0
+        self._claim(session, [message for message, item in items])
+        try:
+            inf.deliver_digest([(message.kind, item) for message, item in items])
+        except Exception as e:
+            for message, item in items:
+                self._retry_later(message, e)
+            self.logger.warning(
+                "delivering digest of %d items failed", len(items), exc_info=e
+            )
+            session.commit()
+            return 0
+        now = datetime.datetime.now()
+        for message, item in items:
+            message.sent = now
+            message.error = None
+        session.commit()
+        return len(items)
+
+    def deliver_calendar(self, session, inf, messages):
+        """Deliver calendar messages as one batch, returns the number sent"""
+        items = []
+        for message in messages:
+            item = self._item(session, message)
+            if item is not None:
+                items.append((message, item))
+        if not items:
+            session.commit()
+            return 0
+        self._claim(session, [message for message, item in items])
+        try:
+            failed = inf.deliver_calendar([item for message, item in items])
+        except Exception as e:
+            failed = {item: e for message, item in items}
+        delivered = 0
+        now = datetime.datetime.now()
+        for message, item in items:
+            if item in failed:
+                self._retry_later(message, failed[item])
+                self.logger.warning(
+                    "delivering %s failed (attempt %d)", message.key, message.attempts
+                )
+            else:
+                message.sent = now
+                message.error = None
+                delivered += 1
+        session.commit()
+        return delivered
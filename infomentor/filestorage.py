@@ -1,4 +1,204 @@
-from infomentor import model, db, icloudcalendar, config
-cfg = config.load()
+import collections
+import contextlib
+import datetime
+import logging
+import os
+import threading
+from infomentor import model
 
-class Attachment(object):
+_logger = logging.getLogger(__name__)
+
+
+class BlobStore(object):
+    """Content addressed storage for downloaded files
+
+    Every distinct content is stored once, named by its SHA-256. The per user
+    paths below linkdirs are hard links to the blob (or symlinks if the
+    filesystem does not support hard links), so existing urls keep working."""
+
+    def __init__(self, directory="blobs", linkdirs=("files", "images")):
+        self.directory = directory
+        self.linkdirs = linkdirs
+
+    def blobpath(self, sha256):
+        """Get the path of the blob for the given content hash"""
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def add(self, filename, sha256):
+        """Move a complete file into the store, it is dropped if the content is known"""
+        blob = self.blobpath(sha256)
+        if os.path.exists(blob):
+            _logger.info("content %s already stored", sha256)
+            os.unlink(filename)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(filename, blob)
+        return blob
+
+    def link(self, sha256, target):
+        """Make target point to the blob, replacing an existing file"""
+        blob = self.blobpath(sha256)
+        tmp = "{}.link".format(target)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            os.symlink(os.path.relpath(blob, os.path.dirname(target)), tmp)
+        os.replace(tmp, target)
+
+    def links(self, sha256s):
+        """Find the per user paths linking to one of the blobs
+
+        Yields (path, sha256) for hard links and symlinks alike, both stat
+        as the blob itself."""
+        blobs = {}
+        for sha256 in sha256s:
+            with contextlib.suppress(FileNotFoundError):
+                st = os.stat(self.blobpath(sha256))
+                blobs[(st.st_dev, st.st_ino)] = sha256
+        if not blobs:
+            return
+        for linkdir in self.linkdirs:
+            for root, dirs, files in os.walk(linkdir):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        # a dangling symlink
+                        continue
+                    sha256 = blobs.get((st.st_dev, st.st_ino))
+                    if sha256 is not None:
+                        yield path, sha256
+
+    def remove(self, sha256s):
+        """Delete the blobs and the per user paths linking to them"""
+        sha256s = set(sha256s)
+        for path, sha256 in list(self.links(sha256s)):
+            os.unlink(path)
+            with contextlib.suppress(OSError):
+                # the directory of the download, if it is empty now
+                os.rmdir(os.path.dirname(path))
+        for sha256 in sha256s:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.blobpath(sha256))
+
+
+class FetchCache(object):
+    """Downloads shared between all users, keyed by their infomentor id
+
+    The same school wide attachment or news image is only downloaded once,
+    other users link to the stored content. Entries older than maxage
+    seconds are downloaded again, in case the server changed the content.
+    Each operation uses its own short session, so entries are shared across
+    worker threads right away. Downloads happen while the user's session
+    has no transaction open, so storing an entry does not wait for it."""
+
+    def __init__(self, new_session, store, maxage=86400):
+        self.new_session = new_session
+        self.store = store
+        self.maxage = datetime.timedelta(seconds=maxage)
+        self._locks = collections.defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Serialize the download of a key, so concurrent users wait for it"""
+        with self._locks_lock:
+            lock = self._locks[key]
+        with lock:
+            yield
+
+    def lookup(self, key):
+        """Get the fresh cached download for key or None"""
+        session = self.new_session(readonly=True)
+        try:
+            cached = (
+                session.query(model.CachedFile)
+                .filter(model.CachedFile.key == key)
+                .one_or_none()
+            )
+            if cached is None:
+                return None
+            session.expunge(cached)
+        finally:
+            session.close()
+        if datetime.datetime.now() - cached.fetched > self.maxage:
+            _logger.info("cached download %s is stale", key)
+            return None
+        if not os.path.exists(self.store.blobpath(cached.sha256)):
+            return None
+        return cached
+
+    def store_file(self, key, filename, sha256, size):
+        """Remember the download for key"""
+        session = self.new_session()
+        try:
+            cached = (
+                session.query(model.CachedFile)
+                .filter(model.CachedFile.key == key)
+                .one_or_none()
+            )
+            if cached is None:
+                cached = model.CachedFile(key=key)
+                session.add(cached)
+            elif cached.sha256 != sha256:
+                _logger.info("content of %s changed on the server", key)
+            cached.filename = filename
+            cached.sha256 = sha256
+            cached.size = size
+            cached.fetched = datetime.datetime.now()
+            session.commit()
+        except Exception:
+            session.rollback()
+            _logger.exception("could not store %s in the fetch cache", key)
+        finally:
+            session.close()
+
+
+def add_references(session, attachments):
+    """Count the stored attachments as references to their blobs"""
+    for attachment in attachments:
+        if attachment.sha256 is None:
+            continue
+        updated = (
+            session.query(model.Blob)
+            .filter(model.Blob.sha256 == attachment.sha256)
+            .update({model.Blob.refcount: model.Blob.refcount + 1})
+        )
+        if not updated:
+            session.add(
+                model.Blob(sha256=attachment.sha256, size=attachment.size, refcount=1)
+            )
+
+
+def remove_references(session, attachments):
+    """Stop counting the attachments, which are removed, as references"""
+    for attachment in attachments:
+        if attachment.sha256 is None:
+            continue
+        session.query(model.Blob).filter(model.Blob.sha256 == attachment.sha256).update(
+            {model.Blob.refcount: model.Blob.refcount - 1}
+        )
+
+
+def collect_garbage(session, store):
+    """Remove the blobs no longer referenced by a stored attachment
+
+    Only the reference counts in the database decide. Blobs without a count
+    (e.g. the news images) are kept. The per user paths linking to a removed
+    blob are removed with it. The session holds the write lock meanwhile, so
+    no reference is added concurrently."""
+    orphaned = [
+        sha256
+        for sha256, in session.query(model.Blob.sha256).filter(
+            model.Blob.refcount <= 0
+        )
+    ]
+    for sha256 in orphaned:
+        _logger.info("removing orphaned blob %s", sha256)
+    store.remove(orphaned)
+    session.query(model.Blob).filter(model.Blob.refcount <= 0).delete()
+    session.commit()
+    return len(orphaned)
@@ -6,9 +6,11 @@ class flock(object):
 
     filename = ".im.lock"
 
-    def __init__(self):
+    def __init__(self, filename=None):
         """Creates an object with the current pid"""
         self.pid = os.getpid()
+        if filename is not None:
+            self.filename = filename
 
     def aquire(self):
         """Try to get the lock, if it fails it returns False"""
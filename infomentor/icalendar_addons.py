@@ -1,19 +1,30 @@
 import pytz
 import icalendar
 import datetime
+import functools
 
 def generate_vtimezone(timezone, for_date=None):
+    """The VTIMEZONE of timezone for the year of for_date
+
+    The result is cached per timezone and year and shared, so it must not
+    be modified."""
     if not timezone or 'utc' in timezone.lower():  # UTC doesn't need a timezone definition
         return None
     if not for_date:
         for_date = datetime.datetime.now()
+    return _generate_vtimezone(timezone, for_date.year)
+
+
+@functools.lru_cache(maxsize=32)
+def _generate_vtimezone(timezone, year):
+    for_date = datetime.datetime(year, 1, 1)
     try:
         z = pytz.timezone(timezone)
     except pytz.UnknownTimeZoneError:
         z = pytz.timezone('Europe/Berlin')
     if not hasattr(z, '_utc_transition_times'):
         return None
-    transitions = zip(z._utc_transition_times, z._transition_info)
+    transitions = list(zip(z._utc_transition_times, z._transition_info))
     try:
         dst1, std1, dst2, std2 = filter(lambda x: x[0].year in (for_date.year, for_date.year + 1),
                                         transitions)
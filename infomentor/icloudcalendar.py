@@ -1,17 +1,23 @@
-from datetime import datetime
-import sys
-
-from bs4 import BeautifulSoup
+import concurrent.futures
 import time
-import caldav
-from caldav.elements import dav, cdav
-from lxml import etree
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 import logging
 
 _logger = logging.getLogger(__name__)
 
+DAV = "{DAV:}"
+CALDAV = "{urn:ietf:params:xml:ns:caldav}"
+
+
+class DiscoveryError(Exception):
+    """The server rejected a discovered url (401 or 404), discover again"""
+
 
 class iCloudConnector(object):
 
@@ -20,14 +26,31 @@ class iCloudConnector(object):
     password = None
     propfind_principal = '<A:propfind xmlns:A="DAV:"><A:prop><A:current-user-principal/></A:prop></A:propfind>'
     propfind_calendar_home_set = "<propfind xmlns='DAV:' xmlns:cd='urn:ietf:params:xml:ns:caldav'><prop> <cd:calendar-home-set/></prop></propfind>"
+    propfind_calendars = "<propfind xmlns='DAV:'><prop><displayname/><resourcetype/></prop></propfind>"
+    mkcalendar = "<cd:mkcalendar xmlns='DAV:' xmlns:cd='urn:ietf:params:xml:ns:caldav'><set><prop><displayname>{}</displayname></prop></set></cd:mkcalendar>"
 
-    def __init__(self, username, password, **kwargs):
+    def __init__(
+        self,
+        username,
+        password,
+        principal_path=None,
+        calendar_home_set_url=None,
+        poolsize=10,
+        **kwargs
+    ):
         self.username = username
         self.password = password
         if "icloud_url" in kwargs:
             self.icloud_url = kwargs["icloud_url"]
-        self.discover()
-        self.get_calendars()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=poolsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.auth = HTTPBasicAuth(self.username, self.password)
+        self.principal_path = principal_path
+        self.calendar_home_set_url = calendar_home_set_url
+        if self.calendar_home_set_url is None:
+            self.discover()
 
     # discover: connect to icloud using the provided credentials and discover
     #
@@ -35,58 +58,52 @@ class iCloudConnector(object):
     # 2  The calendar home URL
     #
     # These URL's vary from user to user
-    # once doscivered, these  can then be used to manage calendars
+    # once doscivered, these can be stored and passed in again, so the
+    # discovery is only needed if they are rejected
 
     def discover(self):
         # Build and dispatch a request to discover the prncipal us for the
         # given credentials
-        headers = {"Depth": "1"}
-        auth = HTTPBasicAuth(self.username, self.password)
         principal_response = self.repeated_request(
-            "PROPFIND", self.icloud_url, auth=auth, data=self.propfind_principal
+            "PROPFIND", self.icloud_url, data=self.propfind_principal
         )
         # Parse the resulting XML response
-        soup = BeautifulSoup(principal_response.content, "lxml")
-        self.principal_path = (
-            soup.find("current-user-principal").find("href").get_text()
-        )
-        discovery_url = self.icloud_url + self.principal_path
+        href = self._find(principal_response, DAV + "current-user-principal")
+        self.principal_path = href
+        discovery_url = urllib.parse.urljoin(self.icloud_url, self.principal_path)
         _logger.debug("Discovery url {}".format(discovery_url))
         # Next use the discovery URL to get more detailed properties - such as
         # the calendar-home-set
         home_set_response = self.repeated_request(
-            "PROPFIND", discovery_url, auth=auth, data=self.propfind_calendar_home_set
+            "PROPFIND", discovery_url, data=self.propfind_calendar_home_set
         )
-        _logger.debug("Result code: {}".format(home_set_response.status_code))
-        if home_set_response.status_code != 207:
-            _logger.error(
-                "Failed to retrieve calendar-home-set {}".format(
-                    home_set_response.status_code
-                )
-            )
-            raise Exception(
-                "failed to retrieve calender home set {}".format(
-                    home_set_response.content
-                )
-            )
         # And then extract the calendar-home-set URL
-        soup = BeautifulSoup(home_set_response.content, "lxml")
-        self.calendar_home_set_url = soup.find(
-            "href", attrs={"xmlns": "DAV:"}
-        ).get_text()
+        href = self._find(home_set_response, CALDAV + "calendar-home-set")
+        self.calendar_home_set_url = urllib.parse.urljoin(discovery_url, href)
+
+    def _find(self, response, prop):
+        """Get the href stored in prop of a multistatus response"""
+        root = ElementTree.fromstring(response.content)
+        href = root.find(".//{}/{}href".format(prop, DAV))
+        if href is None or not href.text:
+            raise Exception("no {} in response {}".format(prop, response.content))
+        return href.text.strip()
 
-    def repeated_request(self, *args, **kwargs):
+    def repeated_request(self, method, url, expected=(207,), **kwargs):
         for _ in range(0, 5):
-            response = requests.request(*args, **kwargs)
+            response = self.session.request(method, url, **kwargs)
             _logger.debug("Request result code: {}".format(response.status_code))
-            if response.status_code != 207:
-                _logger.error(
-                    "Failed to retrieve response: {}".format(response.status_code)
-                )
-                _logger.error("Retry")
-                time.sleep(0.25)
-            if response.status_code == 207:
+            if response.status_code in expected:
                 break
+            if response.status_code in (401, 404):
+                raise DiscoveryError(
+                    "{} {} returned {}".format(method, url, response.status_code)
+                )
+            _logger.error(
+                "Failed to retrieve response: {}".format(response.status_code)
+            )
+            _logger.error("Retry")
+            time.sleep(0.25)
         else:
             raise Exception(
                 "failed to retrieve {} {}".format(response.content, response.headers)
@@ -94,33 +111,46 @@ class iCloudConnector(object):
         return response
 
     # get_calendars
-    # Having discovered the calendar-home-set url
-    # we can create a local object to control calendars (thin wrapper around
-    # CALDAV library)
+    # Having discovered the calendar-home-set url we can list the calendars
+    # within with one PROPFIND, returns a dict of display name and url
     def get_calendars(self):
-        self.caldav = caldav.DAVClient(
-            self.calendar_home_set_url, username=self.username, password=self.password
+        response = self.repeated_request(
+            "PROPFIND",
+            self.calendar_home_set_url,
+            data=self.propfind_calendars,
+            headers={"Depth": "1"},
         )
-        self.principal = self.caldav.principal()
-        self.calendars = self.principal.calendars()
+        calendars = {}
+        for entry in ElementTree.fromstring(response.content).iter(DAV + "response"):
+            href = entry.find(DAV + "href")
+            if href is None or entry.find(".//{}calendar".format(CALDAV)) is None:
+                continue
+            name = entry.find(".//{}displayname".format(DAV))
+            url = urllib.parse.urljoin(self.calendar_home_set_url, href.text.strip())
+            calendars[name.text if name is not None else None] = url
+        return calendars
 
     def get_named_calendar(self, name):
+        url = self.get_calendars().get(name)
+        if url is None:
+            return None
+        return Calendar(self, url)
 
-        if len(self.calendars) > 0:
-            for calendar in self.calendars:
-                properties = calendar.get_properties([dav.DisplayName()])
-                display_name = properties["{DAV:}displayname"]
-                if display_name == name:
-                    return calendar
-        return None
+    def calendar(self, url):
+        """Get a calendar by its known url, without contacting the server"""
+        return Calendar(self, url)
 
     def create_calendar(self, name):
-        return self.principal.make_calendar(name=name)
-
-    def delete_all_events(self, calendar):
-        for event in calendar.events():
-            event.delete()
-        return True
+        url = urllib.parse.urljoin(
+            self.calendar_home_set_url, "{}/".format(uuid.uuid4())
+        )
+        self.repeated_request(
+            "MKCALENDAR",
+            url,
+            expected=(201,),
+            data=self.mkcalendar.format(escape(name)),
+        )
+        return Calendar(self, url)
 
     def create_events_from_ical(self, ical):
         # to do
@@ -137,3 +167,129 @@ class iCloudConnector(object):
     ):
         # to do
         pass
+
+
+class Calendar(object):
+    """A calendar collection, events are written directly to its url"""
+
+    multiget = "<cd:calendar-multiget xmlns='DAV:' xmlns:cd='urn:ietf:params:xml:ns:caldav'><prop><getetag/></prop>{}</cd:calendar-multiget>"
+
+    def __init__(self, connector, url):
+        self.connector = connector
+        self.url = url
+
+    def event_url(self, uid):
+        return urllib.parse.urljoin(self.url, urllib.parse.quote(uid) + ".ics")
+
+    def etags(self, urls):
+        """Get the etags of the events at urls with one REPORT
+
+        Returns a dict of url and etag, events not on the server are left out."""
+        if not urls:
+            return {}
+        paths = {_path(url): url for url in urls}
+        hrefs = "".join(
+            "<href>{}</href>".format(escape(urllib.parse.urlsplit(url).path))
+            for url in urls
+        )
+        response = self.connector.repeated_request(
+            "REPORT",
+            self.url,
+            data=self.multiget.format(hrefs),
+            headers={"Depth": "1", "Content-Type": "application/xml; charset=utf-8"},
+        )
+        etags = {}
+        for entry in ElementTree.fromstring(response.content).iter(DAV + "response"):
+            href = entry.find(DAV + "href")
+            etag = entry.find(".//{}getetag".format(DAV))
+            if href is None or etag is None or not etag.text:
+                continue
+            url = paths.get(_path(urllib.parse.urljoin(self.url, href.text.strip())))
+            if url is not None:
+                etags[url] = etag.text.strip()
+        return etags
+
+    def put_event(self, url, ical):
+        """Write an event, replacing the one on the server if there is one
+
+        Returns the new etag if the server sends one."""
+        response = self.connector.repeated_request(
+            "PUT",
+            url,
+            expected=(201, 204),
+            data=ical,
+            headers={"Content-Type": 'text/calendar; charset="utf-8"'},
+        )
+        return response.headers.get("ETag")
+
+    def delete_event(self, url):
+        """Delete an event, one which is already gone is fine as well"""
+        self.connector.repeated_request("DELETE", url, expected=(200, 204, 404))
+
+
+def _path(url):
+    return urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+
+
+class CalendarSync(object):
+    """Uploads or deletes a batch of events of a calendar
+
+    The etags of all events are fetched with one REPORT, only events which
+    changed locally or on the server are uploaded, concurrently. Infomentor
+    is the source of the events, an event changed on the server is
+    overwritten."""
+
+    def __init__(self, calendar, workers=4):
+        self.calendar = calendar
+        self.workers = workers
+
+    def sync(self, events):
+        """Upload events, a list of (uid, ical, etag, changed)
+
+        etag is the one of the last upload of the event, changed tells if the
+        content differs from that upload. Returns a dict of uid and either
+        (url, etag) of the upload or the exception it failed with. Events
+        which are up to date on the server are left out."""
+        urls = {uid: self.calendar.event_url(uid) for uid, *rest in events}
+        remote = self.calendar.etags(list(urls.values()))
+        uploads = []
+        for uid, ical, etag, changed in events:
+            current = remote.get(urls[uid])
+            if changed or current is None or current != etag:
+                uploads.append((uid, ical))
+        _logger.info("uploading %d of %d calendar events", len(uploads), len(events))
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            futures = {
+                pool.submit(self._upload, uid, ical): uid
+                for uid, ical in uploads
+            }
+            for future in concurrent.futures.as_completed(futures):
+                uid = futures[future]
+                try:
+                    results[uid] = future.result()
+                except DiscoveryError:
+                    raise
+                except Exception as e:
+                    results[uid] = e
+        return results
+
+    def _upload(self, uid, ical):
+        url = self.calendar.event_url(uid)
+        return url, self.calendar.put_event(url, ical)
+
+    def delete(self, urls):
+        """Delete the events at urls concurrently
+
+        Returns a dict of the urls which failed and their exceptions."""
+        failed = {}
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            futures = {pool.submit(self.calendar.delete_event, url): url for url in urls}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except DiscoveryError:
+                    raise
+                except Exception as e:
+                    failed[futures[future]] = e
+        return failed
@@ -0,0 +1,85 @@
+import argparse
+import subprocess
+import sys
+
+# only needed by some stages, importing them at startup is a regression
+LAZY_MODULES = (
+    "dateparser",
+    "icalendar",
+    "pytz",
+    "Crypto",
+    "aiohttp",
+)
+
+
+def _importtime(code):
+    """Run code with -X importtime, returns the cumulative time of each import
+
+    The names keep their indentation, top level imports have none."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        raise Exception("running {!r} failed:\n{}".format(code, result.stderr))
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # the header line
+            continue
+        name = fields[2][1:]
+        imports.setdefault(name, 0)
+        imports[name] += cumulative
+    return imports
+
+
+def measure(module="infomentor.__main__"):
+    """Import module in a fresh interpreter
+
+    Returns the import time in ms and the names of all modules imported for
+    it, the modules loaded during interpreter startup are left out."""
+    startup = _importtime("pass")
+    imports = _importtime("import {}".format(module))
+    total = sum(
+        cumulative
+        for name, cumulative in imports.items()
+        if not name.startswith(" ") and name not in startup
+    )
+    return total / 1000, {name.strip() for name in imports}
+
+
+def main(arglist=None):
+    parser = argparse.ArgumentParser(
+        description="Check the import time of the infomentor entry point"
+    )
+    parser.add_argument(
+        "--target", type=float, default=400, help="maximum import time in ms"
+    )
+    parser.add_argument("--module", default="infomentor.__main__")
+    args = parser.parse_args(arglist)
+
+    total, modules = measure(args.module)
+    eager = sorted(name for name in modules if name in LAZY_MODULES)
+    print(
+        "importing {} took {:.1f}ms (target {:.0f}ms)".format(
+            args.module, total, args.target
+        )
+    )
+    ok = True
+    if eager:
+        print("imported eagerly: {}".format(", ".join(eager)))
+        ok = False
+    if total > args.target:
+        print("import time exceeds the target")
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
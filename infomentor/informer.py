@@ -1,25 +1,15 @@
-from infomentor import model, db, icloudcalendar, config, icalendar_addons
+from infomentor import model, db, config, filestorage, mailer, pushclient, dates
 import logging
 import uuid
 import os
 import re
-import dateparser
 import hashlib
+import json
 import datetime
 import math
-import pushover
 import urllib.parse
-from icalendar import Event, vDate, Calendar, vCalAddress, vText, vBoolean, Timezone
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
-import mimetypes
-import smtplib
-
-
-cfg = config.load()
-pushover.init(cfg["pushover"]["apikey"])
 
 
 class Informer(object):
@@ -27,18 +17,24 @@ class Informer(object):
 
     This class offers the methods required to notify a user of new News and Homework items posted on infomentor."""
 
-    def __init__(self, user, im, logger):
+    def __init__(self, user, im, logger, session=None):
         self.logger = logger or logging.getLogger(__name__)
         self.user = user
         self.im = im
+        self.session = session or db.get_db()
+        self.cfg = config.load()
+        self.fullsync_interval = datetime.timedelta(
+            hours=self.cfg.getint("sync", "fullsync")
+        )
+        self.commit_batch = self.cfg.getint("database", "commitbatch")
         self.cal = None
 
     def send_status_update(self, text):
         """In case something unexpected happends and the user has activated the feature to get notified about it, this will send out the information"""
         try:
             if self.user.notification.ntype == model.Notification.Types.PUSHOVER:
-                pushover.Client(self.user.notification.info).send_message(
-                    text, title="Status Infomentor", html=False
+                pushclient.get_client().send_message(
+                    self.user.notification.info, text, title="Status Infomentor"
                 )
             elif self.user.notification.ntype == model.Notification.Types.EMAIL:
                 self._send_text_mail(
@@ -46,30 +42,214 @@ class Informer(object):
                 )
         except:
             self._send_text_mail(
-                cfg["general"]["adminmail"],
+                self.cfg["general"]["adminmail"],
                 "Fehler bei infomentor",
                 "Fehler bei Infomentor",
             )
 
     def update_news(self):
-        session = db.get_db()
-        newslist = self.im.get_news_list()
+        session = self.session
+        state = self._sync_state("News")
+        fullsync = state.needs_full_sync(self.fullsync_interval)
+        # no transaction is kept open while infomentor is requested
+        session.commit()
+        if fullsync:
+            self.logger.info("full sync of news")
+            newslist = self.im.get_news_list()
+        else:
+            newslist = self.im.get_news_list(since=state.watermark)
+            if self._unchanged(state, "News"):
+                return
+        known = {
+            (news_id, date)
+            for news_id, date in session.query(model.News.news_id, model.News.date)
+            .filter(model.News.user_id == self.user.id)
+        }
+        session.commit()
+        watermark = state.watermark
+        failed = False
+        fetched = []
         for news_entry in newslist:
             self.logger.debug("parsing %s", news_entry["id"])
-            news = (
-                session.query(model.News)
-                .filter(model.News.news_id == news_entry["id"])
-                .filter(model.News.date == news_entry["publishedDate"])
-                .with_parent(self.user, "news")
-                .one_or_none()
-            )
-            if news is not None:
+            date = self.im.list_item_date(news_entry)
+            if date is not None and (watermark is None or date > watermark):
+                watermark = date
+            key = (news_entry["id"], news_entry["publishedDate"])
+            if key in known:
                 self.logger.debug("Skipping news %s", news_entry["id"])
                 continue
-            news = self.im.get_news_article(news_entry)
-            self._notify_news(news)
-            self.user.news.append(news)
-            session.commit()
+            known.add(key)
+            try:
+                fetched.append((self.im.get_news_article(news_entry), None))
+            except Exception as e:
+                self.logger.exception("fetching news %s failed", news_entry["id"])
+                failed = True
+                continue
+            if len(fetched) >= self.commit_batch and not self._store(fetched):
+                failed = True
+        if not self._store(fetched):
+            failed = True
+        if not failed:
+            # a failed entry has to be fetched again on the next run
+            state.watermark = watermark
+            state.fingerprint = self.im.fingerprints.get("News")
+        if fullsync:
+            state.last_full_sync = datetime.datetime.now()
+        session.commit()
+
+    def _store(self, fetched):
+        """Store the fetched (item, changes) in one transaction and clear the list
+
+        Returns False if storing one of them failed."""
+        stored = True
+        for item, changes in fetched:
+            if not self._add_item(item, changes):
+                stored = False
+        self.session.commit()
+        del fetched[:]
+        return stored
+
+    def _add_item(self, item, changes=None):
+        """Store a new or changed item within its own savepoint
+
+        The notification for the item is queued in the outbox within the
+        same savepoint, so it exists exactly when the item is stored. If
+        storing fails only this item is rolled back."""
+        try:
+            with self.session.begin_nested():
+                changes = changes or {}
+                # count each stored attachment once as reference to its blob
+                if item.id is None:
+                    added = getattr(item, "attachments", [])
+                elif "attachments" in changes:
+                    # the replaced attachments are deleted with the flush
+                    filestorage.remove_references(self.session, item.attachments)
+                    added = changes["attachments"]
+                else:
+                    added = []
+                for key, value in changes.items():
+                    setattr(item, key, value)
+                if item.id is None:
+                    item.user = self.user
+                    self.session.add(item)
+                filestorage.add_references(self.session, added)
+                self.session.flush()
+                self._enqueue(item)
+        except Exception as e:
+            self.logger.exception("storing %s failed", item)
+            return False
+        return True
+
+    def _enqueue(self, item):
+        """Queue the notification about item in the outbox"""
+        if isinstance(item, model.News):
+            kind = model.OutboxMessage.Kinds.NEWS
+            key = "news:{}:{}:{}".format(self.user.id, item.news_id, item.date)
+        elif isinstance(item, model.Homework):
+            kind = model.OutboxMessage.Kinds.HOMEWORK
+            key = "homework:{}:{}".format(self.user.id, item.homework_id)
+        else:
+            kind = model.OutboxMessage.Kinds.CALENDAR
+            key = "calendar:{}:{}:{}".format(self.user.id, item.calendar_id, item.hash)
+        exists = (
+            self.session.query(model.OutboxMessage.id)
+            .filter(model.OutboxMessage.key == key)
+            .filter(model.OutboxMessage.sent == None)
+            .first()
+        )
+        if exists is not None:
+            self.logger.info("notification %s already queued", key)
+            return
+        self.session.add(
+            model.OutboxMessage(user=self.user, kind=kind, item_id=item.id, key=key)
+        )
+
+    def deliver(self, kind, item):
+        """Send the notification about an item, used by the dispatcher"""
+        if kind == model.OutboxMessage.Kinds.NEWS:
+            self._notify_news(item)
+            item.notified = True
+        elif kind == model.OutboxMessage.Kinds.HOMEWORK:
+            self._notify_hw(item)
+        elif kind == model.OutboxMessage.Kinds.CALENDAR:
+            failed = self.deliver_calendar([item])
+            if failed:
+                raise failed[item]
+
+    def deliver_digest(self, items):
+        """Send one message about several news and homework items
+
+        items is a list of (kind, item). The full text of each item is put
+        on its own page, the message only lists the titles and links."""
+        if self.user.notification is None:
+            self.logger.debug("Warn: no notification for user")
+            return
+        entries = []
+        for kind, item in items:
+            if kind == model.OutboxMessage.Kinds.NEWS:
+                title, text = item.title, item.content
+            else:
+                title, text = f"Homework: {item.subject}", item.text
+            for attachment in item.attachments:
+                fname, url = self._attachment_link(attachment)
+                text += """<br>Attachment {0}: {1}<br>""".format(fname, url)
+            entries.append((title, self._make_site(f"<h2>{title}</h2>{text}")))
+        subject = "{} new items".format(len(entries))
+        ntype = self.user.notification.ntype
+        if ntype == model.Notification.Types.PUSHOVER:
+            text = "\n".join(
+                '<a href="{1}">{0}</a>'.format(title, url) for title, url in entries
+            )
+            if len(text) > 900:
+                overview = "<br>".join(
+                    "{} {}".format(title, url) for title, url in entries
+                )
+                text = "overview saved at: {}".format(self._make_site(overview))
+            try:
+                pushclient.get_client().send_message(
+                    self.user.notification.info, text, title=subject, html=True
+                )
+            except pushclient.PushoverError as e:
+                self.logger.error("Sending notification failed", exc_info=e)
+                raise
+        elif ntype == model.Notification.Types.EMAIL:
+            text = "\n\n".join("{}\n{}".format(title, url) for title, url in entries)
+            self._send_text_mail(
+                self.user.notification.info, f"INFOMENTOR: {subject}", text
+            )
+        elif ntype == model.Notification.Types.FAKE:
+            with open("{}.txt".format(self.user.name), "a+") as f:
+                f.write(
+                    "Digest:\n---------8<-------\n{}\n---------8<-------\n\n".format(
+                        "\n".join("{} {}".format(title, url) for title, url in entries)
+                    )
+                )
+        else:
+            raise Exception("invalid notification")
+        for kind, item in items:
+            if kind == model.OutboxMessage.Kinds.NEWS:
+                item.notified = True
+
+    def _unchanged(self, state, endpoint):
+        """Check if the response of endpoint is the same as on the last run"""
+        fingerprint = self.im.fingerprints.get(endpoint)
+        if fingerprint is not None and fingerprint == state.fingerprint:
+            self.logger.info("%s unchanged since last run, skipping", endpoint)
+            return True
+        return False
+
+    def _sync_state(self, endpoint):
+        """Get the sync state of the user for endpoint, created if missing"""
+        state = (
+            self.session.query(model.SyncState)
+            .filter(model.SyncState.endpoint == endpoint)
+            .with_parent(self.user, "syncstates")
+            .one_or_none()
+        )
+        if state is None:
+            state = model.SyncState(endpoint=endpoint)
+            self.user.syncstates.append(state)
+        return state
 
     def _notify_news(self, news):
         if self.user.notification is None:
@@ -93,13 +273,9 @@ class Informer(object):
     def _notify_news_pushover(self, news):
         text = news.content
         for attachment in news.attachments:
-            fid, fname = attachment.localpath.split("/")
-            text += """<br>Attachment {0}: {2}/{1} <br>""".format(
-                fname,
-                urllib.parse.quote(attachment.localpath),
-                cfg["general"]["baseurl"],
-            )
-        parsed_date = dateparser.parse(news.date)
+            fname, url = self._attachment_link(attachment)
+            text += """<br>Attachment {0}: {1} <br>""".format(fname, url)
+        parsed_date = dates.parse(news.date)
         now = datetime.datetime.now()
         parsed_date += datetime.timedelta(hours=now.hour, minutes=now.minute)
         timestamp = math.floor(parsed_date.timestamp())
@@ -108,22 +284,39 @@ class Informer(object):
             shorttext = text[:900]
             text = "{}...\n\nfulltext saved at: {}".format(shorttext, url)
         text = text.replace("<br>", "\n")
+        image = None
         try:
             self.logger.info(text)
             self.logger.info(news.title)
             if news.imagefile is not None:
                 image = open(os.path.join("images", news.imagefile), "rb")
-            else:
-                image = None
-            pushover.Client(self.user.notification.info).send_message(
-                text, title=news.title, attachment=image, html=True, timestamp=timestamp
+            pushclient.get_client().send_message(
+                self.user.notification.info,
+                text,
+                title=news.title,
+                attachment=image,
+                html=True,
+                timestamp=timestamp,
             )
-        except pushover.RequestError as e:
+        except pushclient.PushoverError as e:
             self.logger.error("Sending notification failed", exc_info=e)
+            raise
         finally:
             if image is not None:
                 image.close()
 
+    def _attachment_link(self, attachment):
+        """Name and url of an attachment
+
+        Attachments which were too large to be stored link to infomentor."""
+        if attachment.localpath is None:
+            return attachment.title, self.im._mim_url(attachment.url)
+        fid, fname = attachment.localpath.split("/")
+        url = "{}/{}".format(
+            self.cfg["general"]["baseurl"], urllib.parse.quote(attachment.localpath)
+        )
+        return fname, url
+
     def _make_site(self, text):
         filename = str(uuid.uuid4())
         fpath = os.path.join("files", filename + ".html")
@@ -134,7 +327,7 @@ class Informer(object):
         )
         with open(fpath, "w+") as f:
             f.write(text)
-        return "{}/{}.html".format(cfg["general"]["baseurl"], filename)
+        return "{}/{}.html".format(self.cfg["general"]["baseurl"], filename)
 
     def _notify_news_mail(self, news):
         self._send_attachment_mail(
@@ -145,20 +338,37 @@ class Informer(object):
         )
 
     def update_homework(self):
-        session = db.get_db()
+        session = self.session
+        state = self._sync_state("Homework")
+        session.commit()
         homeworklist = self.im.get_homework_list()
-        for homeworkid in homeworklist:
-            homework = (
-                session.query(model.Homework)
-                .filter(model.Homework.homework_id == homeworkid)
-                .with_parent(self.user, "homeworks")
-                .one_or_none()
+        if self._unchanged(state, "Homework"):
+            return
+        known = {
+            homework_id
+            for homework_id, in session.query(model.Homework.homework_id).filter(
+                model.Homework.user_id == self.user.id
             )
-            if homework is None:
-                homework = self.im.get_homework_info(homeworkid)
-                self._notify_hw(homework)
-                self.user.homeworks.append(homework)
-                session.commit()
+        }
+        session.commit()
+        failed = False
+        fetched = []
+        for homeworkid in homeworklist:
+            if homeworkid not in known:
+                known.add(homeworkid)
+                try:
+                    fetched.append((self.im.get_homework_info(homeworkid), None))
+                except Exception as e:
+                    self.logger.exception("fetching homework %s failed", homeworkid)
+                    failed = True
+                    continue
+                if len(fetched) >= self.commit_batch and not self._store(fetched):
+                    failed = True
+        if not self._store(fetched):
+            failed = True
+        if not failed:
+            state.fingerprint = self.im.fingerprints.get("Homework")
+        session.commit()
 
     def _notify_hw(self, hw):
         if self.user.notification.ntype == model.Notification.Types.PUSHOVER:
@@ -179,12 +389,8 @@ class Informer(object):
     def _notify_hw_pushover(self, hw):
         text = hw.text
         for attachment in hw.attachments:
-            fid, fname = attachment.localpath.split("/")
-            text += """<br>Attachment {0}: {2}/{1}<br>""".format(
-                fname,
-                urllib.parse.quote(attachment.localpath),
-                cfg["general"]["baseurl"],
-            )
+            fname, url = self._attachment_link(attachment)
+            text += """<br>Attachment {0}: {1}<br>""".format(fname, url)
         if len(text) > 900:
             url = self._make_site(text)
             shorttext = text[:900]
@@ -193,11 +399,15 @@ class Informer(object):
         try:
             self.logger.info(text)
             self.logger.info(hw.subject)
-            pushover.Client(self.user.notification.info).send_message(
-                text, title=f"Homework: {hw.subject}", html=True
+            pushclient.get_client().send_message(
+                self.user.notification.info,
+                text,
+                title=f"Homework: {hw.subject}",
+                html=True,
             )
-        except pushover.RequestError as e:
+        except pushclient.PushoverError as e:
             self.logger.error("Sending notification failed", exc_info=e)
+            raise
 
     def _notify_hw_mail(self, hw):
         self._send_attachment_mail(
@@ -210,26 +420,34 @@ class Informer(object):
     def _send_attachment_mail(
         self, text, subject, attachments, to, fr="infomentor@09a.de"
     ):
-        outer = MIMEMultipart()
+        """Send text with the attachments, streamed to the smtp server
+
+        Attachments which are not stored or do not fit into the size budget
+        of the mail are replaced by links."""
         text = text.replace("<br>", "\n")
+        # leave some room for the headers and the links added below
+        budget = self.cfg.getint("smtp", "maxsize")
+        budget -= len(text.encode("utf-8")) + 4096
+        files = []
+        for attachment in attachments:
+            if attachment.localpath is not None:
+                filename = os.path.join("files", attachment.localpath)
+                size = mailer.encoded_size(os.path.getsize(filename))
+                if size <= budget:
+                    budget -= size
+                    files.append((filename, attachment.localpath.split("/")[1]))
+                    continue
+                self.logger.info("attachment %s too large for mail", filename)
+            text += "\nAttachment {0}: {1}".format(*self._attachment_link(attachment))
+        outer = MIMEMultipart()
         outer.attach(MIMEText(text + "\n\n"))
         outer["Subject"] = subject
         outer["From"] = fr
         outer["To"] = to
-        for attachment in attachments:
-            fid, fname = attachment.localpath.split("/")
-            filename = os.path.join("files", attachment.localpath)
-            ctype, encoding = mimetypes.guess_type(filename)
-            if ctype is None or encoding is not None:
-                ctype = "application/octet-stream"
-            maintype, subtype = ctype.split("/", 1)
-            with open(filename, "rb") as fp:
-                msg = MIMEBase(maintype, subtype)
-                msg.set_payload(fp.read())
-                encoders.encode_base64(msg)
-            msg.add_header("Content-Disposition", "attachment", filename=fname)
-            outer.attach(msg)
-        self._send_mail(outer)
+        mail = mailer.StreamedMail(outer)
+        for filename, fname in files:
+            mail.attach_file(filename, fname)
+        mailer.get_pool().send_streamed(mail)
 
     def _send_text_mail(self, to, subject, text, fr="infomentor@09a.de"):
         mail = MIMEText(text)
@@ -239,156 +457,419 @@ class Informer(object):
         self._send_mail(mail)
 
     def _send_mail(self, mail):
-        s = smtplib.SMTP_SSL(cfg["smtp"]["server"])
-        s.login(cfg["smtp"]["username"], cfg["smtp"]["password"])
-        s.send_message(mail)
-        s.quit()
-
-    def _send_invitation(self, calobj, to, fr="infomentor@09a.de"):
-        event = calobj.subcomponents[0]
-        eml_body = event["description"]
-        eml_body_bin = event["description"]
+        mailer.get_pool().send_message(mail)
+
+    def _send_invitation(self, entries, to, fr="infomentor@09a.de"):
+        """Send the calendar entries as one invitation mail"""
+        from icalendar import Calendar, vCalAddress, vText
+        from infomentor import icalendar_addons
+
+        calobj = Calendar()
+        calobj.add("PRODID", "-// infomentor_py /")
+        calobj.add("METHOD", "REQUEST")
+        calobj.add("calscale", "GREGORIAN")
+        calobj.add("version", "2.0")
+        vtimezone = icalendar_addons.generate_vtimezone('Europe/Berlin')
+        if vtimezone is not None:
+            calobj.add_component(vtimezone)
+        events = []
+        for entry in entries:
+            for event in Calendar.from_ical(entry.ical).walk("VEVENT"):
+                attendee = vCalAddress(f'MAILTO:{to}')
+                attendee.params['cn'] = vText(to)
+                attendee.params['ROLE'] = vText('REQ-PARTICIPANT')
+                attendee.params['CUTYPE'] = vText('REQ-INDIVIDUAL')
+                attendee.params['PARTSTAT'] = vText('ACCEPTED')
+                attendee.params['RSVP'] = 'FALSE'
+                event.add('attendee', attendee, encode=0)
+                event.add("organizer", 'MAILTO:infomentor@09a.de')
+                calobj.add_component(event)
+                events.append(event)
+
         msg = MIMEMultipart("mixed")
         msg["Reply-To"] = fr
-        msg["Subject"] = event["summary"]
+        if len(events) == 1:
+            msg["Subject"] = events[0]["summary"]
+        else:
+            msg["Subject"] = "{} calendar entries".format(len(events))
         msg["From"] = fr
         msg["To"] = to
         msg["Content-class"] = "urn:content-classes:calendarmessage"
 
-        calobj.add("PRODID", "-// infomentor_py /")
-        calobj.add("METHOD", "REQUEST")
-        calobj.add("calscale", "GREGORIAN")
-        calobj.add("version", "2.0")
-        calobj.add_component(icalendar_addons.generate_vtimezone('Europe/Berlin'))
-        attendee = vCalAddress(f'MAILTO:{to}')
-        attendee.params['cn'] = vText(to)
-        attendee.params['ROLE'] = vText('REQ-PARTICIPANT')
-        attendee.params['CUTYPE'] = vText('REQ-INDIVIDUAL')
-        attendee.params['PARTSTAT'] = vText('ACCEPTED')
-        attendee.params['RSVP'] = 'FALSE'
-        event.add('attendee', attendee, encode=0)
-        event.add("organizer", 'MAILTO:infomentor@09a.de')
-
-        part_email = MIMEText(eml_body, "html")
-        part_email_text = MIMEText(eml_body, "plain")
+        # serialized once, the calendar part is the only content of the mail
         part_cal = MIMEText(calobj.to_ical().decode("utf-8"), "calendar;method=REQUEST;name='invite.ics'")
 
         msgAlternative = MIMEMultipart("alternative")
         msg.attach(msgAlternative)
-
-        ical_atch = MIMEBase("application/ics", ' ;name="%s"' % ("invite.ics"))
-        ical_atch.set_payload(calobj.to_ical().decode("utf-8"))
-        encoders.encode_base64(ical_atch)
-        ical_atch.add_header(
-            "Content-Disposition", 'attachment; filename="%s"' % ("invite.ics")
-        )
-
-        eml_atch = MIMEBase("text/plain", "")
-        eml_atch.set_payload("")
-        encoders.encode_base64(eml_atch)
-        eml_atch.add_header("Content-Transfer-Encoding", "")
-
-        #msg.attach(part_email)
-        #msg.attach(part_email_text)
         msg.attach(part_cal)
         self._send_mail(msg)
 
     def _setup_icloudconnector(self):
         if self.cal is None:
+            from infomentor import icloudcalendar
+
             try:
-                icx = icloudcalendar.iCloudConnector(
-                    self.user.icalendar.icloud_user, self.user.icalendar.password
-                )
-                cname = self.user.icalendar.calendarname
-                self.cal = icx.get_named_calendar(cname)
-                if not self.cal:
-                    self.cal = icx.create_calendar(cname)
+                self.cal = self._icloud_calendar(icloudcalendar)
                 self.logger.warn("using icloud")
             except Exception as e:
-                self.logger.exception("using icloud dummy connector")
-
-                class Dummy(object):
-                    def add_event(self, *args, **kwargs):
-                        pass
-
-                self.cal = Dummy()
-
-    def _write_icalendar(self, calend):
+                self.logger.exception("icloud calendar unavailable")
+                # not tried again within this run, nothing is uploaded
+                self.cal = False
+
+    def _icloud_calendar(self, icloudcalendar):
+        """Get the icloud calendar, discovering its url only if needed"""
+        account = self.user.icalendar
+        ttl = datetime.timedelta(hours=self.cfg.getint("calendar", "discoveryttl"))
+        if not account.needs_discovery(ttl):
+            icx = icloudcalendar.iCloudConnector(
+                account.icloud_user,
+                account.password,
+                principal_path=account.principal_path,
+                calendar_home_set_url=account.home_set_url,
+            )
+            return icx.calendar(account.calendar_url)
+        self.logger.info("discovering icloud calendar")
+        icx = icloudcalendar.iCloudConnector(account.icloud_user, account.password)
+        cname = account.calendarname
+        cal = icx.get_named_calendar(cname)
+        if not cal:
+            cal = icx.create_calendar(cname)
+        account.principal_path = icx.principal_path
+        account.home_set_url = icx.calendar_home_set_url
+        account.calendar_url = cal.url
+        account.discovered_at = datetime.datetime.now()
+        return cal
+
+    def _sync_icalendar(self, entries):
+        """Upload calendar entries to icloud, returns the failed ones"""
+        from icalendar import Calendar
+        from infomentor import icloudcalendar
+
+        self._setup_icloudconnector()
+        if not isinstance(self.cal, icloudcalendar.Calendar):
+            # nothing was uploaded, the entries are retried later
+            error = Exception("icloud calendar unavailable")
+            return {entry: error for entry in entries}
+        events = [
+            (
+                entry.calendar_id,
+                Calendar.from_ical(entry.ical).to_ical(),
+                entry.etag,
+                entry.synced_hash != entry.hash,
+            )
+            for entry in entries
+        ]
+        workers = self.cfg.getint("calendar", "workers")
         try:
+            results = icloudcalendar.CalendarSync(self.cal, workers).sync(events)
+        except icloudcalendar.DiscoveryError as e:
+            self.logger.info("icloud calendar moved, discovering again: %s", e)
+            self.user.icalendar.forget_discovery()
+            self.cal = None
             self._setup_icloudconnector()
-            self.cal.add_event(calend.to_ical())
-        except Exception as e:
-            self.logger.exception("Calendar failed")
+            results = icloudcalendar.CalendarSync(self.cal, workers).sync(events)
+        failed = {}
+        for entry in entries:
+            result = results.get(entry.calendar_id)
+            if isinstance(result, Exception):
+                self.logger.error("Calendar failed", exc_info=result)
+                failed[entry] = result
+            elif result is not None:
+                entry.href, entry.etag = result
+                entry.synced_hash = entry.hash
+        return failed
+
+    def _calendar_fingerprint(self, entry):
+        """Fingerprint of the list level information of a calendar entry"""
+        listinfo = [entry["id"], entry["title"], entry["start"], entry["end"]]
+        return hashlib.sha1(json.dumps(listinfo).encode("utf-8")).hexdigest()
+
+    def _is_stored_event(self, calendarentry, entry):
+        """Check if the stored event has the title and times of a list entry"""
+        from icalendar import Calendar
+
+        try:
+            event = Calendar.from_ical(calendarentry.ical).walk("VEVENT")[0]
+            stored = [event.decoded("dtstart"), event.decoded("dtend")]
+            title = str(event["summary"])
+        except Exception:
+            return False
+        if title != entry["title"]:
+            return False
+        for value, listed in zip(stored, [entry["start"], entry["end"]]):
+            listed = dates.parse(listed)
+            if listed is None:
+                return False
+            if not isinstance(value, datetime.datetime):
+                listed = listed.date()
+            if value != listed:
+                return False
+        return True
+
+    def deliver_calendar(self, entries):
+        """Write calendar entries to icloud and/or send the invitations
+
+        The icloud uploads of all entries run as one batch. Returns the
+        entries which failed with their exceptions, an entry already
+        uploaded is not uploaded again when it is retried. With a batch
+        invitation all entries are sent in one mail."""
+        failed = {}
+        if self.user.icalendar is not None:
+            try:
+                failed.update(self._sync_icalendar(entries))
+            except Exception as e:
+                self.logger.exception("Calendar failed")
+                failed.update((entry, e) for entry in entries)
+        invitation = self.user.invitation
+        if invitation is not None:
+            pending = [entry for entry in entries if entry not in failed]
+            if invitation.batch:
+                batches = [pending] if pending else []
+            else:
+                batches = [[entry] for entry in pending]
+            for batch in batches:
+                try:
+                    self._send_invitation(batch, invitation.email)
+                except Exception as e:
+                    self.logger.exception("sending invitation failed")
+                    failed.update((entry, e) for entry in batch)
+        return failed
 
     def update_calendar(self):
-        session = db.get_db()
-        if self.user.icalendar is None and self.user.invitation is None:
+        session = self.session
+        if (
+            self.user.icalendar is None
+            and self.user.invitation is None
+            and self.user.feed_token is None
+        ):
             return
         try:
+            state = self._sync_state("Calendar")
+            session.commit()
             calentries = self.im.get_calendar()
+            if self._unchanged(state, "Calendar"):
+                self._update_calendar_feed(changed=False)
+                return
+            stored = {
+                calendarentry.calendar_id: calendarentry
+                for calendarentry in session.query(model.CalendarEntry).with_parent(
+                    self.user, "calendarentries"
+                )
+            }
+            session.commit()
+            failed = False
+            changed = False
+            uids = set()
+            fetched = []
             for entry in calentries:
                 self.logger.debug(entry)
                 uid = str(
                     uuid.uuid5(uuid.NAMESPACE_URL, "infomentor_{}".format(entry["id"]))
                 )
-                event_details = self.im.get_event(entry["id"])
-                calend = Calendar()
-                event = Event()
-                event.add("uid", uid)
-                event.add("summary", entry["title"])
-                event.add("categories", ['Jules Verne Campus', 'Schule'])
-                event.add("dtstamp", datetime.datetime.now())
-                if not event_details["allDayEvent"]:
-                    event.add("dtstart", dateparser.parse(entry["start"]))
-                    event.add("dtend", dateparser.parse(entry["end"]))
-                else:
-                    event.add("dtstart", dateparser.parse(entry["start"]).date())
-                    event.add("dtend", dateparser.parse(entry["end"]).date())
-
-                description = event_details["notes"]
-                eventinfo = event_details["info"]
-                new_cal_entry = calend.to_ical().replace(b"\r", b"")
-                new_cal_hash = hashlib.sha1(new_cal_entry).hexdigest()
-                for res in eventinfo["resources"]:
-                    f = self.im.download_file(res["url"], directory="files")
-                    description += """\nAttachment {0}: {2}/{1}""".format(
-                        res["title"], urllib.parse.quote(f), cfg["general"]["baseurl"]
+                uids.add(uid)
+                fingerprint = self._calendar_fingerprint(entry)
+                calendarentry = stored.get(uid)
+                if (
+                    calendarentry is not None
+                    and calendarentry.fingerprint == fingerprint
+                ):
+                    self.logger.debug("calendar entry UNCHANGED {}".format(uid))
+                    continue
+                if (
+                    calendarentry is not None
+                    and calendarentry.fingerprint is None
+                    and self._is_stored_event(calendarentry, entry)
+                ):
+                    # stored before the fingerprint was kept
+                    self.logger.debug("calendar entry ADOPTED {}".format(uid))
+                    calendarentry.fingerprint = fingerprint
+                    continue
+
+                try:
+                    calend, new_cal_hash, attachments = self._make_calendar_entry(
+                        uid, entry
                     )
-                event.add("description", description)
-
-                calend.add_component(event)
+                except Exception as e:
+                    self.logger.exception("fetching calendar entry %s failed", uid)
+                    failed = True
+                    continue
                 new_cal_entry = calend.to_ical().replace(b"\r", b"")
-                session = db.get_db()
                 storedata = {
                     "calendar_id": uid,
+                    "title": entry["title"],
                     "ical": new_cal_entry,
                     "hash": new_cal_hash,
+                    "fingerprint": fingerprint,
+                    "attachments": attachments,
                 }
-                calendarentry = (
-                    session.query(model.CalendarEntry)
-                    .filter(model.CalendarEntry.calendar_id == uid)
-                    .with_parent(self.user, "calendarentries")
-                    .one_or_none()
-                )
                 if calendarentry is not None:
                     if calendarentry.hash == new_cal_hash:
                         self.logger.info("calendar entry UNCHANGED {}".format(uid))
+                        calendarentry.fingerprint = fingerprint
                         continue
-                    else:
-                        self.logger.info("calendar entry UPDATED {}".format(uid))
-                        for key, value in storedata.items():
-                            setattr(calendarentry, key, value)
-
+                    self.logger.info("calendar entry UPDATED {}".format(uid))
+                    fetched.append((calendarentry, storedata))
                 else:
                     self.logger.info("calendar entry NEW {}".format(uid))
-                    calendarentry = model.CalendarEntry(**storedata)
-
+                    fetched.append((model.CalendarEntry(**storedata), None))
                 self.logger.debug(new_cal_entry.decode("utf-8"))
-                if self.user.icalendar is not None:
-                    self._write_icalendar(calend)
-                if self.user.invitation is not None:
-                    self._send_invitation(calend, self.user.invitation.email)
-                self.user.calendarentries.append(calendarentry)
-                session.commit()
+                changed = True
+                if len(fetched) >= self.commit_batch and not self._store(fetched):
+                    failed = True
+            if not self._store(fetched):
+                failed = True
+            removed, complete = self._reconcile_calendar(uids)
+            if removed:
+                changed = True
+            if not failed and complete:
+                state.fingerprint = self.im.fingerprints.get("Calendar")
+            session.commit()
+            self._update_calendar_feed(changed)
         except Exception as e:
             self.logger.exception("Calendar failed")
+            session.rollback()
+
+    def _reconcile_calendar(self, uids):
+        """Remove the stored entries which are no longer listed by infomentor
+
+        uids are the ids of all listed entries. Only entries within the
+        school year covered by the list are removed, first from icloud, all
+        at once, then from the database. Returns the number removed and
+        whether all vanished entries were handled, the list is only marked
+        as synced then. An empty list removes nothing, it is rather a glitch
+        of infomentor than an empty school year."""
+        from icalendar import Calendar
+        from infomentor import icloudcalendar
+
+        stored = {
+            calendar_id: entry_id
+            for entry_id, calendar_id in self.session.query(
+                model.CalendarEntry.id, model.CalendarEntry.calendar_id
+            ).filter(model.CalendarEntry.user_id == self.user.id)
+        }
+        vanished = stored.keys() - uids
+        if not vanished:
+            return 0, True
+        if not uids:
+            self.logger.warning("empty calendar, keeping all entries")
+            return 0, False
+        listed = self.im._get_calendar_dates()
+        start = dates.parse(listed["start"]).date()
+        end = dates.parse(listed["end"]).date()
+        orphans = []
+        for calendar_id in vanished:
+            entry = self.session.query(model.CalendarEntry).get(stored[calendar_id])
+            event = Calendar.from_ical(entry.ical).walk("VEVENT")[0]
+            dtstart = event.decoded("dtstart")
+            if isinstance(dtstart, datetime.datetime):
+                dtstart = dtstart.date()
+            if start <= dtstart <= end:
+                orphans.append(entry)
+        if not orphans:
+            return 0, True
+        if self.user.icalendar is not None:
+            # the deletions run without a transaction, the entries are
+            # removed in a new one
+            self.session.commit()
+            self._setup_icloudconnector()
+            if not isinstance(self.cal, icloudcalendar.Calendar):
+                self.logger.warning("icloud unavailable, keeping vanished entries")
+                return 0, False
+            urls = {
+                entry: entry.href or self.cal.event_url(entry.calendar_id)
+                for entry in orphans
+            }
+            sync = icloudcalendar.CalendarSync(
+                self.cal, self.cfg.getint("calendar", "workers")
+            )
+            failed = sync.delete(list(urls.values()))
+            for url, e in failed.items():
+                self.logger.error("deleting %s failed", url, exc_info=e)
+            orphans = [entry for entry in orphans if urls[entry] not in failed]
+        else:
+            failed = {}
+        for entry in orphans:
+            self.logger.info("calendar entry DELETED {}".format(entry.calendar_id))
+            filestorage.remove_references(self.session, entry.attachments)
+            self.session.delete(entry)
+        return len(orphans), not failed
+
+    def _update_calendar_feed(self, changed):
+        """Store all calendar entries of the user as the ics feed
+
+        The feed is only built again if entries changed, or if it is
+        missing."""
+        if self.user.feed_token is None:
+            return
+        if not changed and self.user.calendarfeed is not None:
+            return
+        from icalendar import Calendar
+        from infomentor import icalendar_addons
+
+        calobj = Calendar()
+        calobj.add("PRODID", "-// infomentor_py /")
+        calobj.add("calscale", "GREGORIAN")
+        calobj.add("version", "2.0")
+        calobj.add("X-WR-CALNAME", "Infomentor {}".format(self.user.name))
+        vtimezone = icalendar_addons.generate_vtimezone("Europe/Berlin")
+        if vtimezone is not None:
+            calobj.add_component(vtimezone)
+        entries = (
+            self.session.query(model.CalendarEntry)
+            .with_parent(self.user, "calendarentries")
+            .order_by(model.CalendarEntry.calendar_id)
+        )
+        for entry in entries:
+            for event in Calendar.from_ical(entry.ical).walk("VEVENT"):
+                calobj.add_component(event)
+        ical = calobj.to_ical()
+        etag = hashlib.sha1(ical).hexdigest()
+        feed = self.user.calendarfeed
+        if feed is None:
+            feed = self.user.calendarfeed = model.CalendarFeed()
+        if feed.etag != etag:
+            self.logger.info("calendar feed changed")
+            feed.ical = ical
+            feed.etag = etag
+            feed.modified = datetime.datetime.utcnow().replace(microsecond=0)
+        self.session.commit()
+
+    def _make_calendar_entry(self, uid, entry):
+        """Build the calendar for an entry
+
+        Returns it with its content hash and the attachments of the
+        downloaded resources."""
+        from icalendar import Calendar, Event
+
+        event_details = self.im.get_event(entry["id"])
+        calend = Calendar()
+        event = Event()
+        event.add("uid", uid)
+        event.add("summary", entry["title"])
+        event.add("categories", ['Jules Verne Campus', 'Schule'])
+        if not event_details["allDayEvent"]:
+            event.add("dtstart", dates.parse(entry["start"]))
+            event.add("dtend", dates.parse(entry["end"]))
+        else:
+            event.add("dtstart", dates.parse(entry["start"]).date())
+            event.add("dtend", dates.parse(entry["end"]).date())
+
+        description = event_details["notes"]
+        eventinfo = event_details["info"]
+        attachments = self.im.get_event_resources(eventinfo["resources"])
+        for attachment in attachments:
+            if attachment.localpath is None:
+                url = self.im._mim_url(attachment.url)
+            else:
+                url = "{}/{}".format(
+                    self.cfg["general"]["baseurl"],
+                    urllib.parse.quote(attachment.localpath),
+                )
+            description += """\nAttachment {0}: {1}""".format(attachment.title, url)
+        event.add("description", description)
+        calend.add_component(event)
+
+        # hash the content before the dtstamp is added, which changes every run
+        new_cal_hash = hashlib.sha1(calend.to_ical().replace(b"\r", b"")).hexdigest()
+        event.add("dtstamp", datetime.datetime.now())
+        return calend, new_cal_hash, attachments
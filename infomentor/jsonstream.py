@@ -0,0 +1,108 @@
+import codecs
+import json
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+# the characters a number can continue with, e.g. "1." or "1e" cut at a chunk end
+_number = "0123456789.eE+-"
+
+
+class _Reader(object):
+    """Incrementally decoded text of a chunked json document"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._exhausted = False
+        self.buffer = ""
+        self.pos = 0
+
+    def _fill(self):
+        """Append the next chunk to the buffer, returns False at the end"""
+        if self._exhausted:
+            return False
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self.buffer = self.buffer[self.pos :] + text
+                self.pos = 0
+                return True
+        self._exhausted = True
+        self.buffer = self.buffer[self.pos :] + self._decoder.decode(b"", final=True)
+        self.pos = 0
+        return False
+
+    def _error(self, msg):
+        return json.JSONDecodeError(msg, self.buffer, self.pos)
+
+    def peek(self):
+        """Get the next non whitespace character without consuming it"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise self._error("Unexpected end of data")
+
+    def take(self):
+        """Consume the next non whitespace character"""
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def expect(self, char):
+        if self.take() != char:
+            self.pos -= 1
+            raise self._error("Expecting '{}'".format(char))
+
+    def value(self):
+        """Decode the next complete json value"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer might continue in the next chunk
+            if not self.buffer[end:].lstrip(_number) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_items(chunks, key="items"):
+    """Yield the elements of the array stored under key in a json object
+
+    chunks is an iterable of bytes, e.g. response.iter_content(). Only the
+    current element is kept in memory, so the caller can start working on the
+    first elements and stop early without the whole document being read."""
+    reader = _Reader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        name = reader.value()
+        reader.expect(":")
+        if name != key:
+            reader.value()
+        else:
+            reader.expect("[")
+            if reader.peek() == "]":
+                return
+            while True:
+                yield reader.value()
+                separator = reader.take()
+                if separator == "]":
+                    return
+                if separator != ",":
+                    reader.pos -= 1
+                    raise reader._error("Expecting ',' delimiter")
+        separator = reader.take()
+        if separator == "}":
+            return
+        if separator != ",":
+            reader.pos -= 1
+            raise reader._error("Expecting ',' delimiter")
@@ -0,0 +1,225 @@
+import base64
+import contextlib
+import email.generator
+import email.utils
+import io
+import logging
+import mimetypes
+import queue
+import re
+import smtplib
+import socket
+import threading
+import uuid
+from email.mime.base import MIMEBase
+from infomentor import config
+
+_logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# base64 encodes 57 bytes into one line of 76 characters
+ENCODE_CHUNK = 57 * 1024
+_leading_dot = re.compile(rb"^\.", re.MULTILINE)
+
+
+def encoded_size(size):
+    """Upper bound of the size of size bytes encoded into base64 lines"""
+    return (size + 56) // 57 * 78
+
+
+class StreamedMail(object):
+    """A mail whose attachments are only read and encoded while sending
+
+    Attached files are represented by a marker in the message, when the mail
+    is sent the markers are replaced by the encoded file, chunk by chunk. So
+    no complete copy of an attachment is held in memory."""
+
+    def __init__(self, message):
+        self.message = message
+        self.files = {}
+
+    def attach_file(self, path, filename):
+        ctype, encoding = mimetypes.guess_type(path)
+        if ctype is None or encoding is not None:
+            ctype = "application/octet-stream"
+        maintype, subtype = ctype.split("/", 1)
+        marker = uuid.uuid4().hex
+        part = MIMEBase(maintype, subtype)
+        part.set_payload(marker)
+        part["Content-Transfer-Encoding"] = "base64"
+        part.add_header("Content-Disposition", "attachment", filename=filename)
+        self.message.attach(part)
+        self.files[marker.encode("ascii")] = path
+
+    def _skeleton(self):
+        fp = io.BytesIO()
+        generator = email.generator.BytesGenerator(
+            fp, policy=self.message.policy.clone(linesep="\r\n")
+        )
+        generator.flatten(self.message)
+        return fp.getvalue()
+
+    def _encode_file(self, path):
+        with open(path, "rb") as fp:
+            while True:
+                data = fp.read(ENCODE_CHUNK)
+                if not data:
+                    return
+                yield base64.encodebytes(data).replace(b"\n", b"\r\n")
+
+    def chunks(self):
+        """Yield the dot-stuffed mail data, ready to be sent after DATA"""
+        skeleton = self._skeleton()
+        if not skeleton.endswith(b"\r\n"):
+            skeleton += b"\r\n"
+        pos = 0
+        if self.files:
+            markers = re.compile(b"(" + b"|".join(self.files) + b")\r\n")
+            for match in markers.finditer(skeleton):
+                yield _leading_dot.sub(b"..", skeleton[pos : match.start()])
+                # base64 lines never start with a dot
+                yield from self._encode_file(self.files[match.group(1)])
+                pos = match.end()
+        yield _leading_dot.sub(b"..", skeleton[pos:])
+
+
+class _Connection(object):
+    """An authenticated SMTP connection and the number of mails sent over it"""
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.sent = 0
+        self.broken = False
+
+    def quit(self):
+        with contextlib.suppress(Exception):
+            self.smtp.quit()
+
+
+class SMTPPool(object):
+    """Reuses authenticated SMTP connections for many messages
+
+    At most size connections are open at once. A connection is closed after
+    maxmessages mails and replaced on demand. If a connection turns out to be
+    dead, the message is sent again over a fresh one."""
+
+    retry_errors = (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout)
+
+    def __init__(self, server, username, password, size=2, maxmessages=50):
+        self.server = server
+        self.username = username
+        self.password = password
+        self.maxmessages = maxmessages
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        _logger.info("connecting to %s", self.server)
+        smtp = smtplib.SMTP_SSL(self.server)
+        smtp.login(self.username, self.password)
+        return _Connection(smtp)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection, it is returned to the pool afterwards"""
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except Exception:
+                conn.broken = True
+                raise
+            finally:
+                if conn.broken or conn.sent >= self.maxmessages:
+                    conn.quit()
+                else:
+                    self._idle.put(conn)
+
+    def send_message(self, mail, *args, **kwargs):
+        """Send a mail, reconnecting once if the connection was lost"""
+        for attempt in range(2):
+            try:
+                with self.connection() as conn:
+                    conn.smtp.send_message(mail, *args, **kwargs)
+                    conn.sent += 1
+                    return
+            except self.retry_errors:
+                if attempt:
+                    raise
+                _logger.warning("smtp connection lost, reconnecting")
+
+    def send_streamed(self, mail):
+        """Send a StreamedMail, writing it to the server chunk by chunk"""
+        message = mail.message
+        sender = email.utils.getaddresses([message["From"]])[0][1]
+        recipients = [
+            address
+            for name, address in email.utils.getaddresses(message.get_all("To", []))
+        ]
+        for attempt in range(2):
+            try:
+                with self.connection() as conn:
+                    self._transmit(conn.smtp, sender, recipients, mail)
+                    conn.sent += 1
+                    return
+            except self.retry_errors:
+                if attempt:
+                    raise
+                _logger.warning("smtp connection lost, reconnecting")
+
+    def _transmit(self, smtp, sender, recipients, mail):
+        code, resp = smtp.mail(sender)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, sender)
+        for recipient in recipients:
+            code, resp = smtp.rcpt(recipient)
+            if code not in (250, 251):
+                raise smtplib.SMTPRecipientsRefused({recipient: (code, resp)})
+        smtp.putcmd("data")
+        code, resp = smtp.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        for chunk in mail.chunks():
+            smtp.send(chunk)
+        smtp.send(b".\r\n")
+        code, resp = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().quit()
+            except queue.Empty:
+                return
+
+
+def get_pool():
+    """Get the SMTP pool of this run, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            cfg = config.load()
+            _pool = SMTPPool(
+                cfg["smtp"]["server"],
+                cfg["smtp"]["username"],
+                cfg["smtp"]["password"],
+                size=cfg.getint("smtp", "poolsize"),
+                maxmessages=cfg.getint("smtp", "maxmessages"),
+            )
+        return _pool
+
+
+def close_pool():
+    """Close the connections at the end of the run"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -1,17 +1,23 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, ForeignKey, Enum, DateTime, Boolean
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    Enum,
+    DateTime,
+    Boolean,
+    Index,
+)
 from sqlalchemy.orm import relationship
-from Crypto.Cipher import AES
 import base64
+import datetime
 import enum
 import hashlib
 from infomentor import config
 
-cfg = config.load()
-
 ModelBase = declarative_base()
 
-_PASSWORD_SECRET_KEY = cfg["general"]["secretkey"]
 BS = 16
 
 
@@ -30,7 +36,7 @@ class User(ModelBase):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, index=True)
     enc_password = Column(String)
     notification = relationship("Notification", back_populates="user", uselist=False)
     apistatus = relationship("ApiStatus", back_populates="user", uselist=False)
@@ -40,6 +46,10 @@ class User(ModelBase):
     homeworks = relationship("Homework", back_populates="user")
     news = relationship("News", back_populates="user")
     calendarentries = relationship("CalendarEntry", back_populates="user", uselist=True)
+    syncstates = relationship("SyncState", back_populates="user")
+    # secret part of the url of the calendar feed, no feed without it
+    feed_token = Column(String, unique=True)
+    calendarfeed = relationship("CalendarFeed", back_populates="user", uselist=False)
 
     def __init__(self, *args, **kwargs):
         self._setup_cipher()
@@ -47,7 +57,10 @@ class User(ModelBase):
 
     def _setup_cipher(self):
         if not hasattr(self, "cipher"):
-            aeskey = hashlib.sha256(_PASSWORD_SECRET_KEY.encode()).digest()
+            from Crypto.Cipher import AES
+
+            secretkey = config.load()["general"]["secretkey"]
+            aeskey = hashlib.sha256(secretkey.encode()).digest()
             self.cipher = AES.new(aeskey, AES.MODE_ECB)
 
     @property
@@ -85,6 +98,10 @@ class Notification(ModelBase):
     user_id = Column(Integer, ForeignKey("users.id"))
     ntype = Column(Enum(Types))
     info = Column(String)
+    # collect news and homework into one message, sent once the oldest
+    # collected item is digestwindow minutes old (0: once per run)
+    digest = Column(Boolean, default=False)
+    digestwindow = Column(Integer, default=0)
     user = relationship("User", back_populates="notification")
 
     def __repr__(self):
@@ -92,7 +109,7 @@ class Notification(ModelBase):
 
 
 class Attachment(ModelBase):
-    """General attachment type for homework and news"""
+    """General attachment type for homework, news and calendar entries"""
 
     __tablename__ = "attachments"
 
@@ -102,17 +119,52 @@ class Attachment(ModelBase):
     url = Column(String)
     title = Column(String)
     localpath = Column(String)
-    news_id = Column(Integer, ForeignKey("news.id"))
-    homework_id = Column(Integer, ForeignKey("homework.id"))
+    sha256 = Column(String)
+    size = Column(Integer)
+    news_id = Column(Integer, ForeignKey("news.id"), index=True)
+    homework_id = Column(Integer, ForeignKey("homework.id"), index=True)
+    calendarentry_id = Column(Integer, ForeignKey("calendarentries.id"), index=True)
 
     news = relationship("News", back_populates="attachments")
     homework = relationship("Homework", back_populates="attachments")
+    calendarentry = relationship("CalendarEntry", back_populates="attachments")
+
+
+class Blob(ModelBase):
+    """A stored file content, shared by all attachments with the same content"""
+
+    __tablename__ = "blobs"
+
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String, unique=True)
+    size = Column(Integer)
+    refcount = Column(Integer, default=0)
+
+    def __repr__(self):
+        return "<Blob(sha256='%s', refcount='%d')>" % (self.sha256, self.refcount)
+
+
+class CachedFile(ModelBase):
+    """A download shared by all users, keyed by the infomentor id of the file"""
+
+    __tablename__ = "cached_files"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String, unique=True)
+    filename = Column(String)
+    sha256 = Column(String)
+    size = Column(Integer)
+    fetched = Column(DateTime)
+
+    def __repr__(self):
+        return "<CachedFile(key='%s', sha256='%s')>" % (self.key, self.sha256)
 
 
 class News(ModelBase):
     """A News entry"""
 
     __tablename__ = "news"
+    __table_args__ = (Index("ix_news_user_id_news_id", "user_id", "news_id", "date"),)
 
     id = Column(Integer, primary_key=True)
     news_id = Column(Integer)
@@ -138,13 +190,28 @@ class CalendarEntry(ModelBase):
     """A News entry"""
 
     __tablename__ = "calendarentries"
+    __table_args__ = (
+        Index("ix_calendarentries_user_id_calendar_id", "user_id", "calendar_id"),
+    )
 
     id = Column(Integer, primary_key=True)
-    calendar_id = Column(Integer)
+    calendar_id = Column(String)
     title = Column(String)
     user_id = Column(Integer, ForeignKey("users.id"))
     ical = Column(String)
     hash = Column(String)
+    fingerprint = Column(String)
+    # the event on the icloud calendar, synced_hash is the uploaded content
+    href = Column(String)
+    etag = Column(String)
+    synced_hash = Column(String)
+    # the resources linked in the description, replaced on every change
+    attachments = relationship(
+        "Attachment",
+        order_by=Attachment.id,
+        back_populates="calendarentry",
+        cascade="all, delete-orphan",
+    )
     user = relationship("User", back_populates="calendarentries")
 
     def __repr__(self):
@@ -159,6 +226,7 @@ class Homework(ModelBase):
     """A homework entry"""
 
     __tablename__ = "homework"
+    __table_args__ = (Index("ix_homework_user_id_homework_id", "user_id", "homework_id"),)
 
     id = Column(Integer, primary_key=True)
     homework_id = Column(Integer)
@@ -174,6 +242,41 @@ class Homework(ModelBase):
     user = relationship("User", back_populates="homeworks")
 
 
+class OutboxMessage(ModelBase):
+    """A notification about a stored item, waiting to be delivered
+
+    The key identifies the notification, it is queued only once while it is
+    not sent. A change back to an earlier version queues it again."""
+
+    __tablename__ = "outbox"
+    __table_args__ = (
+        Index("ix_outbox_sent_user_id", "sent", "user_id"),
+        Index("ix_outbox_key_sent", "key", "sent"),
+    )
+
+    class Kinds(enum.Enum):
+        """The item types a notification refers to"""
+
+        NEWS = 1
+        HOMEWORK = 2
+        CALENDAR = 3
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    kind = Column(Enum(Kinds))
+    item_id = Column(Integer)
+    key = Column(String)
+    created = Column(DateTime, default=datetime.datetime.now)
+    attempts = Column(Integer, default=0)
+    next_attempt = Column(DateTime, default=datetime.datetime.now)
+    sent = Column(DateTime)
+    error = Column(String)
+    user = relationship("User")
+
+    def __repr__(self):
+        return "<OutboxMessage(key='%s', attempts='%d')>" % (self.key, self.attempts)
+
+
 class ApiStatus(ModelBase):
     """Representing the result of the last trys to access the api, represented as one status"""
 
@@ -199,6 +302,52 @@ class ApiStatus(ModelBase):
         )
 
 
+class CalendarFeed(ModelBase):
+    """The calendar entries of a user as one ics file, served by the webserver"""
+
+    __tablename__ = "calendar_feeds"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), unique=True)
+    ical = Column(String)
+    etag = Column(String)
+    modified = Column(DateTime)
+    user = relationship("User", back_populates="calendarfeed")
+
+    def __repr__(self):
+        return "<CalendarFeed(etag='%s', modified='%s')>" % (self.etag, self.modified)
+
+
+class SyncState(ModelBase):
+    """The progress of the incremental synchronisation of one endpoint of a user
+
+    Besides the watermark of list endpoints, the fingerprint of the last
+    processed response is kept to skip unchanged endpoints completely."""
+
+    __tablename__ = "sync_state"
+    __table_args__ = (Index("ix_sync_state_user_id_endpoint", "user_id", "endpoint"),)
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    endpoint = Column(String)
+    watermark = Column(String)
+    last_full_sync = Column(DateTime)
+    fingerprint = Column(String)
+    user = relationship("User", back_populates="syncstates")
+
+    def needs_full_sync(self, interval):
+        """Check if the last full synchronisation is older than interval"""
+        if self.last_full_sync is None or self.watermark is None:
+            return True
+        return datetime.datetime.now() - self.last_full_sync > interval
+
+    def __repr__(self):
+        return "<SyncState(endpoint='%s', watermark='%s')>" % (
+            self.endpoint,
+            self.watermark,
+        )
+
+
 class ICloudCalendar(ModelBase):
     """An icloud account with a calendar name"""
 
@@ -209,6 +358,11 @@ class ICloudCalendar(ModelBase):
     icloud_user = Column(String)
     icloud_pwd = Column(String)
     calendarname = Column(String)
+    # cached caldav discovery, repeated after the ttl or if a url is rejected
+    principal_path = Column(String)
+    home_set_url = Column(String)
+    calendar_url = Column(String)
+    discovered_at = Column(DateTime)
     user = relationship("User", back_populates="icalendar", uselist=False)
 
     def __init__(self, *args, **kwargs):
@@ -217,7 +371,10 @@ class ICloudCalendar(ModelBase):
 
     def _setup_cipher(self):
         if not hasattr(self, "cipher"):
-            aeskey = hashlib.sha256(_PASSWORD_SECRET_KEY.encode()).digest()
+            from Crypto.Cipher import AES
+
+            secretkey = config.load()["general"]["secretkey"]
+            aeskey = hashlib.sha256(secretkey.encode()).digest()
             self.cipher = AES.new(aeskey, AES.MODE_ECB)
 
     @property
@@ -232,6 +389,18 @@ class ICloudCalendar(ModelBase):
         encoded = base64.b64encode(self.cipher.encrypt(pad(value)))
         self.icloud_pwd = encoded
 
+    def needs_discovery(self, ttl):
+        """Check if the discovered urls are missing or older than ttl"""
+        if self.calendar_url is None or self.discovered_at is None:
+            return True
+        return datetime.datetime.now() - self.discovered_at >= ttl
+
+    def forget_discovery(self):
+        self.principal_path = None
+        self.home_set_url = None
+        self.calendar_url = None
+        self.discovered_at = None
+
     def __repr__(self):
         return "<ICloudCalendar(user='%s' cal='%s')>" % (
             self.icloud_user,
@@ -247,6 +416,8 @@ class Invitation(ModelBase):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     email = Column(String)
+    # send all new or changed entries of a run in one mail
+    batch = Column(Boolean, default=False)
     user = relationship("User", back_populates="invitation", uselist=False)
 
     def __init__(self, *args, **kwargs):
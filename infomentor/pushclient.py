@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from infomentor import config
+
+_logger = logging.getLogger(__name__)
+
+API_URL = "https://api.pushover.net/1/messages.json"
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class PushoverError(Exception):
+    """Pushover rejected a message"""
+
+
+class RateLimited(PushoverError):
+    """The app is (close to) its monthly message limit, retry after reset"""
+
+    def __init__(self, reset):
+        super().__init__("pushover limit reached, resets at {}".format(reset))
+        self.reset = reset
+
+
+class PushoverClient(object):
+    """Sends Pushover messages over one pooled keep-alive session
+
+    The remaining quota reported by Pushover is tracked. Once it drops to
+    reserve messages, sending is refused with RateLimited until the limit
+    resets, so the outbox defers the messages instead of burning the rest."""
+
+    def __init__(self, token, reserve=0, poolsize=10):
+        self.token = token
+        self.reserve = reserve
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize)
+        self.session.mount("https://", adapter)
+        self.remaining = None
+        self.reset = None
+        self._lock = threading.Lock()
+
+    def _check_quota(self):
+        with self._lock:
+            if self.remaining is None or self.remaining > self.reserve:
+                return
+            if self.reset is not None and time.time() >= self.reset:
+                self.remaining = None
+                return
+            raise RateLimited(self.reset)
+
+    def _update_quota(self, headers):
+        with self._lock:
+            if "X-Limit-App-Remaining" in headers:
+                self.remaining = int(headers["X-Limit-App-Remaining"])
+            if "X-Limit-App-Reset" in headers:
+                self.reset = int(headers["X-Limit-App-Reset"])
+        if self.remaining is not None:
+            _logger.debug("pushover quota remaining: %d", self.remaining)
+
+    def send_message(
+        self, user, message, title=None, html=False, timestamp=None, attachment=None
+    ):
+        """Send a message to user, attachment is an opened image file"""
+        self._check_quota()
+        data = {"token": self.token, "user": user, "message": message}
+        if title is not None:
+            data["title"] = title
+        if html:
+            data["html"] = 1
+        if timestamp is not None:
+            data["timestamp"] = timestamp
+        files = None
+        if attachment is not None:
+            files = {"attachment": ("image", attachment)}
+        r = self.session.post(API_URL, data=data, files=files, timeout=30)
+        self._update_quota(r.headers)
+        if r.status_code == 429:
+            raise RateLimited(self.reset)
+        try:
+            result = r.json()
+        except ValueError:
+            raise PushoverError("invalid response ({})".format(r.status_code))
+        if r.status_code != 200 or result.get("status") != 1:
+            raise PushoverError(", ".join(result.get("errors", [])) or r.status_code)
+        return result
+
+
+def get_client():
+    """Get the Pushover client of this process, created on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            cfg = config.load()
+            _client = PushoverClient(
+                cfg["pushover"]["apikey"], reserve=cfg.getint("pushover", "reserve")
+            )
+        return _client
@@ -1,11 +1,16 @@
 from infomentor import model, db
-from flask import Flask, render_template, redirect, url_for, request
+from flask import Flask, render_template, redirect, url_for, request, abort
 from flask_bootstrap import Bootstrap
 
 app = Flask(__name__)
 Bootstrap(app)
 
 
+@app.teardown_appcontext
+def remove_session(exception=None):
+    db.remove_session()
+
+
 @app.route("/")
 def home():
     return render_template("notfound.html")
@@ -47,5 +52,25 @@ def create():
     return "success"
 
 
+@app.route("/calendar/<token>.ics")
+def calendar_feed(token):
+    # polled by every subscribed calendar, must not wait for a run
+    session = db.get_db(readonly=True)
+    feed = (
+        session.query(model.CalendarFeed)
+        .join(model.User)
+        .filter(model.User.feed_token == token)
+        .one_or_none()
+    )
+    if feed is None:
+        abort(404)
+    response = app.response_class(feed.ical, mimetype="text/calendar")
+    response.set_etag(feed.etag)
+    response.last_modified = feed.modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -18,11 +18,9 @@ setup(
         "request",
         "sqlalchemy",
         "dateparser",
-        "python-pushover",
         "flask",
         "flask-bootstrap",
-        "caldav",
-        "bs4",
         "icalendar",
+        "aiohttp",
     ],
 )
@@ -0,0 +1,264 @@
+import collections
+import hashlib
+import http.server
+import json
+import sqlite3
+import threading
+import time
+import urllib.parse
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+from infomentor import config, db, model, pushclient
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory, with the default config written there"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, "_config", None)
+    return tmp_path
+
+
+@pytest.fixture
+def database(workdir, monkeypatch):
+    """The engine of a sqlite database file in the working directory"""
+    monkeypatch.setattr(db, "_engine", None)
+    monkeypatch.setattr(db, "_sessionmaker", None)
+    monkeypatch.setattr(db, "_scoped_session", None)
+    monkeypatch.setattr(db, "_scoped_readsession", None)
+    engine = db.get_engine(str(workdir / "infomentor.db"))
+    yield engine
+    db.remove_session()
+    engine.dispose()
+
+
+def is_locked(path):
+    """Check if a transaction holds the write lock of the sqlite database"""
+    conn = sqlite3.connect(path, timeout=0)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.rollback()
+        return False
+    except sqlite3.OperationalError:
+        return True
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def database_locked(database, workdir):
+    """Check if the database of the test is locked at the moment"""
+    return lambda: is_locked(str(workdir / "infomentor.db"))
+
+
+class FakeInfomentor(http.server.ThreadingHTTPServer):
+    """A local stand-in for the infomentor endpoints a run requests
+
+    Every user sees the same news, the requested paths are counted."""
+
+    def __init__(self, delay=0.01):
+        super().__init__(("127.0.0.1", 0), _InfomentorHandler)
+        self.delay = delay
+        self.news = []
+        self.calendar = []
+        self.files = {}
+        self.requests = collections.Counter()
+        # requests handled at the same time, now and at most
+        self.active = 0
+        self.maxactive = 0
+        # (Range, If-Range) of every download
+        self.ranges = []
+        # (pageSize, page) of every news list request
+        self.pages = []
+        self.lock = threading.Lock()
+        # with a database set, requests made while it is locked are recorded
+        self.database = None
+        self.locked = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def add_news(self, news_id, attachments=()):
+        """Publish a news entry with attachments, a list of (id, name, content)"""
+        entry = {
+            "id": news_id,
+            "title": "News {}".format(news_id),
+            "content": "Text of news {}".format(news_id),
+            "publishedDate": "2019-09-{:02d}T08:00:00".format(news_id),
+            "attachments": [],
+        }
+        for att_id, name, content in attachments:
+            self.files[str(att_id)] = (name, content)
+            entry["attachments"].append(
+                {"url": "NewsAttachment/Download/{}".format(att_id), "title": name}
+            )
+        self.news.append(entry)
+
+    def news_page(self, form):
+        """The news of the requested page, newest first"""
+        pagesize = int(form.get("pageSize", ["-1"])[0])
+        page = int(form.get("page", ["1"])[0])
+        with self.lock:
+            self.pages.append((pagesize, page))
+        news = sorted(self.news, key=lambda n: n["publishedDate"], reverse=True)
+        if pagesize < 0:
+            return news
+        return news[(page - 1) * pagesize : page * pagesize]
+
+
+class _InfomentorHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body, status=200, headers=()):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode()) if length else {}
+        path = self.path.split("?")[0]
+        server = self.server
+        with server.lock:
+            server.requests[path] += 1
+            server.active += 1
+            server.maxactive = max(server.maxactive, server.active)
+        try:
+            if server.database is not None and is_locked(server.database):
+                server.locked.append(path)
+            time.sleep(server.delay)
+            return self._route(path, form)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _route(self, path, form):
+        if path.startswith("/authentication/authentication/isauthenticated"):
+            return self._reply("true")
+        if path == "/Communication/News/GetNewsList":
+            return self._reply(json.dumps({"items": self.server.news_page(form)}))
+        if path == "/Homework/homework/GetHomework":
+            return self._reply("[]")
+        if path == "/Communication/NewsImage/GetImage":
+            return self._reply(b"image", headers=[("Content-Type", "image/png")])
+        if path == "/Calendar/Calendar/getEntries":
+            return self._reply(json.dumps(self.server.calendar))
+        if path == "/Calendar/Calendar/getEntry":
+            details = {
+                "id": int(form["id"][0]),
+                "allDayEvent": False,
+                "notes": "",
+                "info": {"resources": []},
+            }
+            return self._reply(json.dumps(details))
+        if "/Download/" in path:
+            return self._download(path)
+        return self._reply("not found", status=404)
+
+    def _download(self, path):
+        """Send a file, a range of it if requested and it is unchanged"""
+        file_id = path.rsplit("/", 1)[1]
+        if file_id not in self.server.files:
+            return self._reply("not found", status=404)
+        name, content = self.server.files[file_id]
+        etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        headers = [
+            ("Content-Disposition", "attachment; filename={}".format(name)),
+            ("ETag", etag),
+        ]
+        requested = self.headers.get("Range")
+        ifrange = self.headers.get("If-Range")
+        with self.server.lock:
+            self.server.ranges.append((requested, ifrange))
+        if requested is not None and ifrange in (None, etag):
+            start = int(requested[len("bytes=") :].rstrip("-"))
+            headers.append(
+                (
+                    "Content-Range",
+                    "bytes {}-{}/{}".format(start, len(content) - 1, len(content)),
+                )
+            )
+            return self._reply(content[start:], status=206, headers=headers)
+        return self._reply(content, headers=headers)
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+@pytest.fixture
+def infomentor_server(workdir):
+    """A running FakeInfomentor, configured as infomentor of the run"""
+    server = FakeInfomentor()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    cfg = config.load()
+    cfg["general"]["mimurl"] = server.url
+    cfg["general"]["im1url"] = server.url
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_user(database):
+    """Create a user, returns its id"""
+
+    def make_user(name, password="secret", notification=None):
+        session = db.new_session()
+        user = model.User(name=name, password=password)
+        if notification is not None:
+            user.notification = model.Notification(
+                ntype=model.Notification.Types[notification], info=""
+            )
+        session.add(user)
+        session.commit()
+        user_id = user.id
+        session.close()
+        return user_id
+
+    return make_user
+
+
+class StubPushover(BaseAdapter):
+    """Answers the requests of a PushoverClient with queued responses
+
+    Without a queued (status, headers) the message is accepted."""
+
+    def __init__(self):
+        super().__init__()
+        self.responses = []
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        status, headers = self.responses.pop(0) if self.responses else (200, {})
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        body = {"status": 1} if status == 200 else {"status": 0, "errors": ["no"]}
+        response._content = json.dumps(body).encode("utf-8")
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def pushover(workdir, monkeypatch):
+    """The stub answering the pushover client of the run"""
+    stub = StubPushover()
+    client = pushclient.PushoverClient("token", reserve=2)
+    client.session.mount("https://", stub)
+    monkeypatch.setattr(pushclient, "_client", client)
+    stub.client = client
+    return stub
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+import pytest
+from infomentor.asyncconnector import AsyncInfomentor
+
+
+def _run(coroutine_function, **kwargs):
+    """Run coroutine_function(im) with a new AsyncInfomentor"""
+
+    async def run():
+        async with AsyncInfomentor("someone", **kwargs) as im:
+            return await coroutine_function(im)
+
+    return asyncio.run(run())
+
+
+def _content(path):
+    with open(os.path.join("files", path), "rb") as f:
+        return f.read()
+
+
+def test_news_article_is_downloaded(infomentor_server):
+    infomentor_server.add_news(
+        1, [(11, "plan.pdf", b"plan"), (12, "menu.pdf", b"menu")]
+    )
+
+    async def fetch(im):
+        assert await im.login("secret")
+        items = await im.get_news_list()
+        return await im.get_news_article(items[0])
+
+    news = _run(fetch)
+    assert news.news_id == 1
+    assert [_content(a.localpath) for a in news.attachments] == [b"plan", b"menu"]
+    assert news.attachments[0].sha256 is not None
+    with open(os.path.join("images", news.imagefile), "rb") as f:
+        assert f.read() == b"image"
+
+
+def test_every_failed_download_is_reported(infomentor_server, caplog):
+    infomentor_server.add_news(1, [(11, "plan.pdf", b"plan")])
+    # two attachments the server does not have
+    infomentor_server.news[0]["attachments"] += [
+        {"url": "NewsAttachment/Download/{}".format(n), "title": "gone"}
+        for n in (12, 13)
+    ]
+
+    async def fetch(im):
+        items = await im.get_news_list()
+        return await im.get_news_article(items[0])
+
+    with caplog.at_level(logging.ERROR), pytest.raises(Exception):
+        _run(fetch)
+    failed = [r.getMessage() for r in caplog.records if r.levelno >= logging.ERROR]
+    assert failed == [
+        "downloading NewsAttachment/Download/12 failed",
+        "downloading NewsAttachment/Download/13 failed",
+    ]
+    # the other download was completed nevertheless
+    assert infomentor_server.requests["/NewsAttachment/Download/11"] == 1
+
+
+def test_requests_in_flight_are_bounded(infomentor_server):
+    infomentor_server.delay = 0.05
+    infomentor_server.add_news(
+        1, [(n, "{}.pdf".format(n), b"content") for n in range(10, 16)]
+    )
+
+    async def fetch(im):
+        items = await im.get_news_list()
+        return await im.get_news_article(items[0])
+
+    news = _run(fetch, limit=2)
+    assert len(news.attachments) == 6
+    assert infomentor_server.maxactive == 2
+
+
+def test_calendar_and_homework(infomentor_server):
+    infomentor_server.calendar = [
+        {"id": 7, "title": "Exam", "start": "2019-09-02T08:00:00"}
+    ]
+
+    async def fetch(im):
+        calendar = await im.get_calendar()
+        event = await im.get_event(calendar[0]["id"])
+        homework = await im.get_homework_list()
+        return calendar, event, homework
+
+    calendar, event, homework = _run(fetch)
+    assert calendar == infomentor_server.calendar
+    assert event["id"] == 7
+    assert homework == []
+    assert infomentor_server.requests["/Homework/homework/GetHomework"] == 2
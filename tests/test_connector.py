@@ -0,0 +1,121 @@
+import hashlib
+import os
+import pytest
+import requests
+from infomentor import connector
+
+URL = "NewsAttachment/Download/11"
+CONTENT = b"0123456789"
+ETAG = '"{}"'.format(hashlib.sha1(CONTENT).hexdigest())
+
+
+@pytest.fixture
+def im(infomentor_server):
+    infomentor_server.files["11"] = ("plan.pdf", CONTENT)
+    return connector.Infomentor("someone")
+
+
+def _partial(content, validator=None):
+    """Leave an interrupted download of URL behind"""
+    file = connector.InfomentorFile("files", None, seed=URL)
+    os.makedirs("files", exist_ok=True)
+    with open(file.partfile, "wb") as f:
+        f.write(content)
+    if validator is not None:
+        file.keep_validator(validator)
+    return file
+
+
+def _content(file):
+    with open(file.targetfile, "rb") as f:
+        return f.read()
+
+
+def test_download_is_resumed_if_unchanged(im, infomentor_server):
+    partial = _partial(CONTENT[:4], ETAG)
+    file = im.fetch_file(URL, directory="files")
+    assert infomentor_server.ranges == [("bytes=4-", ETAG)]
+    assert _content(file) == CONTENT
+    assert file.sha256 == hashlib.sha256(CONTENT).hexdigest()
+    assert not os.path.exists(partial.partfile)
+    assert not os.path.exists(partial.validatorfile)
+
+
+def test_changed_download_is_restarted(im, infomentor_server):
+    _partial(b"abcd", '"of the old file"')
+    file = im.fetch_file(URL, directory="files")
+    assert infomentor_server.ranges == [("bytes=4-", '"of the old file"')]
+    assert _content(file) == CONTENT
+
+
+def test_download_without_validator_is_restarted(im, infomentor_server):
+    _partial(b"abcd")
+    file = im.fetch_file(URL, directory="files")
+    assert infomentor_server.ranges == [(None, None)]
+    assert _content(file) == CONTENT
+
+
+def test_partial_download_is_kept_on_connection_errors(im, monkeypatch):
+    partial = _partial(CONTENT[:4], ETAG)
+
+    def unreachable(*args, **kwargs):
+        raise requests.ConnectionError("unreachable")
+
+    monkeypatch.setattr(im.session, "get", unreachable)
+    with pytest.raises(requests.ConnectionError):
+        im.fetch_file(URL, directory="files")
+    assert partial.partial_size() == 4
+    assert partial.validator() == ETAG
+
+
+def _interrupted(error):
+    """iter_content yielding the first bytes of CONTENT, then raising error"""
+
+    def iter_content(self, chunk_size=1):
+        yield CONTENT[:4]
+        raise error
+
+    return iter_content
+
+
+def test_interrupted_download_is_resumed(im, infomentor_server, monkeypatch):
+    iter_content = requests.Response.iter_content
+    monkeypatch.setattr(
+        requests.Response,
+        "iter_content",
+        _interrupted(requests.exceptions.ChunkedEncodingError("connection reset")),
+    )
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        im.fetch_file(URL, directory="files")
+    partial = connector.InfomentorFile("files", None, seed=URL)
+    assert partial.partial_size() == 4
+    assert partial.validator() == ETAG
+    monkeypatch.setattr(requests.Response, "iter_content", iter_content)
+    file = im.fetch_file(URL, directory="files")
+    assert infomentor_server.ranges[-1] == ("bytes=4-", ETAG)
+    assert _content(file) == CONTENT
+
+
+def test_partial_download_is_dropped_on_other_errors(im, monkeypatch):
+    monkeypatch.setattr(
+        requests.Response, "iter_content", _interrupted(OSError("disk full"))
+    )
+    with pytest.raises(OSError):
+        im.fetch_file(URL, directory="files")
+    partial = connector.InfomentorFile("files", None, seed=URL)
+    assert partial.partial_size() == 0
+    assert partial.validator() is None
+
+
+def test_failed_response_is_closed(im, monkeypatch):
+    closed = []
+    close = requests.Response.close
+
+    def observed_close(self):
+        closed.append(self.status_code)
+        close(self)
+
+    monkeypatch.setattr(requests.Response, "close", observed_close)
+    with pytest.raises(Exception, match="Got response with code 404"):
+        im.fetch_file("NewsAttachment/Download/99", directory="files")
+    assert closed == [404]
@@ -0,0 +1,66 @@
+import datetime
+import pytest
+from infomentor import dates
+
+UTC = datetime.timezone.utc
+CET = datetime.timezone(datetime.timedelta(hours=1))
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("2019-09-02T08:30:00", datetime.datetime(2019, 9, 2, 8, 30)),
+        ("2019-09-02 08:30", datetime.datetime(2019, 9, 2, 8, 30)),
+        ("2019-09-02T08:30:00Z", datetime.datetime(2019, 9, 2, 8, 30, tzinfo=UTC)),
+        (
+            "2019-09-02T08:30:00+01:00",
+            datetime.datetime(2019, 9, 2, 8, 30, tzinfo=CET),
+        ),
+        ("2019-09-02T08:30:00+0100", datetime.datetime(2019, 9, 2, 8, 30, tzinfo=CET)),
+        (
+            "2019-09-02T08:30:00-02:30",
+            datetime.datetime(
+                2019,
+                9,
+                2,
+                8,
+                30,
+                tzinfo=datetime.timezone(-datetime.timedelta(hours=2, minutes=30)),
+            ),
+        ),
+        ("2019-09-02T08:30:00.5", datetime.datetime(2019, 9, 2, 8, 30, 0, 500000)),
+        (
+            "2019-09-02T08:30:00.1234567Z",
+            datetime.datetime(2019, 9, 2, 8, 30, 0, 123456, tzinfo=UTC),
+        ),
+        ("2019-09-02", datetime.datetime(2019, 9, 2)),
+        (" 2019-09-02 ", datetime.datetime(2019, 9, 2)),
+    ],
+)
+def test_parse_iso(text, expected):
+    parsed = dates.parse_iso(text)
+    assert parsed == expected
+    assert parsed.tzinfo == expected.tzinfo
+    assert dates.parse(text) == expected
+
+
+@pytest.mark.parametrize("text", ["02.09.2019", "2019-09-02T08", "junk", ""])
+def test_parse_iso_leaves_other_formats(text):
+    assert dates.parse_iso(text) is None
+
+
+def test_invalid_iso_date_raises():
+    with pytest.raises(ValueError):
+        dates.parse_iso("2019-13-02")
+
+
+def test_other_formats_are_handed_to_dateparser():
+    pytest.importorskip("dateparser")
+    assert dates.parse("2. September 2019") == datetime.datetime(2019, 9, 2)
+
+
+@pytest.mark.parametrize("text", ["no date at all", "foo bar baz", "", None])
+def test_unparseable_dates_are_none(text):
+    if text:
+        pytest.importorskip("dateparser")
+    assert dates.parse(text) is None
@@ -0,0 +1,205 @@
+import concurrent.futures
+import hashlib
+import sqlite3
+import time
+from infomentor import db, model
+
+# the tables as created before the schema was versioned
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL, name VARCHAR, enc_password VARCHAR, wantstatus BOOLEAN,
+    PRIMARY KEY (id)
+);
+CREATE TABLE notifications (
+    id INTEGER NOT NULL, user_id INTEGER, ntype VARCHAR(8), info VARCHAR,
+    PRIMARY KEY (id)
+);
+CREATE TABLE news (
+    id INTEGER NOT NULL, news_id INTEGER, user_id INTEGER, title VARCHAR,
+    content VARCHAR, category VARCHAR, date VARCHAR, "imageUrl" VARCHAR,
+    imagefile VARCHAR, notified BOOLEAN, raw VARCHAR, PRIMARY KEY (id)
+);
+CREATE TABLE calendarentries (
+    id INTEGER NOT NULL, calendar_id INTEGER, title VARCHAR, user_id INTEGER,
+    ical VARCHAR, hash VARCHAR, PRIMARY KEY (id)
+);
+CREATE TABLE homework (
+    id INTEGER NOT NULL, homework_id INTEGER, user_id INTEGER, subject VARCHAR,
+    "courseElement" VARCHAR, text VARCHAR, date VARCHAR, "imageUrl" VARCHAR,
+    PRIMARY KEY (id)
+);
+CREATE TABLE api_status (
+    id INTEGER NOT NULL, user_id INTEGER, degraded_count INTEGER,
+    datetime DATETIME, info VARCHAR, ok BOOLEAN, PRIMARY KEY (id)
+);
+CREATE TABLE icloud_calendar (
+    id INTEGER NOT NULL, user_id INTEGER, icloud_user VARCHAR,
+    icloud_pwd VARCHAR, calendarname VARCHAR, PRIMARY KEY (id)
+);
+CREATE TABLE invitation_mails (
+    id INTEGER NOT NULL, user_id INTEGER, email VARCHAR, PRIMARY KEY (id)
+);
+CREATE TABLE attachments (
+    id INTEGER NOT NULL, attachment_id INTEGER, filetype VARCHAR, url VARCHAR,
+    title VARCHAR, localpath VARCHAR, news_id INTEGER, homework_id INTEGER,
+    PRIMARY KEY (id)
+);
+INSERT INTO users (id, name) VALUES (1, 'someone');
+INSERT INTO calendarentries (id, calendar_id, title, user_id, ical, hash)
+    VALUES (1, 'a8f5f167-f44f-5b6e-9e8e-b7e3c2a9d1f0', 'Exam', 1, 'BEGIN:VCALENDAR', 'x');
+"""
+
+
+def _baseline(path, version=0):
+    conn = sqlite3.connect(str(path))
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("PRAGMA user_version = {:d}".format(version))
+    conn.commit()
+    conn.close()
+
+
+def _schema(engine):
+    tables = {}
+    for table in model.ModelBase.metadata.sorted_tables:
+        tables[table.name] = db._columns(engine, table.name)
+    return tables
+
+
+def test_new_database_gets_current_version(database):
+    assert database.execute("PRAGMA user_version").scalar() == db.SCHEMA_VERSION
+    assert database.execute("PRAGMA journal_mode").scalar() == "wal"
+
+
+def test_baseline_database_is_migrated(workdir, database, monkeypatch):
+    path = workdir / "baseline.db"
+    _baseline(path)
+    monkeypatch.setattr(db, "_engine", None)
+    engine = db.get_engine(str(path))
+    assert engine.execute("PRAGMA user_version").scalar() == db.SCHEMA_VERSION
+    for table, columns in _schema(engine).items():
+        expected = {c.name for c in model.ModelBase.metadata.tables[table].columns}
+        assert expected <= set(columns), table
+    assert _schema(engine)["calendarentries"]["calendar_id"] == "VARCHAR"
+    session = db.new_session()
+    entry = session.query(model.CalendarEntry).one()
+    assert entry.calendar_id == "a8f5f167-f44f-5b6e-9e8e-b7e3c2a9d1f0"
+    assert entry.user.name == "someone"
+    session.close()
+    engine.dispose()
+
+
+def test_versions_set_without_migrating_are_migrated(workdir, database, monkeypatch):
+    path = workdir / "stamped.db"
+    # the first versions were set by create_all only, on old tables as well
+    _baseline(path, version=6)
+    monkeypatch.setattr(db, "_engine", None)
+    engine = db.get_engine(str(path))
+    assert "sha256" in db._columns(engine, "attachments")
+    assert "feed_token" in db._columns(engine, "users")
+    engine.dispose()
+
+
+def test_migrations_are_ordered():
+    versions = [version for version, migration in db.MIGRATIONS]
+    assert versions == sorted(versions)
+    assert versions[-1] == db.SCHEMA_VERSION
+
+
+def test_concurrent_sessions_read_then_write(database):
+    def work(n):
+        session = db.new_session()
+        try:
+            for i in range(5):
+                session.query(model.SyncState).count()
+                # another thread commits in between with a deferred BEGIN
+                time.sleep(0.005)
+                session.add(model.SyncState(endpoint="{}-{}".format(n, i)))
+                session.commit()
+        finally:
+            session.close()
+
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        for future in [pool.submit(work, n) for n in range(4)]:
+            future.result()
+    session = db.new_session(readonly=True)
+    assert session.query(model.SyncState).count() == 20
+    session.close()
+
+
+def test_outbox_key_is_no_longer_unique(workdir, database, monkeypatch):
+    path = workdir / "outbox.db"
+    conn = sqlite3.connect(str(path))
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executescript(
+        """
+        CREATE TABLE outbox (
+            id INTEGER NOT NULL, user_id INTEGER, kind VARCHAR(8),
+            item_id INTEGER, key VARCHAR, created DATETIME, attempts INTEGER,
+            next_attempt DATETIME, sent DATETIME, error VARCHAR,
+            PRIMARY KEY (id), UNIQUE (key)
+        );
+        CREATE INDEX ix_outbox_sent_user_id ON outbox (sent, user_id);
+        INSERT INTO outbox (id, user_id, kind, key, sent)
+            VALUES (1, 1, 'CALENDAR', 'calendar:1:exam:a', '2019-09-01 08:00:00');
+        PRAGMA user_version = 19;
+        """
+    )
+    conn.close()
+    monkeypatch.setattr(db, "_engine", None)
+    engine = db.get_engine(str(path))
+    indexes = {row[1]: row[2] for row in engine.execute("PRAGMA index_list(outbox)")}
+    assert indexes == {"ix_outbox_sent_user_id": 0, "ix_outbox_key_sent": 0}
+    engine.execute(
+        "INSERT INTO outbox (user_id, kind, key) VALUES (1, 'CALENDAR', 'calendar:1:exam:a')"
+    )
+    assert engine.execute("SELECT count(*) FROM outbox").scalar() == 2
+    engine.dispose()
+
+
+def test_calendar_hashes_are_taken_again(workdir, database, monkeypatch):
+    ical = (
+        b"BEGIN:VCALENDAR\nBEGIN:VEVENT\nSUMMARY:Exam\nDTSTART:20190902T080000\n"
+        b"DTEND:20190902T090000\nDTSTAMP:20190901T120000Z\nUID:exam\n"
+        b"END:VEVENT\nEND:VCALENDAR\n"
+    )
+    path = workdir / "legacy.db"
+    _baseline(path, version=6)
+    conn = sqlite3.connect(str(path))
+    conn.execute(
+        "INSERT INTO calendarentries (id, calendar_id, user_id, ical, hash)"
+        " VALUES (2, 'exam', 1, ?, 'of an empty calendar')",
+        (ical,),
+    )
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(db, "_engine", None)
+    engine = db.get_engine(str(path))
+    without_dtstamp = ical.replace(b"DTSTAMP:20190901T120000Z\n", b"")
+    expected = hashlib.sha1(without_dtstamp).hexdigest()
+    hashes = dict(engine.execute("SELECT id, hash FROM calendarentries").fetchall())
+    # the first one is no event, it is left as it is
+    assert hashes == {1: "x", 2: expected}
+    engine.dispose()
+
+
+def test_readonly_session_reads_while_a_run_writes(database, database_locked):
+    writer = db.new_session()
+    writer.add(model.SyncState(endpoint="News"))
+    writer.flush()
+    assert database_locked()
+    reader = db.get_db(readonly=True)
+    started = time.monotonic()
+    # the written row is not committed yet
+    assert reader.query(model.SyncState).count() == 0
+    assert time.monotonic() - started < 1
+    writer.commit()
+    writer.close()
+    # the open read transaction does not keep a writer waiting
+    reader.query(model.User).count()
+    assert not database_locked()
+    db.remove_session()
+    # a session which may write takes the lock with its first query
+    db.get_db().query(model.User).count()
+    assert database_locked()
+    db.remove_session()
+    assert not database_locked()
@@ -0,0 +1,99 @@
+import datetime
+import logging
+import time
+from infomentor import db, dispatcher, informer, model
+from infomentor.__main__ import notify_users
+
+
+def _errors(caplog):
+    return [r.getMessage() for r in caplog.records if r.levelno >= logging.ERROR]
+
+
+def test_parallel_dispatch_delivers_every_message_once(
+    workdir, infomentor_server, make_user, caplog
+):
+    infomentor_server.add_news(1)
+    infomentor_server.add_news(2)
+    for n in range(8):
+        make_user("user{}".format(n), notification="FAKE")
+    notify_users(workers=4)
+    with caplog.at_level(logging.ERROR):
+        delivered = dispatcher.Dispatcher(db.new_session, workers=4).run()
+    assert _errors(caplog) == []
+    assert delivered == 16
+    assert dispatcher.Dispatcher(db.new_session, workers=4).run() == 0
+    for n in range(8):
+        sent = (workdir / "user{}.txt".format(n)).read_text()
+        assert sent.count("Notification:") == 2
+
+
+def test_no_transaction_is_open_during_delivery(
+    infomentor_server, make_user, database_locked, monkeypatch
+):
+    infomentor_server.add_news(1)
+    make_user("someone", notification="FAKE")
+    notify_users()
+    locked = []
+    deliver = informer.Informer.deliver
+
+    def observed_deliver(self, kind, item):
+        locked.append(database_locked())
+        return deliver(self, kind, item)
+
+    monkeypatch.setattr(informer.Informer, "deliver", observed_deliver)
+    assert dispatcher.Dispatcher(db.new_session).run() == 1
+    assert locked == [False]
+
+
+def test_rate_limited_messages_wait_for_the_reset(
+    infomentor_server, make_user, pushover
+):
+    infomentor_server.add_news(1)
+    infomentor_server.add_news(2)
+    make_user("someone", notification="PUSHOVER")
+    notify_users()
+    reset = int(time.time()) + 3600
+    pushover.responses = [
+        (429, {"X-Limit-App-Remaining": "0", "X-Limit-App-Reset": str(reset)})
+    ]
+    assert dispatcher.Dispatcher(db.new_session).run() == 0
+    # the second message is deferred without asking pushover
+    assert len(pushover.requests) == 1
+    session = db.new_session(readonly=True)
+    messages = session.query(model.OutboxMessage).all()
+    session.close()
+    assert len(messages) == 2
+    for message in messages:
+        assert message.sent is None
+        assert message.attempts == 0
+        assert message.next_attempt == datetime.datetime.fromtimestamp(reset)
+    # nothing is due before the reset
+    assert dispatcher.Dispatcher(db.new_session).run() == 0
+    assert len(pushover.requests) == 1
+
+
+def test_digest_is_sent_once_after_the_window(workdir, make_user, pushover):
+    user_id = make_user("someone", notification="PUSHOVER")
+    (workdir / "files").mkdir()
+    session = db.new_session()
+    user = session.query(model.User).get(user_id)
+    user.notification.digest = True
+    user.notification.digestwindow = 60
+    inf = informer.Informer(user, None, logger=None, session=session)
+    for n in range(3):
+        news = model.News(news_id=n, title="News {}".format(n), content="Text")
+        inf._add_item(news)
+        inf._add_item(model.Homework(homework_id=n, subject="Math", text="Do it"))
+    session.commit()
+    session.close()
+    assert dispatcher.Dispatcher(db.new_session).run() == 0
+    assert pushover.requests == []
+    session = db.new_session()
+    for message in session.query(model.OutboxMessage):
+        message.created -= datetime.timedelta(minutes=61)
+    session.commit()
+    session.close()
+    assert dispatcher.Dispatcher(db.new_session).run() == 6
+    assert dispatcher.Dispatcher(db.new_session).run() == 0
+    (request,) = pushover.requests
+    assert "title=6+new+items" in request.body
@@ -0,0 +1,83 @@
+import hashlib
+import os
+from infomentor import db, filestorage, informer, model
+from infomentor.__main__ import notify_users
+
+
+def test_second_user_uses_the_cached_download(workdir, infomentor_server, make_user):
+    infomentor_server.add_news(1, [(11, "plan.pdf", b"plan")])
+    make_user("first")
+    make_user("second")
+    notify_users()
+    assert infomentor_server.requests["/NewsAttachment/Download/11"] == 1
+    assert infomentor_server.requests["/Communication/NewsImage/GetImage"] == 1
+    session = db.new_session(readonly=True)
+    cached = {c.key: c for c in session.query(model.CachedFile)}
+    assert set(cached) == {"attachment:11", "newsimage:1"}
+    attachments = session.query(model.Attachment).all()
+    assert len(attachments) == 2
+    for attachment in attachments:
+        assert attachment.sha256 == cached["attachment:11"].sha256
+        with open(os.path.join("files", attachment.localpath), "rb") as f:
+            assert f.read() == b"plan"
+    session.close()
+
+
+def _blob(store, content):
+    """Store content as a blob, returns its hash"""
+    sha256 = hashlib.sha256(content).hexdigest()
+    with open("download.part", "wb") as f:
+        f.write(content)
+    store.add("download.part", sha256)
+    return sha256
+
+
+def _attachment(store, content, path):
+    """An attachment of content stored at files/path"""
+    sha256 = _blob(store, content)
+    os.makedirs(os.path.dirname(os.path.join("files", path)), exist_ok=True)
+    store.link(sha256, os.path.join("files", path))
+    return model.Attachment(localpath=path, sha256=sha256, size=len(content))
+
+
+def _refcounts(session):
+    return {blob.sha256: blob.refcount for blob in session.query(model.Blob)}
+
+
+def test_replaced_attachments_are_collected(database, make_user):
+    store = filestorage.BlobStore()
+    user_id = make_user("someone")
+    session = db.new_session()
+    user = session.query(model.User).get(user_id)
+    inf = informer.Informer(user, None, logger=None, session=session)
+    old = _attachment(store, b"old", "a/plan.pdf")
+    new = _attachment(store, b"new", "b/plan.pdf")
+    # a news image has no reference count
+    image = _blob(store, b"image")
+    os.makedirs("images/c")
+    os.symlink(os.path.relpath(store.blobpath(image), "images/c"), "images/c/1.image")
+    entry = model.CalendarEntry(calendar_id="exam", hash="a", attachments=[old])
+    inf._add_item(entry)
+    inf._add_item(entry, {"hash": "b", "attachments": [new]})
+    session.commit()
+    assert _refcounts(session) == {old.sha256: 0, new.sha256: 1}
+    assert session.query(model.Attachment).count() == 1
+
+    assert filestorage.collect_garbage(session, store) == 1
+    assert not os.path.exists(store.blobpath(old.sha256))
+    assert not os.path.exists("files/a")
+    assert os.path.exists("files/b/plan.pdf")
+    assert os.path.exists("images/c/1.image")
+    assert _refcounts(session) == {new.sha256: 1}
+    session.close()
+
+
+def test_symlinked_paths_are_collected(workdir):
+    store = filestorage.BlobStore()
+    sha256 = _blob(store, b"content")
+    os.makedirs("files/a")
+    os.symlink(os.path.relpath(store.blobpath(sha256), "files/a"), "files/a/x.pdf")
+    assert list(store.links([sha256])) == [("files/a/x.pdf", sha256)]
+    store.remove([sha256])
+    assert not os.path.lexists("files/a/x.pdf")
+    assert not os.path.exists(store.blobpath(sha256))
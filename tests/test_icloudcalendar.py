@@ -0,0 +1,247 @@
+import collections
+import http.server
+import threading
+import uuid
+import pytest
+from infomentor import db, icloudcalendar, informer, model
+
+MULTISTATUS = '<d:multistatus xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav">{}</d:multistatus>'
+RESPONSE = "<d:response><d:href>{}</d:href><d:propstat><d:prop>{}</d:prop></d:propstat></d:response>"
+
+ICAL = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//infomentor//test//
+BEGIN:VEVENT
+UID:{uid}
+SUMMARY:{title}
+DTSTART:20190902T080000
+DTEND:20190902T090000
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class FakeCalDAV(http.server.ThreadingHTTPServer):
+    """A caldav server with one calendar, counts the requests by method"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _CalDAVHandler)
+        self.events = {}
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+
+class _CalDAVHandler(http.server.BaseHTTPRequestHandler):
+    calendar = "/calendars/school/"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body="", headers=()):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _multistatus(self, *responses):
+        self._reply(207, MULTISTATUS.format("".join(responses)))
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+        server = self.server
+        with server.lock:
+            server.requests[self.command] += 1
+        if self.command == "PROPFIND" and self.path == "/":
+            prop = "<d:current-user-principal><d:href>/principal/</d:href></d:current-user-principal>"
+            return self._multistatus(RESPONSE.format("/", prop))
+        if self.command == "PROPFIND" and self.path == "/principal/":
+            prop = "<c:calendar-home-set><d:href>/calendars/</d:href></c:calendar-home-set>"
+            return self._multistatus(RESPONSE.format(self.path, prop))
+        if self.command == "PROPFIND" and self.path == "/calendars/":
+            prop = "<d:displayname>Schule</d:displayname><d:resourcetype><c:calendar/></d:resourcetype>"
+            return self._multistatus(RESPONSE.format(self.calendar, prop))
+        if self.command == "REPORT" and self.path == self.calendar:
+            with server.lock:
+                responses = [
+                    RESPONSE.format(path, "<d:getetag>{}</d:getetag>".format(etag))
+                    for path, (etag, ical) in server.events.items()
+                    if "<href>{}</href>".format(path) in body
+                ]
+            return self._multistatus(*responses)
+        if self.command == "PUT" and self.path.startswith(self.calendar):
+            with server.lock:
+                current = server.events.get(self.path)
+                if self.headers.get("If-None-Match") == "*" and current is not None:
+                    return self._reply(412)
+                if "If-Match" in self.headers and (
+                    current is None or current[0] != self.headers["If-Match"]
+                ):
+                    return self._reply(412)
+                etag = '"{}"'.format(server.requests["PUT"])
+                server.events[self.path] = (etag, body)
+            return self._reply(201 if current is None else 204, headers=[("ETag", etag)])
+        return self._reply(404)
+
+    do_PROPFIND = _handle
+    do_REPORT = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+
+
+@pytest.fixture
+def caldav_server(monkeypatch):
+    server = FakeCalDAV()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(icloudcalendar.iCloudConnector, "icloud_url", server.url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def calendar_user(make_user):
+    """A user with an icloud calendar and three calendar entries"""
+    user_id = make_user("someone")
+    session = db.new_session()
+    user = session.query(model.User).get(user_id)
+    user.icalendar = model.ICloudCalendar(
+        icloud_user="someone", password="secret", calendarname="Schule"
+    )
+    for n in range(3):
+        uid = "entry-{}".format(n)
+        ical = ICAL.format(uid=uid, title="Exam {}".format(n))
+        user.calendarentries.append(
+            model.CalendarEntry(calendar_id=uid, title=uid, ical=ical, hash=uid)
+        )
+    session.commit()
+    session.close()
+    return user_id
+
+
+def _deliver(user_id):
+    """Deliver all calendar entries of the user with a new informer"""
+    session = db.new_session()
+    user = session.query(model.User).get(user_id)
+    inf = informer.Informer(user, None, logger=None, session=session)
+    entries = list(user.calendarentries)
+    failed = inf.deliver_calendar(entries)
+    session.commit()
+    session.close()
+    return failed, entries
+
+
+def test_unchanged_entries_are_not_uploaded_again(caldav_server, calendar_user):
+    failed, entries = _deliver(calendar_user)
+    assert failed == {}
+    assert caldav_server.requests == {"PROPFIND": 3, "REPORT": 1, "PUT": 3}
+    assert len(caldav_server.events) == 3
+    assert all(entry.synced_hash == entry.hash for entry in entries)
+
+    caldav_server.requests.clear()
+    failed, entries = _deliver(calendar_user)
+    assert failed == {}
+    # the discovered calendar is stored, the etags are checked with one REPORT
+    assert caldav_server.requests == {"REPORT": 1}
+
+
+def test_unavailable_icloud_fails_every_entry(
+    caldav_server, calendar_user, monkeypatch
+):
+    monkeypatch.setattr(
+        icloudcalendar.iCloudConnector, "icloud_url", caldav_server.url + "/gone/"
+    )
+    failed, entries = _deliver(calendar_user)
+    assert set(failed) == set(entries)
+    assert caldav_server.requests["PUT"] == 0
+    assert all(entry.synced_hash is None for entry in entries)
+
+
+class StubInfomentor(object):
+    """Lists the first calendar entry of calendar_user only"""
+
+    listed = {"id": 1, "title": "Exam 0", "start": "2019-09-02", "end": "2019-09-02"}
+
+    def __init__(self):
+        self.fingerprints = {}
+
+    def get_calendar(self):
+        self.fingerprints["Calendar"] = "listed"
+        return [self.listed]
+
+    def _get_calendar_dates(self):
+        return {"start": "2019-08-01", "end": "2020-07-31"}
+
+
+def _update_calendar(user_id):
+    """Run update_calendar with the first entry listed, the others vanished"""
+    session = db.new_session()
+    user = session.query(model.User).get(user_id)
+    inf = informer.Informer(user, StubInfomentor(), logger=None, session=session)
+    entry = user.calendarentries[0]
+    entry.calendar_id = str(uuid.uuid5(uuid.NAMESPACE_URL, "infomentor_1"))
+    entry.fingerprint = inf._calendar_fingerprint(StubInfomentor.listed)
+    inf.update_calendar()
+    state = inf._sync_state("Calendar")
+    entries = session.query(model.CalendarEntry).with_parent(user, "calendarentries")
+    result = state.fingerprint, entries.count()
+    session.close()
+    return result
+
+
+def test_calendar_is_synced_after_removing_vanished_entries(
+    caldav_server, calendar_user
+):
+    assert _update_calendar(calendar_user) == ("listed", 1)
+    assert caldav_server.requests["DELETE"] == 2
+
+
+def test_calendar_is_not_synced_while_vanished_entries_are_kept(
+    caldav_server, calendar_user, monkeypatch
+):
+    monkeypatch.setattr(
+        icloudcalendar.iCloudConnector, "icloud_url", caldav_server.url + "/gone/"
+    )
+    assert _update_calendar(calendar_user) == (None, 3)
+
+
+def test_stored_entries_are_adopted_without_details(caldav_server, calendar_user):
+    session = db.new_session()
+    user = session.query(model.User).get(calendar_user)
+    im = StubInfomentor()
+    im.listed = dict(
+        StubInfomentor.listed, start="2019-09-02T08:00:00", end="2019-09-02T09:00:00"
+    )
+    inf = informer.Informer(user, im, logger=None, session=session)
+    entry = user.calendarentries[0]
+    entry.calendar_id = str(uuid.uuid5(uuid.NAMESPACE_URL, "infomentor_1"))
+    # the stub has no get_event, fetching the details would fail
+    inf.update_calendar()
+    assert entry.fingerprint == inf._calendar_fingerprint(im.listed)
+    assert inf._sync_state("Calendar").fingerprint == "listed"
+    assert session.query(model.OutboxMessage).count() == 0
+    session.close()
+
+
+def test_event_changed_on_the_server_is_overwritten(caldav_server, calendar_user):
+    _deliver(calendar_user)
+    path = "/calendars/school/entry-0.ics"
+    caldav_server.events[path] = ('"changed"', "edited in the calendar app")
+    caldav_server.requests.clear()
+    failed, entries = _deliver(calendar_user)
+    assert failed == {}
+    # only the changed event is written again
+    assert caldav_server.requests == {"REPORT": 1, "PUT": 1}
+    etag, ical = caldav_server.events[path]
+    assert "UID:entry-0" in ical
+    assert entries[0].etag == etag != '"changed"'
@@ -0,0 +1,32 @@
+import datetime
+from infomentor import db, informer, model
+
+
+def _queued(session, user_id):
+    return [
+        message.key
+        for message in session.query(model.OutboxMessage)
+        .filter(model.OutboxMessage.user_id == user_id)
+        .order_by(model.OutboxMessage.id)
+    ]
+
+
+def test_change_back_is_queued_again(database, make_user):
+    user_id = make_user("someone")
+    session = db.new_session()
+    user = session.query(model.User).get(user_id)
+    inf = informer.Informer(user, None, logger=None, session=session)
+    entry = model.CalendarEntry(calendar_id="exam", title="Exam", hash="a")
+    inf._add_item(entry)
+    # not sent yet, the same version is queued once only
+    inf._add_item(entry)
+    assert _queued(session, user_id) == ["calendar:{}:exam:a".format(user_id)]
+    for hash in ("b", "a"):
+        for message in session.query(model.OutboxMessage):
+            message.sent = datetime.datetime.now()
+        inf._add_item(entry, {"hash": hash})
+    session.commit()
+    assert _queued(session, user_id) == [
+        "calendar:{}:exam:{}".format(user_id, hash) for hash in "aba"
+    ]
+    session.close()
@@ -0,0 +1,87 @@
+import json
+import pytest
+from infomentor import jsonstream
+
+DOCUMENT = json.dumps(
+    {
+        "total": 4,
+        "items": [
+            {"id": 1, "title": "Übung – Größe", "score": -1.5e3},
+            {"id": 22, "title": 'say "hi" \\ \u00e4', "tags": ["a", "b"]},
+            0.25,
+            None,
+            True,
+            123456,
+        ],
+        "after": {"ignored": [1, 2]},
+    },
+    ensure_ascii=False,
+).encode("utf-8")
+ITEMS = json.loads(DOCUMENT)["items"]
+
+
+def _items(*chunks):
+    return list(jsonstream.iter_items(chunks))
+
+
+@pytest.mark.parametrize("position", range(len(DOCUMENT) + 1))
+def test_document_split_at_any_position(position):
+    assert _items(DOCUMENT[:position], DOCUMENT[position:]) == ITEMS
+
+
+def test_document_in_single_bytes():
+    assert _items(*(DOCUMENT[n : n + 1] for n in range(len(DOCUMENT)))) == ITEMS
+
+
+@pytest.mark.parametrize("number", [b"123", b"-1.5e3", b"2E+10", b"0.125"])
+def test_number_cut_at_the_chunk_end(number):
+    document = b'{"items": [' + number + b"]}"
+    for position in range(len(document)):
+        assert _items(document[:position], document[position:]) == [
+            json.loads(number)
+        ]
+
+
+def test_multibyte_character_cut_at_the_chunk_end():
+    document = '{"items": ["ä€𝄞"]}'.encode("utf-8")
+    chunks = [document[:13], document[13:16], document[16:19], document[19:]]
+    assert _items(*chunks) == ["ä€𝄞"]
+
+
+@pytest.mark.parametrize(
+    "document", [b"{}", b'{"items": []}', b'{"total": 0}', b' { "items" : [ ] } ']
+)
+def test_no_items(document):
+    assert _items(document) == []
+
+
+def test_keys_after_the_items_are_not_read():
+    chunks = [b'{"items": [1, 2], "total": 2', b", broken"]
+    assert _items(*chunks) == [1, 2]
+
+
+def test_elements_are_yielded_before_the_end_is_read():
+    def chunks():
+        yield b'{"items": [1, '
+        raise AssertionError("read too far")
+
+    assert next(jsonstream.iter_items(chunks())) == 1
+
+
+@pytest.mark.parametrize(
+    "document",
+    [
+        b"",
+        b"[1, 2]",
+        b'{"items": [1 2]}',
+        b'{"items": [1,',
+        b'{"items": [1, }',
+        b'{"items" [1]}',
+        b'{"total": 1 "items": [1]}',
+        b'{"items": ["open',
+        b'{"items": [tru]}',
+    ],
+)
+def test_malformed_document(document):
+    with pytest.raises(json.JSONDecodeError):
+        _items(document[:5], document[5:])
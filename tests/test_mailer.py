@@ -0,0 +1,217 @@
+import email
+import email.policy
+import os
+import re
+import smtplib
+import pytest
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from infomentor import config, db, informer, mailer, model
+
+
+class FakeSMTP(object):
+    """Records what is sent over a smtplib.SMTP_SSL connection"""
+
+    def __init__(self, server, connections):
+        self.server = server
+        self.connections = connections
+        self.messages = []
+        self.data = []
+        self.envelope = []
+        self.closed = False
+        self.reply = 250
+        # a dead connection raises like one closed by the server
+        self.dead = False
+        connections.append(self)
+
+    def login(self, username, password):
+        pass
+
+    def send_message(self, mail, *args, **kwargs):
+        if self.dead:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.messages.append(mail)
+
+    def mail(self, sender):
+        if self.dead:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.envelope.append(("MAIL", sender))
+        return 250, b"ok"
+
+    def rcpt(self, recipient):
+        self.envelope.append(("RCPT", recipient))
+        return 250, b"ok"
+
+    def putcmd(self, cmd):
+        self.envelope.append((cmd.upper(), None))
+        self.reply = 354
+
+    def getreply(self):
+        reply, self.reply = self.reply, 250
+        return reply, b"ok"
+
+    def send(self, chunk):
+        self.data.append(chunk)
+
+    def quit(self):
+        self.closed = True
+
+
+@pytest.fixture
+def smtp(workdir, monkeypatch):
+    """The fake connections opened by the pool of the run"""
+    connections = []
+    monkeypatch.setattr(
+        smtplib, "SMTP_SSL", lambda server: FakeSMTP(server, connections)
+    )
+    monkeypatch.setattr(mailer, "_pool", None)
+    yield connections
+    mailer.close_pool()
+
+
+@pytest.fixture
+def pool(smtp):
+    return mailer.SMTPPool("smtp.example.com", "user", "secret", maxmessages=2)
+
+
+def _unstuff(data):
+    """The mail data as it is stored by the receiving server"""
+    assert data.endswith(b"\r\n.\r\n")
+    return re.sub(rb"(?m)^\.", b"", data[: -len(b".\r\n")])
+
+
+def _attachments(data):
+    message = email.message_from_bytes(_unstuff(data), policy=email.policy.default)
+    return message, {
+        part.get_filename(): part.get_content() for part in message.iter_attachments()
+    }
+
+
+def _mail(text):
+    outer = MIMEMultipart()
+    outer.attach(MIMEText(text))
+    outer["Subject"] = "Test"
+    outer["From"] = "infomentor@example.com"
+    outer["To"] = "someone@example.com, Other <other@example.com>"
+    return outer
+
+
+def _write(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+    return str(path)
+
+
+def test_streamed_attachments_are_sent_unchanged(workdir):
+    content = os.urandom(3 * mailer.ENCODE_CHUNK + 100)
+    mail = mailer.StreamedMail(_mail("Hello"))
+    mail.attach_file(_write(workdir / "plan.pdf", content), "plan.pdf")
+    mail.attach_file(_write(workdir / "empty.bin", b""), "empty.bin")
+    data = b"".join(mail.chunks()) + b".\r\n"
+    message, attachments = _attachments(data)
+    assert attachments == {"plan.pdf": content, "empty.bin": b""}
+    assert message.get_body().get_content() == "Hello"
+    assert max(len(line) for line in data.split(b"\r\n")) <= 78
+
+
+def test_leading_dots_are_stuffed(workdir):
+    mail = mailer.StreamedMail(_mail(".hidden\n..two\nnot.a.dot\n."))
+    mail.attach_file(_write(workdir / "a.bin", b".dot\n"), "a.bin")
+    data = b"".join(mail.chunks()) + b".\r\n"
+    assert b"\r\n..hidden\r\n...two\r\nnot.a.dot\r\n..\r\n" in data
+    message, attachments = _attachments(data)
+    assert message.get_body().get_content().splitlines() == [
+        ".hidden",
+        "..two",
+        "not.a.dot",
+        ".",
+    ]
+    assert attachments == {"a.bin": b".dot\n"}
+
+
+def test_streamed_mail_is_sent_after_data(smtp, workdir):
+    content = os.urandom(1000)
+    mail = mailer.StreamedMail(_mail(".Hello"))
+    mail.attach_file(_write(workdir / "plan.pdf", content), "plan.pdf")
+    pool = mailer.SMTPPool("smtp.example.com", "user", "secret")
+    pool.send_streamed(mail)
+    (conn,) = smtp
+    assert conn.envelope == [
+        ("MAIL", "infomentor@example.com"),
+        ("RCPT", "someone@example.com"),
+        ("RCPT", "other@example.com"),
+        ("DATA", None),
+    ]
+    message, attachments = _attachments(b"".join(conn.data))
+    assert attachments == {"plan.pdf": content}
+    assert message.get_body().get_content().splitlines() == [".Hello"]
+
+
+def test_attachments_beyond_the_budget_are_linked(smtp, database):
+    cfg = config.load()
+    cfg["general"]["baseurl"] = "https://example.com/files"
+    text = "News"
+    small, large = b"s" * 1000, b"l" * 10000
+    cfg["smtp"]["maxsize"] = str(
+        len(text) + 4096 + mailer.encoded_size(len(small)) + 100
+    )
+    attachments = []
+    for name, content in (("large.pdf", large), ("small.pdf", small)):
+        os.makedirs(os.path.join("files", name[0]))
+        _write(os.path.join("files", name[0], name), content)
+        attachments.append(model.Attachment(localpath="{}/{}".format(name[0], name)))
+    session = db.new_session()
+    inf = informer.Informer(None, None, logger=None, session=session)
+    inf._send_attachment_mail(text, "Subject", attachments, "someone@example.com")
+    session.close()
+    (conn,) = smtp
+    message, sent = _attachments(b"".join(conn.data))
+    assert sent == {"small.pdf": small}
+    body = message.get_body().get_content()
+    assert "Attachment large.pdf: https://example.com/files/l/large.pdf" in body
+    assert "small.pdf" not in body
+
+
+def test_connections_are_reused_and_closed_after_maxmessages(smtp, pool):
+    mails = [MIMEText(str(n)) for n in range(5)]
+    for mail in mails:
+        pool.send_message(mail)
+    assert [conn.messages for conn in smtp] == [mails[:2], mails[2:4], mails[4:]]
+    assert [conn.closed for conn in smtp] == [True, True, False]
+    pool.close()
+    assert smtp[2].closed
+
+
+def test_lost_connection_is_replaced_once(smtp, pool):
+    first, second = MIMEText("first"), MIMEText("second")
+    pool.send_message(first)
+    # the idle connection timed out on the server
+    smtp[0].dead = True
+    pool.send_message(second)
+    assert len(smtp) == 2
+    assert smtp[0].closed
+    assert smtp[1].messages == [second]
+
+
+def test_streamed_mail_is_sent_again_over_a_new_connection(smtp, pool, workdir):
+    pool.send_message(MIMEText("first"))
+    smtp[0].dead = True
+    mail = mailer.StreamedMail(_mail("Hello"))
+    mail.attach_file(_write(workdir / "a.bin", b"content"), "a.bin")
+    pool.send_streamed(mail)
+    assert len(smtp) == 2
+    assert _attachments(b"".join(smtp[1].data))[1] == {"a.bin": b"content"}
+
+
+def test_second_lost_connection_fails(smtp, monkeypatch):
+    def dead(server):
+        conn = FakeSMTP(server, smtp)
+        conn.dead = True
+        return conn
+
+    monkeypatch.setattr(smtplib, "SMTP_SSL", dead)
+    pool = mailer.SMTPPool("smtp.example.com", "user", "secret")
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        pool.send_message(MIMEText("lost"))
+    assert len(smtp) == 2
+    assert all(conn.closed for conn in smtp)
@@ -0,0 +1,60 @@
+import time
+import pytest
+from infomentor import pushclient
+
+
+def _quota(remaining, reset):
+    return {"X-Limit-App-Remaining": str(remaining), "X-Limit-App-Reset": str(reset)}
+
+
+def test_messages_share_one_session(pushover):
+    client = pushclient.get_client()
+    client.send_message("user", "first", title="Title", html=True)
+    client.send_message("user", "second")
+    assert [r.url for r in pushover.requests] == [pushclient.API_URL] * 2
+    assert "token=token" in pushover.requests[0].body
+    assert "html=1" in pushover.requests[0].body
+    assert client.remaining is None
+
+
+def test_reserve_is_kept(pushover):
+    reset = int(time.time()) + 3600
+    pushover.responses = [(200, _quota(3, reset)), (200, _quota(2, reset))]
+    client = pushover.client
+    client.send_message("user", "first")
+    client.send_message("user", "second")
+    with pytest.raises(pushclient.RateLimited) as raised:
+        client.send_message("user", "third")
+    # refused without asking pushover
+    assert len(pushover.requests) == 2
+    assert raised.value.reset == reset
+    assert client.remaining == 2
+
+
+def test_quota_is_available_again_after_the_reset(pushover):
+    pushover.responses = [(200, _quota(0, int(time.time()) - 1))]
+    client = pushover.client
+    client.send_message("user", "first")
+    client.send_message("user", "after the reset")
+    assert len(pushover.requests) == 2
+    assert client.remaining is None
+
+
+def test_rejected_for_the_limit(pushover):
+    reset = int(time.time()) + 3600
+    pushover.responses = [(429, _quota(0, reset))]
+    client = pushover.client
+    with pytest.raises(pushclient.RateLimited) as raised:
+        client.send_message("user", "too many")
+    assert raised.value.reset == reset
+    with pytest.raises(pushclient.RateLimited):
+        client.send_message("user", "still too many")
+    assert len(pushover.requests) == 1
+
+
+def test_rejected_message(pushover):
+    pushover.responses = [(400, {})]
+    with pytest.raises(pushclient.PushoverError) as raised:
+        pushover.client.send_message("invalid", "message")
+    assert not isinstance(raised.value, pushclient.RateLimited)
+    assert str(raised.value) == "no"
@@ -0,0 +1,50 @@
+import datetime
+from infomentor import config, db, model
+from infomentor.__main__ import notify_users
+
+
+def _news_ids(user_id):
+    session = db.new_session(readonly=True)
+    news = session.query(model.News.news_id).filter(model.News.user_id == user_id)
+    ids = sorted(news_id for news_id, in news)
+    session.close()
+    return ids
+
+
+def test_news_are_paged_until_the_watermark(infomentor_server, make_user):
+    config.load()["sync"]["pagesize"] = "2"
+    for news_id in range(1, 6):
+        infomentor_server.add_news(news_id)
+    user_id = make_user("someone")
+    notify_users()
+    # the first run fetches the complete list at once
+    assert infomentor_server.pages == [(-1, 1)]
+    for news_id in range(6, 9):
+        infomentor_server.add_news(news_id)
+    del infomentor_server.pages[:]
+    notify_users()
+    # news 5 is on the watermark, the run stops at news 4 on page 3
+    assert infomentor_server.pages == [(2, 1), (2, 2), (2, 3)]
+    assert _news_ids(user_id) == list(range(1, 9))
+
+
+def test_news_are_synced_in_full_after_fullsync_hours(infomentor_server, make_user):
+    config.load()["sync"]["fullsync"] = "1"
+    infomentor_server.add_news(1)
+    user_id = make_user("someone")
+    notify_users()
+    notify_users()
+    assert infomentor_server.pages == [(-1, 1), (20, 1)]
+    session = db.new_session()
+    state = (
+        session.query(model.SyncState)
+        .filter(model.SyncState.user_id == user_id)
+        .filter(model.SyncState.endpoint == "News")
+        .one()
+    )
+    state.last_full_sync -= datetime.timedelta(hours=2)
+    session.commit()
+    session.close()
+    del infomentor_server.pages[:]
+    notify_users()
+    assert infomentor_server.pages == [(-1, 1)]
@@ -0,0 +1,112 @@
+import logging
+import re
+from sqlalchemy import event
+from infomentor import config, db, model
+from infomentor.__main__ import notify_users, parse_args, perform_user_update
+
+
+def _errors(caplog):
+    return [r.getMessage() for r in caplog.records if r.levelno >= logging.ERROR]
+
+
+def test_parallel_workers_update_every_user(infomentor_server, make_user, caplog):
+    infomentor_server.add_news(1, [(11, "plan.pdf", b"plan")])
+    infomentor_server.add_news(2)
+    for n in range(8):
+        make_user("user{}".format(n))
+    with caplog.at_level(logging.ERROR):
+        notify_users(workers=4)
+    assert _errors(caplog) == []
+    session = db.new_session(readonly=True)
+    users = session.query(model.User).all()
+    assert len(users) == 8
+    for user in users:
+        assert user.apistatus.ok
+        assert sorted(news.news_id for news in user.news) == [1, 2]
+        queued = session.query(model.OutboxMessage).filter(
+            model.OutboxMessage.user_id == user.id
+        )
+        assert queued.count() == 2
+    session.close()
+
+
+def test_no_transaction_is_open_during_requests(
+    workdir, infomentor_server, make_user
+):
+    infomentor_server.add_news(1, [(11, "plan.pdf", b"plan")])
+    make_user("someone")
+    make_user("another")
+    infomentor_server.database = str(workdir / "infomentor.db")
+    notify_users()
+    assert infomentor_server.requests["/Communication/News/GetNewsList"] == 2
+    assert infomentor_server.locked == []
+
+
+def test_unchanged_run_does_not_query_items(infomentor_server, make_user):
+    infomentor_server.add_news(1, [(11, "plan.pdf", b"plan")])
+    infomentor_server.calendar = [
+        {
+            "id": 7,
+            "title": "Exam",
+            "start": "2019-09-02T08:00:00",
+            "end": "2019-09-02T09:00:00",
+        }
+    ]
+    user_id = make_user("someone")
+    session = db.new_session()
+    session.query(model.User).get(user_id).feed_token = "token"
+    session.commit()
+    session.close()
+    # a full sync, then the first paged run that remembers the fingerprint
+    notify_users()
+    notify_users()
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db.get_engine()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        notify_users()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert infomentor_server.requests["/Communication/News/GetNewsList"] == 3
+    items = re.compile(r"\b(FROM|JOIN) (news|homework|calendarentries)\b")
+    assert [s for s in statements if items.search(s)] == []
+
+
+def test_failing_user_does_not_stop_the_run(infomentor_server, make_user):
+    infomentor_server.add_news(1)
+    make_user("first")
+    broken = make_user("broken")
+    make_user("last")
+    session = db.new_session()
+    # the password can not be decrypted, updating this user raises
+    session.query(model.User).get(broken).enc_password = "broken"
+    session.commit()
+    session.close()
+    config.load()["healthchecks"]["url"] = infomentor_server.url + "/ping"
+    notify_users()
+    session = db.new_session(readonly=True)
+    updated = {user.name for user in session.query(model.User).join(model.News)}
+    session.close()
+    assert updated == {"first", "last"}
+    assert infomentor_server.requests["/ping/start"] == 1
+    assert infomentor_server.requests["/ping"] == 1
+
+
+def test_adding_and_updating_a_user(database, caplog):
+    with caplog.at_level(logging.INFO):
+        perform_user_update(parse_args(["--username", "someone", "--password", "a"]))
+        perform_user_update(
+            parse_args(["--username", "someone", "--password", "b", "--fake"])
+        )
+    messages = [r.getMessage() for r in caplog.records]
+    assert "Creating user someone" in messages
+    assert "Updating user someone" in messages
+    session = db.new_session(readonly=True)
+    user = session.query(model.User).one()
+    assert user.password == "b"
+    assert user.notification.ntype == model.Notification.Types.FAKE
+    session.close()
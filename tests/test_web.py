@@ -0,0 +1,54 @@
+import datetime
+import time
+import pytest
+from infomentor import db, model, web
+
+ICAL = b"BEGIN:VCALENDAR\nEND:VCALENDAR\n"
+MODIFIED = datetime.datetime(2019, 9, 2, 8, 0, 0)
+
+
+@pytest.fixture
+def client(make_user):
+    user_id = make_user("someone")
+    session = db.new_session()
+    user = session.query(model.User).get(user_id)
+    user.feed_token = "token"
+    user.calendarfeed = model.CalendarFeed(ical=ICAL, etag="abc", modified=MODIFIED)
+    session.commit()
+    session.close()
+    return web.app.test_client()
+
+
+def test_unknown_feed_is_not_found(client):
+    assert client.get("/calendar/unknown.ics").status_code == 404
+
+
+def test_feed_is_served_with_validators(client):
+    response = client.get("/calendar/token.ics")
+    assert response.status_code == 200
+    assert response.data == ICAL
+    assert response.mimetype == "text/calendar"
+    assert response.headers["ETag"] == '"abc"'
+    assert response.last_modified == MODIFIED.replace(tzinfo=datetime.timezone.utc)
+
+
+def test_unchanged_feed_is_not_sent_again(client):
+    response = client.get("/calendar/token.ics", headers={"If-None-Match": '"abc"'})
+    assert response.status_code == 304
+    assert response.data == b""
+    response = client.get("/calendar/token.ics", headers={"If-None-Match": '"old"'})
+    assert response.status_code == 200
+
+
+def test_feed_is_served_while_a_run_writes(client, database_locked):
+    writer = db.new_session()
+    writer.add(model.SyncState(endpoint="Calendar"))
+    writer.flush()
+    started = time.monotonic()
+    assert client.get("/calendar/token.ics").status_code == 200
+    assert time.monotonic() - started < 1
+    writer.commit()
+    writer.close()
+    # the request did not leave a lock behind
+    assert client.get("/calendar/token.ics").status_code == 200
+    assert not database_locked()